@@ -25,6 +25,7 @@
 
 import threading
 import time
+import Queue
 import datetime
 import traceback
 
@@ -42,6 +43,65 @@ except:
 global updater
 updater = False
 
+class StockDownloader:
+	'''Download stock data on a bounded pool of threads.
+	Downloads do not touch the database, the caller saves each result from getResult.'''
+	def __init__(self, stockData, requests, maxThreads = 4, retries = 3):
+		self.stockData = stockData
+		self.retries = retries
+		self.running = True
+		self.pending = len(requests)
+		self.requests = Queue.Queue()
+		self.results = Queue.Queue()
+		for r in requests:
+			self.requests.put(r)
+		
+		for i in range(min(maxThreads, len(requests))):
+			t = threading.Thread(target = self.download, name = "stockDownloader%d" % i)
+			t.setDaemon(True)
+			t.start()
+	
+	def download(self):
+		while self.running:
+			try:
+				(chunk, request, icarraTickers) = self.requests.get_nowait()
+			except Queue.Empty:
+				return
+			
+			# Retry with exponential backoff (1, 2, 4... seconds)
+			data = False
+			delay = 1
+			for attempt in range(self.retries):
+				try:
+					data = self.stockData.downloadStockData(request, icarraTickers)
+					break
+				except Exception, e:
+					if attempt == self.retries - 1:
+						break
+					wait = time.time() + delay
+					while self.running and time.time() < wait:
+						time.sleep(0.1)
+					delay *= 2
+					if not self.running:
+						break
+			self.results.put((chunk, data))
+	
+	def getResult(self, timeout = 0.5):
+		'''Return (tickers, data) for the next finished download, data is False if the download failed.
+		Return None if nothing finished within timeout.'''
+		try:
+			result = self.results.get(True, timeout)
+		except Queue.Empty:
+			return None
+		self.pending -= 1
+		return result
+	
+	def finished(self):
+		return self.pending == 0 or not self.running
+	
+	def stop(self):
+		self.running = False
+
 class AutoUpdater(threading.Thread):
 	def __init__(self, stockData, prefs):
 		self.stockData = stockData
@@ -81,7 +141,7 @@ class AutoUpdater(threading.Thread):
 				cutoffTime -= datetime.timedelta(days = 1)
 			cutoffTime = datetime.datetime(cutoffTime.year, cutoffTime.month, cutoffTime.day, 0, 0, 0)
 
-			# Load all portfolios
+			# Load all portfolios, they stay open for the next check
 			# Build list of tickers, update stock data
 			names = self.prefs.getPortfolios()
 			tickers = []
@@ -89,9 +149,7 @@ class AutoUpdater(threading.Thread):
 			tickerPorts = {}
 			ports = {}
 			for name in names:
-				p = portfolio.Portfolio(name)
-				p.readFromDb()
-				ports[name] = p
+				ports[name] = portfolio.getPortfolio(name)
 				
 			# Auto update
 			if app.prefs.getBackgroundImport() and haveKeyring:
@@ -121,19 +179,31 @@ class AutoUpdater(threading.Thread):
 							# It may be an error string, in which case it's ignored
 							ofx = getOfx(p.username, password, brokerage, p.account)
 							if ofx != "":
+								# updateFromFile marks the portfolio as dirty
 								(numNew, numOld, newTickers) = p.updateFromFile(ofx, app)
-								if numNew > 0 or newTickers:
-									p.portPrefs.setDirty(True)
 							print "imported"
 
 					# Update time only if not aborted
 					if self.running:
 						app.prefs.setLastBackgroundImport()
 
-			# Build list of tickers
+			# Build list of tickers from the saved tickers of each portfolio
+			# Combined portfolios depend on the tickers of their components
+			portTickers = {}
+			for name, p in ports.items():
+				if not p.isCombined():
+					portTickers[name] = self.getPortfolioTickers(p)
+			for name, p in ports.items():
+				if p.isCombined():
+					pTickers = {}
+					for component in p.portPrefs.getCombinedComponents():
+						if component in portTickers:
+							for ticker in portTickers[component]:
+								pTickers[ticker] = True
+					portTickers[name] = sorted(pTickers.keys())
+			
 			for name, p in ports.items():
-				pTickers = p.getTickers(includeAllocation = True)
-				for ticker in pTickers:
+				for ticker in portTickers[name]:
 					if ticker in ["__CASH__", "__COBMINED__"]:
 						continue
 					
@@ -161,7 +231,9 @@ class AutoUpdater(threading.Thread):
 					tickers.remove(ticker)
 					continue
 					
+			# Key is portfolio name, value is a dictionary of ticker to earliest date of new stock data
 			portsToUpdate = {}
+			newDates = {}
 			self.tickersToImport = len(tickers)
 			
 			# Lump all tickers that are less than 2 weeks old into one request
@@ -174,48 +246,70 @@ class AutoUpdater(threading.Thread):
 					continue
 			
 			# Download the 2 week lump 10 tickers at a time
-			while updateNow and self.running and not appGlobal.getFailConnected():
-				downloadPart = updateNow[0:10]
+			# Download each remaining ticker by itself
+			# Only remaining tickers add 3 for every port that needs rebuilding
+			chunks = []
+			while updateNow:
+				chunks.append((updateNow[0:10], False))
 				updateNow = updateNow[10:]
-				try:
-					new = self.stockData.updateStocks(downloadPart)
-					appGlobal.setConnected(True)
-				except Exception, e:
+			for ticker in tickers:
+				chunks.append(([ticker], True))
+			
+			# Requests are built here so this thread is the only one writing to the database
+			requests = []
+			countRebuild = {}
+			if self.running and not appGlobal.getFailConnected():
+				for (chunk, rebuild) in chunks:
+					update = self.stockData.getUpdateRequest(chunk)
+					(request, icarraTickers) = self.stockData.encodeRequest(update)
+					requests.append((chunk, request, icarraTickers))
+					countRebuild[tuple(chunk)] = rebuild
+			
+			downloader = False
+			if requests:
+				downloader = StockDownloader(self.stockData, requests)
+			while downloader and not downloader.finished():
+				if not self.running or appGlobal.getFailConnected():
+					downloader.stop()
+					break
+				result = downloader.getResult()
+				if not result:
+					continue
+				
+				(chunk, data) = result
+				if data is False:
 					appGlobal.setFailConnected(True)
+					downloader.stop()
 					break
-				for ticker in downloadPart:
-					self.tickerCount += 1
-					if new:
-						for p in tickerPorts[ticker]:
-							portsToUpdate[p.name] = True
-
-			# Update each remaining ticker while still running
-			for ticker in tickers:
-				if self.running and not appGlobal.getFailConnected():
-					try:
-						new = self.stockData.updateStocks([ticker])
-						appGlobal.setConnected(True)
-					except Exception, e:
-						appGlobal.setFailConnected(True)
-						break
-					if new:
+				
+				app.beginBigTask('downloading stock data')
+				try:
+					new = self.stockData.saveStockData(data, newDates)
+				finally:
+					app.endBigTask()
+				appGlobal.setConnected(True)
+				
+				for ticker in chunk:
+					if new and ticker in newDates:
 						for p in tickerPorts[ticker]:
 							# Add 3 for every port
-							if not p.name in portsToUpdate:
+							if countRebuild[tuple(chunk)] and not p.name in portsToUpdate:
 								if app.prefs.getBackgroundRebuild():
 									self.tickersToImport += 3
-								portsToUpdate[p.name] = True
-
-				self.tickerCount += 1
+							self.addPortToUpdate(portsToUpdate, p, ticker, newDates[ticker])
+				self.tickerCount += len(chunk)
 			
-			# Mark every portfolio as dirty
+			# Mark the tickers of every portfolio as dirty from their earliest new stock data
+			# Only positions depending on these tickers are replayed
 			for name in portsToUpdate:
-				ports[name].portPrefs.setDirty(True)
+				for (ticker, date) in portsToUpdate[name].items():
+					ports[name].setStockDataDirty(date, ticker)
 			
 			# Next rebuild if the user has it configured
 			if app.prefs.getBackgroundRebuild():
 				self.rebuilding = True
 				# Rebuild benchmarks, portfolios, combined portfolios
+				rebuilt = {}
 				for name, p in ports.items():
 					if not self.running:
 						break
@@ -233,12 +327,19 @@ class AutoUpdater(threading.Thread):
 						try:
 							#print "Rebuilding brokerage", name
 							ports[name].rebuildPositionHistory(self.stockData)
+							rebuilt[name] = True
 						except Exception, e:
 							print traceback.format_exc()
 						self.tickerCount += 3
 				for name, p in ports.items():
 					if not self.running:
 						break
+					# Combined portfolios are rebuilt after any of their components
+					if p.isCombined() and not p.portPrefs.getDirty():
+						for component in p.portPrefs.getCombinedComponents():
+							if component in rebuilt:
+								p.portPrefs.setDirty(True)
+								break
 					if p.portPrefs.getDirty() and p.isCombined():
 						try:
 							#print "Rebuilding combined", name
@@ -248,10 +349,6 @@ class AutoUpdater(threading.Thread):
 						self.tickerCount += 3
 				self.rebuilding = False
 			
-			# Close all opened portfolios
-			for name, p in ports.items():
-				p.close()
-			
 			now = datetime.datetime.now()
 			#print "Finished checking for new stock data at %s" % now.strftime("%Y-%m-%d %H:%M:%S")
 
@@ -269,6 +366,23 @@ class AutoUpdater(threading.Thread):
 
 		self.finished = True
 		
+	def addPortToUpdate(self, portsToUpdate, p, ticker, date):
+		if not p.name in portsToUpdate:
+			portsToUpdate[p.name] = {}
+		tickerDates = portsToUpdate[p.name]
+		if not ticker in tickerDates or date < tickerDates[ticker]:
+			tickerDates[ticker] = date
+	
+	def getPortfolioTickers(self, p):
+		"""Return the tickers of a portfolio that is not combined.
+		Tickers are saved and read again only if transactions may have changed."""
+		tickers = self.prefs.getPortfolioTickers(p.name)
+		transactionsChanged = p.portPrefs.getDirty() and p.portPrefs.getDirtyTickers() is False
+		if tickers is False or transactionsChanged:
+			tickers = p.getTickers(includeAllocation = True)
+			self.prefs.setPortfolioTickers(p.name, tickers)
+		return tickers
+
 	def stop(self):
 		self.running = False
 		self.wakeUp()
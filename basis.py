@@ -1,94 +1,200 @@
 import appGlobal
+import bisect
+import heapq
 
 from transaction import *
 
+class LotLedger:
+	"""Lots of one ticker ordered by purchase date.  A lot is a list of [date, quantity, pricePerShare].
+	Quantities may be negative for shorts.  Running totals make getShares, getBasis and getTotalBasis O(1)."""
+
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		self.lots = []
+		# Purchase date of each lot for bisect
+		self.dates = []
+		# Lots before first are used up
+		self.first = 0
+		self.count = 0
+		self.shares = 0
+		self.total = 0
+		# Heap of (-pricePerShare, seq, lot) for hifo, built when first needed
+		self.heap = False
+		self.seq = 0
+
+	def add(self, date, quantity, pricePerShare):
+		if quantity == 0:
+			return
+		lot = [date, quantity, pricePerShare]
+		if not self.dates or date >= self.dates[-1]:
+			self.lots.append(lot)
+			self.dates.append(date)
+		else:
+			i = bisect.bisect_right(self.dates, date, self.first)
+			self.lots.insert(i, lot)
+			self.dates.insert(i, date)
+		self.count += 1
+		self.shares += quantity
+		self.total += quantity * pricePerShare
+		if self.heap is not False:
+			self.seq += 1
+			heapq.heappush(self.heap, (-pricePerShare, self.seq, lot))
+
+	def nextLot(self, method, date = False):
+		"""Return the next lot to remove shares from or False"""
+		if method == Basis.lifo:
+			while len(self.lots) > self.first and self.lots[-1][1] == 0:
+				self.lots.pop()
+				self.dates.pop()
+			if len(self.lots) > self.first:
+				return self.lots[-1]
+		elif method == Basis.hifo:
+			if self.heap is False:
+				self.heap = []
+				for lot in self.lots[self.first:]:
+					if lot[1] != 0:
+						self.seq += 1
+						self.heap.append((-lot[2], self.seq, lot))
+				heapq.heapify(self.heap)
+			while self.heap and self.heap[0][2][1] == 0:
+				heapq.heappop(self.heap)
+			if self.heap:
+				return self.heap[0][2]
+		elif method == Basis.specificLot:
+			i = bisect.bisect_left(self.dates, date, self.first)
+			while i < len(self.dates) and self.dates[i] == date:
+				if self.lots[i][1] != 0:
+					return self.lots[i]
+				i += 1
+		else:
+			while self.first < len(self.lots) and self.lots[self.first][1] == 0:
+				self.first += 1
+			if self.first < len(self.lots):
+				return self.lots[self.first]
+		return False
+
+	def remove(self, quantity, method = False, date = False):
+		"""Remove quantity from the lots chosen by method, fifo by default.
+		specificLot removes from the lots purchased on date.
+		Return the quantity that could not be removed."""
+		while abs(quantity) > 1.0e-6:
+			lot = self.nextLot(method, date)
+			if not lot:
+				break
+			if abs(lot[1]) > abs(quantity):
+				# Remove some shares
+				lot[1] -= quantity
+				self.shares -= quantity
+				self.total -= quantity * lot[2]
+				quantity = 0
+			else:
+				# Remove completely
+				quantity -= lot[1]
+				self.shares -= lot[1]
+				self.total -= lot[1] * lot[2]
+				lot[1] = 0
+				self.count -= 1
+				if self.count == 0:
+					self.clear()
+		
+		# Drop used up lots and recompute totals so rounding does not accumulate
+		if self.first > 64 and self.first * 2 > len(self.lots):
+			del self.lots[:self.first]
+			del self.dates[:self.first]
+			self.first = 0
+			self.updateTotals()
+		return quantity
+
+	def scale(self, shareFactor):
+		"""Multiply quantities by shareFactor keeping the total basis, as for a split"""
+		for lot in self.lots[self.first:]:
+			lot[1] *= shareFactor
+			lot[2] /= shareFactor
+		self.updateTotals()
+
+	def adjustPrices(self, percent):
+		"""Multiply the price of every lot by percent"""
+		for lot in self.lots[self.first:]:
+			lot[2] *= percent
+		self.updateTotals()
+
+	def updateTotals(self):
+		self.shares = 0
+		self.total = 0
+		for lot in self.lots[self.first:]:
+			self.shares += lot[1]
+			self.total += lot[1] * lot[2]
+		# Prices may have changed
+		self.heap = False
+
+	def getLots(self):
+		"""Return a list of (date, quantity, pricePerShare)"""
+		return [tuple(lot) for lot in self.lots[self.first:] if lot[1] != 0]
+
+	def isEmpty(self):
+		return self.count == 0
+
+	def getShares(self):
+		return self.shares
+
+	def getBasis(self):
+		if self.shares == 0:
+			return 0
+		return self.total / self.shares
+
+	def getTotalBasis(self):
+		return self.total
+
 class Basis:
 	"""Implements a basis tracker.  Ticker can be a simple stock ticker or a tuple for tracking options.  An options tuple is (ticker, Transaction.optionCall | Transaction.optionPut, strike, expire)"""
 
-	# tickers[ticker][pricePerShare] = (datePurchased, quantity)
-	# The (datePurchased, quantity) tuple should be removed once quantity goes to 0
-	def __init__(self):
+	# Lot selection methods when removing shares
+	fifo = "fifo"
+	lifo = "lifo"
+	hifo = "hifo"
+	specificLot = "specificLot"
+
+	# tickers[ticker] = LotLedger
+	# The ledger is removed once its quantity goes to 0
+	def __init__(self, method = fifo):
 		self.tickers = {}
+		self.method = method
 
 	def add(self, ticker, datePurchased, quantity, pricePerShare):
 		if not ticker in self.tickers:
-			self.tickers[ticker] = {}
-		if not pricePerShare in self.tickers[ticker]:
-			self.tickers[ticker][pricePerShare] = []
-		self.tickers[ticker][pricePerShare].append((datePurchased, quantity))
+			self.tickers[ticker] = LotLedger()
+		self.tickers[ticker].add(datePurchased, quantity, pricePerShare)
+		if self.tickers[ticker].isEmpty():
+			del self.tickers[ticker]
 
-	def remove(self, ticker, quantity):
+	def remove(self, ticker, quantity, method = False, date = False):
+		"""Remove quantity shares of ticker.  Lots are chosen by method or the default method of this tracker.
+		Pass the purchase date of the lot for Basis.specificLot."""
 		if not ticker in self.tickers:
 			#print "no basis for", ticker, quantity
 			return
-		# Keep looping until we have removed all quantity
-		while quantity > 1.0e-6:
-			# Find minimum date
-			minDate = False
-			for ts in self.tickers[ticker].itervalues():
-				for t in ts:
-					if minDate is False or t[0] < minDate:
-						minDate = t[0]
-			if minDate is False:
-				#print "no dates for", ticker
-				return
-
-			# Remove shares from minimum dates
-			removed = 0
-			i = 0
-			for (pricePerShare, ts) in self.tickers[ticker].items():
-				for t in ts:
-					if t[0] != minDate:
-						continue
-					if t[1] <= quantity:
-						# Remove completely
-						removed += t[1]
-						quantity -= t[1]
-						self.tickers[ticker][pricePerShare].remove(t)
-						if len(self.tickers[ticker][pricePerShare]) == 0:
-							del self.tickers[ticker][pricePerShare]
-						if len(self.tickers[ticker]) == 0:
-							del self.tickers[ticker]
-							if quantity > 1.0e-6:
-								app = appGlobal.getApp()
-								if app and app.statusUpdate:
-									app.statusUpdate.addMessage("Left over quantity %s, shares = %f" % (ticker, quantity))
-								return
-					else:
-						# Remove some shares
-						removed += quantity
-						self.tickers[ticker][pricePerShare][i] = (t[0], t[1] - quantity)
-						quantity = 0
-						i += 1
-
-			# Makes ure something was removed
-			if removed == 0:
-				#print "Could not finish basis for", ticker
-				break
+		if method is False:
+			method = self.method
+		quantity = self.tickers[ticker].remove(quantity, method, date)
+		if self.tickers[ticker].isEmpty():
+			del self.tickers[ticker]
+			if quantity > 1.0e-6:
+				app = appGlobal.getApp()
+				if app and app.statusUpdate:
+					app.statusUpdate.addMessage("Left over quantity %s, shares = %f" % (ticker, quantity))
 
 	def getShares(self, ticker):
 		if not ticker in self.tickers:
 			return 0
-		count = 0
-		for ts in self.tickers[ticker].itervalues():
-			for t in ts:
-				count += t[1]
-		return count
+		return self.tickers[ticker].getShares()
 
 	def getBasis(self, ticker):
 		"""Get the basis per share for a stock or option"""
-		if not ticker in self.tickers:
-			return 0
-		count = 0
-		sum = 0
-		for (pricePerShare, ts) in self.tickers[ticker].items():
-			for t in ts:
-				count += t[1]
-				sum += t[1] * pricePerShare
-		if count > 0:
-			return float(sum) / count
-		else:
+		if not ticker in self.tickers or self.tickers[ticker].getShares() <= 0:
 			return 0
+		return float(self.tickers[ticker].getTotalBasis()) / self.tickers[ticker].getShares()
 
 	def getTotalBasis(self, ticker = False):
 		"""Get the total basis for a ticker.  This includes stocks and options.  Pass ticker as False to get the basis for all stocks and options."""
@@ -97,11 +203,20 @@ class Basis:
 			# Check for ticker or for option
 			if ticker and t != ticker and not (isinstance(t, tuple) and t[0] == ticker):
 				continue
-			for (pricePerShare, ts) in self.tickers[t].items():
-				for t in ts:
-					sum += t[1] * pricePerShare
+			sum += self.tickers[t].getTotalBasis()
 		return sum
 
+	def getState(self):
+		"""Return the lots of every ticker as a dictionary of lists of (date, quantity, pricePerShare)"""
+		return dict([(t, self.tickers[t].getLots()) for t in self.tickers])
+
+	def setState(self, state):
+		"""Replace the lots with a dictionary returned by getState"""
+		self.tickers = {}
+		for (ticker, lots) in state.items():
+			for (date, quantity, pricePerShare) in lots:
+				self.add(ticker, date, quantity, pricePerShare)
+
 if __name__ == "__main__":
 	print "test 1 - basic add remove"
 	b = Basis()
@@ -196,3 +311,32 @@ if __name__ == "__main__":
 	assert(b.getBasis("A") == 0)
 	assert(b.getTotalBasis("A") == 0)
 	assert(len(b.tickers) == 0)
+
+	print "test 5 - lot selection"
+	b = Basis()
+	b.add("A", "2011-01-01", 10, 20)
+	b.add("A", "2011-01-02", 10, 30)
+	b.add("A", "2011-01-03", 10, 25)
+	b.remove("A", 5, Basis.lifo)
+	assert(b.getShares("A") == 25)
+	assert(b.getTotalBasis("A") == 625)
+	b.remove("A", 10, Basis.hifo)
+	assert(b.getShares("A") == 15)
+	assert(b.getTotalBasis("A") == 325)
+	b.remove("A", 5, Basis.specificLot, "2011-01-01")
+	assert(b.getTotalBasis("A") == 225)
+	b.remove("A", 5)
+	assert(b.getShares("A") == 5)
+	assert(b.getBasis("A") == 25)
+	b.add("A", "2011-01-02", 5, 10)
+	b.remove("A", 5)
+	assert(b.getBasis("A") == 25)
+
+	print "test 6 - many small lots"
+	b = Basis()
+	for i in range(10000):
+		b.add("A", i, 1, 10)
+	for i in range(9999):
+		b.remove("A", 1)
+	assert(b.getShares("A") == 1)
+	assert(b.getTotalBasis("A") == 10)
@@ -0,0 +1,114 @@
+import datetime
+import os
+import threading
+import bisect
+from array import array
+
+import appGlobal
+from db import *
+
+class BenchmarkHistory:
+	"""The __COMBINED__ position history of a benchmark in arrays indexed by day.
+	Portfolios share one copy per benchmark, it is read again when the benchmark is rebuilt."""
+	def __init__(self, stamp, rows):
+		self.stamp = stamp
+		self.days = array("l")
+		self.value = array("d")
+		self.normSplit = array("d")
+		self.normDividend = array("d")
+		self.normFee = array("d")
+		for (day, date, value, normSplit, normDividend, normFee) in rows:
+			# Only parse dates saved before the day column was filled
+			if day is None:
+				day = datetime.datetime.strptime(date[:10], "%Y-%m-%d").toordinal()
+			self.days.append(day)
+			self.value.append(value or 0.0)
+			self.normSplit.append(normSplit or 0.0)
+			self.normDividend.append(normDividend or 0.0)
+			self.normFee.append(normFee or 0.0)
+
+		# Key is day ordinal, value is index
+		self.index = dict(zip(self.days, range(len(self.days))))
+
+	def __len__(self):
+		return len(self.days)
+
+	def find(self, day):
+		"""Return the index of a day ordinal or -1 if there is no history on that day"""
+		return self.index.get(day, -1)
+
+	def getDate(self, i):
+		return datetime.datetime.fromordinal(self.days[i])
+
+	def getIndexes(self, startDate = False):
+		"""Return the indexes of every day on or after startDate"""
+		if not startDate:
+			return range(len(self.days))
+		return range(bisect.bisect_left(self.days, startDate.toordinal()), len(self.days))
+
+class BenchmarkCache:
+	def __init__(self):
+		self.histories = {}
+		self.dbs = {}
+		self.lock = threading.Lock()
+
+	def getDb(self, name):
+		if not name in self.dbs:
+			self.dbs[name] = Db(appGlobal.getApp().prefs.getPortfolioPath(name))
+		return self.dbs[name]
+
+	def close(self, name):
+		"""Close and forget the database of benchmark name before it is renamed or deleted"""
+		self.lock.acquire()
+		try:
+			db = self.dbs.pop(name, False)
+			self.histories.pop(name, False)
+		finally:
+			self.lock.release()
+		if db:
+			db.close()
+
+	def getStamp(self, db):
+		"""Return the lastRebuild preference of a benchmark without opening the portfolio"""
+		try:
+			row = db.select("prefs", where = {"name": "lastRebuild"}).fetchone()
+		except Exception:
+			return False
+		if not row:
+			return False
+		return row["value"]
+
+	def getHistory(self, name):
+		"""Return the BenchmarkHistory of benchmark name, reading it only if it was rebuilt"""
+		# Do not create a database for a missing benchmark
+		if not os.path.exists(appGlobal.getApp().prefs.getPortfolioPath(name)):
+			return BenchmarkHistory(False, [])
+		
+		self.lock.acquire()
+		try:
+			db = self.getDb(name)
+			stamp = self.getStamp(db)
+			history = self.histories.get(name)
+			if not history or history.stamp != stamp:
+				# Benchmarks saved before the day column get it when next opened as a portfolio
+				if db.hasColumn("positionHistory", "day"):
+					what = "day, date, value, normSplit, normDividend, normFee"
+				else:
+					what = "null, date, value, normSplit, normDividend, normFee"
+				cursor = db.selectTuples("positionHistory", what = what, where = {"ticker": "__COMBINED__"}, orderBy = "date")
+				history = BenchmarkHistory(stamp, cursor.fetchall())
+				self.histories[name] = history
+			return history
+		finally:
+			self.lock.release()
+
+global cache
+cache = BenchmarkCache()
+
+def getHistory(name):
+	global cache
+	return cache.getHistory(name)
+
+def close(name):
+	global cache
+	cache.close(name)
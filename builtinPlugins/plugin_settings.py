@@ -212,7 +212,7 @@ class PortfolioSettingsWidget(QWidget):
 			portfolios = self.app.prefs.getPortfolios()
 			choices = []
 			for name in portfolios:
-				port = Portfolio(name)
+				port = getPortfolio(name)
 				if port.isBenchmark():
 					choices.append(port.name)
 			self.benchmarkChoices = choices
@@ -298,7 +298,7 @@ class PortfolioSettingsWidget(QWidget):
 			compFrame = QFrame()
 			compFrameLayout = QVBoxLayout(compFrame)
 			for portName in self.app.prefs.getPortfolios():
-				p = Portfolio(portName)
+				p = getPortfolio(portName)
 				if p.isBrokerage():
 					check = QCheckBox(portName)
 					compFrameLayout.addWidget(check)
@@ -468,21 +468,20 @@ class PortfolioSettingsWidget(QWidget):
 	def newName(self):
 		name = str(self.name.text())
 		if name != self.app.portfolio.name:
+			closePortfolio(self.app.portfolio.name)
 			error = self.app.prefs.changePortfolioName(self.app.portfolio.name, name)
 			if not error:
 				self.app.prefs.setLastPortfolio(name)
 				self.app.main.setWindowTitle(name)
 				self.app.rebuildPortfoliosMenu()
 	
-			self.app.portfolio = Portfolio(name)
-			self.app.portfolio.readFromDb()
+			self.app.portfolio = getPortfolio(name)
 	
 	def newBenchmark(self):
 		benchmark = self.benchmarkChoices[self.benchmark.currentIndex()]
 		self.app.portfolio.setBenchmark(benchmark)
 
-		self.app.portfolio = Portfolio(self.app.portfolio.name)
-		self.app.portfolio.readFromDb()
+		self.app.portfolio = getPortfolio(self.app.portfolio.name)
 	
 	def newReport(self):
 		summ = self.reportChoices[self.report.currentIndex()]
@@ -493,8 +492,7 @@ class PortfolioSettingsWidget(QWidget):
 		else:
 			self.app.portfolio.setSummaryYears("allYears")
 
-		self.app.portfolio = Portfolio(self.app.portfolio.name)
-		self.app.portfolio.readFromDb()
+		self.app.portfolio = getPortfolio(self.app.portfolio.name)
 	
 	def newSummary1(self):
 		types = chart.getSummaryChartTypes(self.app.portfolio)
@@ -549,8 +547,7 @@ class PortfolioSettingsWidget(QWidget):
 			username,
 			account)
 
-		self.app.portfolio = Portfolio(name)
-		self.app.portfolio.readFromDb()
+		self.app.portfolio = getPortfolio(name)
 
 	def changeAccount(self):
 		self.app.portfolio.account = ""
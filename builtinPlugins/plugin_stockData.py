@@ -413,6 +413,7 @@ class StockDataWidget(QWidget):
 			else:
 				price = self.model.priceMap[row]
 				app.stockData.db.delete("stockData", {"ticker": self.model.ticker, "date": price["date"].strftime("%Y-%m-%d %H:%M:%S")})
+			app.stockData.invalidateCache(self.model.ticker)
 
 			self.model.setStockData()
 			self.table.resizeColumnsToContents()
@@ -706,6 +707,7 @@ class NewStockData(QDialog):
 
 			data = {"ticker": ticker,
 				"date": date,
+				"day": dateDatetime.toordinal(),
 				"close": close}
 			if open != "":
 				data["open"] = open
@@ -758,6 +760,7 @@ class NewStockData(QDialog):
 			# Insert or update dividend/split
 			data = {"ticker": ticker,
 				"date": date,
+				"day": dateDatetime.toordinal(),
 				"value": value}
 			if self.data:
 				# Update existing data
@@ -770,10 +773,14 @@ class NewStockData(QDialog):
 					{"ticker": ticker, 
 					"date": self.data["date"].strftime("%Y-%m-%d %H:%M:%S")})
 			else:
+				# Replace any existing dividend/split on the same date
+				on = {"ticker": ticker, "date": date}
 				if type == "Dividend":
-					self.app.stockData.db.insert("stockDividends", data)
+					self.app.stockData.db.insertOrUpdate("stockDividends", data, on)
 				else:
-					self.app.stockData.db.insert("stockSplits", data)
+					self.app.stockData.db.insertOrUpdate("stockSplits", data, on)
+		
+		self.app.stockData.invalidateCache(ticker)
 		
 		#if self.ticker2.GetValue():
 		#	t.setTicker2(self.ticker2.GetValue())
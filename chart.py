@@ -81,11 +81,50 @@ def getChartTypes(portfolio):
 	else:
 		return ["Total Value", "Profit", "Return (Time Weighted)", "Transactions"]
 
+def downsample(xs, ys, buckets):
+	'''Reduce a series to its first and last points and the lowest and highest point of each bucket.
+	Peaks and troughs are kept, unlike skipping points.  A False y is a break in the data and is kept.'''
+	n = len(xs)
+	if buckets < 1 or n <= 2 * buckets + 2:
+		return (xs, ys)
+	
+	outXs = [xs[0]]
+	outYs = [ys[0]]
+	size = (n - 2) / float(buckets)
+	for b in range(buckets):
+		minI = -1
+		maxI = -1
+		breakI = -1
+		for i in xrange(1 + int(b * size), 1 + int((b + 1) * size)):
+			y = ys[i]
+			if y is False:
+				if breakI == -1:
+					breakI = i
+			else:
+				if minI == -1 or y < ys[minI]:
+					minI = i
+				if maxI == -1 or y > ys[maxI]:
+					maxI = i
+		
+		for i in sorted(set([minI, maxI, breakI])):
+			if i != -1:
+				outXs.append(xs[i])
+				outYs.append(ys[i])
+	outXs.append(xs[-1])
+	outYs.append(ys[-1])
+	
+	return (outXs, outYs)
+
 class Chart():
+	# Display parameters that change how a chart is drawn, see getDisplayKey
+	displayFields = ["margin", "titleMargin", "lineWidth", "labelSize", "legendSize", "transactionSize", "title", "titleSize", "pixelsPerTickX", "pixelsPerTickY", "tickSize", "pixelsPerPoint", "legend", "zeroYAxis", "xAxisType", "yAxisType", "doGradient"]
+
 	def __init__(self, parent = None):
+		self.version = 0
 		self.reset()
 	
 	def reset(self):
+		self.version += 1
 		self.xs = []
 		self.ys = []
 		self.buyXs = []
@@ -123,6 +162,10 @@ class Chart():
 		self.xAxisType = "date"
 		self.yAxisType = "dollars"
 		self.doGradient = False
+		
+		# Cached by getBounds and getSampled
+		self.bounds = False
+		self.sampled = False
 
 	def addXY(self, x, y, label = False, color = (0.0, 0.8, 0.0), dashed = False):
 		self.xs.append(x)
@@ -130,30 +173,126 @@ class Chart():
 		self.labels.append(label)
 		self.colors.append(color)
 		self.dashed.append(dashed)
+		self.bounds = False
+		self.sampled = False
+		self.version += 1
+	
+	def getDisplayKey(self):
+		'''Return a key that changes whenever the data or display parameters change'''
+		return (self.version,) + tuple([getattr(self, f) for f in self.displayFields])
+	
+	def getBounds(self):
+		'''Return (minX, maxX, minY, maxY, numXs) of all series and dividends'''
+		if self.bounds:
+			return self.bounds
+		
+		# If no xs or ys then assume we have dividends
+		if len(self.xs) and len(self.xs[0]) > 0:
+			minX = self.xs[0][0]
+			maxX = self.xs[0][0]
+			minY = self.ys[0][0]
+			maxY = self.ys[0][0]
+			numXs = 0
+			for x in self.xs:
+				minX = min(minX, min(x))
+				maxX = max(maxX, max(x))
+				numXs = max(numXs, len(x))
+			for y in self.ys:
+				minY = min(minY, min(y))
+				maxY = max(maxY, max(y))
+		else:
+			minX = self.dividendXs[0]
+			maxX = self.dividendXs[0]
+			minY = self.dividendYs[0]
+			maxY = self.dividendYs[0]
+			numXs = len(self.dividendXs)
+		if self.dividendXs:
+			numXs = max(numXs, len(self.dividendXs))
+			minX = min(minX, min(self.dividendXs))
+			maxX = max(maxX, max(self.dividendXs))
+			minY = min(minY, min(self.dividendYs))
+			maxY = max(maxY, max(self.dividendYs))
+		
+		self.bounds = (minX, maxX, minY, maxY, numXs)
+		return self.bounds
+	
+	def getSampled(self, width):
+		'''Return (xs, ys) downsampled to one bucket per pixelsPerPoint of width.
+		Only computed again when the width or the series change.'''
+		buckets = int(width / self.pixelsPerPoint)
+		if not self.sampled or self.sampled[0] != buckets:
+			xs = []
+			ys = []
+			for i in range(len(self.xs)):
+				(x, y) = downsample(self.xs[i], self.ys[i], buckets)
+				xs.append(x)
+				ys.append(y)
+			self.sampled = (buckets, xs, ys)
+		return self.sampled[1:]
 	
 	def addBuys(self, buyX, buyY):
 		self.buyXs = buyX
 		self.buyYs = buyY
+		self.version += 1
 
 	def addSells(self, sellX, sellY):
 		self.sellXs = sellX
 		self.sellYs = sellY
+		self.version += 1
 
 	def addSplits(self, splitX, splitY):
 		self.splitXs = splitX
 		self.splitYs = splitY
+		self.version += 1
 
 	def addDividends(self, dividendX, dividendY, dividendValues):
 		self.dividendXs = dividendX
 		self.dividendYs = dividendY
 		self.dividendValues = dividendValues
+		self.bounds = False
+		self.version += 1
 
 	def addShorts(self, shortX, shortY):
 		self.shortXs = shortX
 		self.shortYs = shortY
+		self.version += 1
 
 	def addCovers(self, coverX, coverY):
 		self.coverXs = coverX
 		self.coverYs = coverY
+		self.version += 1
+
 
 
+if __name__ == "__main__":
+	print "test 1 - short series are unchanged"
+	xs = range(10)
+	ys = [float(x) for x in xs]
+	assert(downsample(xs, ys, 4) == (xs, ys))
+	assert(downsample(xs, ys, 5) == (xs, ys))
+	assert(downsample(xs, ys, 0) == (xs, ys))
+	assert(downsample([], [], 3) == ([], []))
+	
+	print "test 2 - first, last, lowest and highest points are kept"
+	(outXs, outYs) = downsample(xs, ys, 3)
+	assert(outXs == [0, 1, 2, 3, 5, 6, 8, 9])
+	assert(outYs == [float(x) for x in outXs])
+	xs = range(1000)
+	ys = [math.sin(x / 10.0) * x for x in xs]
+	(outXs, outYs) = downsample(xs, ys, 50)
+	assert(len(outXs) <= 2 * 50 + 2)
+	assert(outXs == sorted(outXs))
+	assert(outXs[0] == 0 and outXs[-1] == 999)
+	assert(min(outYs) == min(ys) and max(outYs) == max(ys))
+	assert(outYs == [ys[x] for x in outXs])
+	
+	print "test 3 - breaks are kept"
+	ys[500] = False
+	ys[501] = False
+	(outXs, outYs) = downsample(xs, ys, 50)
+	assert(len([y for y in outYs if y is False]) == 1)
+	assert(500 in outXs)
+	assert(len(outXs) <= 3 * 50 + 2)
+	(outXs, outYs) = downsample(range(7), [1, 5, False, 2, 9, 0, 3], 2)
+	assert(outXs == [0, 1, 2, 4, 5, 6])
+	assert(outYs == [1, 5, False, 9, 0, 3])
@@ -32,11 +32,19 @@ from PyQt4.QtGui import *
 import appGlobal
 import chart
 
+# Fonts and string widths shared by all charts, key is (size, bold) and (string, size)
+fonts = {}
+stringWidths = {}
+
 class ChartWidget(QWidget, chart.Chart):
 	def __init__(self, parent = None):
 		QWidget.__init__(self, parent)
 		chart.Chart.__init__(self)
 		self.setMinimumSize(300, 200)
+		
+		# Rendered chart, drawn again when pixmapKey changes
+		self.pixmap = False
+		self.pixmapKey = False
 	
 	@staticmethod
 	def totalSeconds(td):
@@ -66,22 +74,40 @@ class ChartWidget(QWidget, chart.Chart):
 			else:
 				return d.strftime("%b")
 
-	def stringWidth(self, string, size):
+	def getFont(self, size, bold = False):
+		key = (size, bold)
+		if key in fonts:
+			return fonts[key]
+		
 		if size >= 18:
 			font = "times new roman"
 		else:
 			font = "helvetica"
 
-		app = appGlobal.getApp()
-		if app.isOSX:
+		if appGlobal.getApp().isOSX:
 			newFont = QFont(font, size * 1.4)
 		else:
 			newFont = QFont(font, size)
 			if size >= 18:
 				newFont.setBold(True)
+		if bold:
+			newFont.setBold(True)
+		
+		fonts[key] = newFont
+		return newFont
 
-		metrics = QFontMetrics(newFont)
-		return metrics.width(string)
+	def stringWidth(self, string, size):
+		key = (string, size)
+		if key in stringWidths:
+			return stringWidths[key]
+		
+		# Y labels are formatted values, do not let the cache grow forever
+		if len(stringWidths) > 10000:
+			stringWidths.clear()
+		
+		width = QFontMetrics(self.getFont(size)).width(string)
+		stringWidths[key] = width
+		return width
 
 	def maxStringWidth(self, strings, size):
 		m = 0
@@ -92,11 +118,6 @@ class ChartWidget(QWidget, chart.Chart):
 		return m
 
 	def drawString(self, string, x, y, size, align = "left", width = False, bold = False, outline = False):
-		if size >= 18:
-			font = "times new roman"
-		else:
-			font = "helvetica"
-		
 		# Increase size by 20% to account for underhangs
 		if align.find("center") > -1:
 			x -= self.stringWidth(string, size) / 2
@@ -108,15 +129,7 @@ class ChartWidget(QWidget, chart.Chart):
 		elif align.find("top") > -1:
 			y += size
 
-		# Build font
-		if appGlobal.getApp().isOSX:
-			newFont = QFont(font, size * 1.4)
-		else:
-			newFont = QFont(font, size)
-			if size >= 18:
-				newFont.setBold(True)
-		if bold:
-			newFont.setBold(True)
+		newFont = self.getFont(size, bold)
 		self.painter.setFont(newFont)
 
 		if outline:
@@ -132,39 +145,28 @@ class ChartWidget(QWidget, chart.Chart):
 		if (len(self.xs) == 0 or len(self.xs[0]) == 0) and len(self.dividendXs) == 0:
 			return
 		
+		# Only draw the chart again if its data, display parameters or size changed
+		key = (self.w, self.h, self.getDisplayKey())
+		if key != self.pixmapKey:
+			self.pixmap = QPixmap(self.size())
+			self.pixmap.fill(Qt.transparent)
+			painter = QPainter(self.pixmap)
+			self.paintChart(painter)
+			painter.end()
+			self.pixmapKey = key
+		
 		painter = QPainter(self)
+		painter.drawPixmap(0, 0, self.pixmap)
+		painter.end()
+	
+	def paintChart(self, painter):
 		self.painter = painter
 
 		self.lastYear = -1
 		xyArray = []
 		
 		# Get min/max x, y
-		# If no xs or ys then assume we have dividends
-		if len(self.xs) and len(self.xs[0]) > 0:
-			minX = self.xs[0][0]
-			maxX = self.xs[0][0]
-			minY = self.ys[0][0]
-			maxY = self.ys[0][0]
-			numXs = 0
-			for x in self.xs:
-				minX = min(minX, min(x))
-				maxX = max(maxX, max(x))
-				numXs = max(numXs, len(x))
-			for y in self.ys:
-				minY = min(minY, min(y))
-				maxY = max(maxY, max(y))
-		else:
-			minX = self.dividendXs[0]
-			maxX = self.dividendXs[0]
-			minY = self.dividendYs[0]
-			maxY = self.dividendYs[0]
-			numXs = len(self.dividendXs)
-		if self.dividendXs:
-			numXs = max(numXs, len(self.dividendXs))
-			minX = min(minX, min(self.dividendXs))
-			maxX = max(maxX, max(self.dividendXs))
-			minY = min(minY, min(self.dividendYs))
-			maxY = max(maxY, max(self.dividendYs))
+		(minX, maxX, minY, maxY, numXs) = self.getBounds()
 		
 		if self.zeroYAxis and minY > 0:
 			minY = 0
@@ -194,47 +196,8 @@ class ChartWidget(QWidget, chart.Chart):
 		spanX = maxX - minX
 		spanY = maxY - minY
 
-		# Trim prices
-		interval = self.pixelsPerPoint * numXs / float(self.chartSpanX)
-		if interval < 1.0:
-				interval = 1.0
-
-		prices = {}
-		xs = []
-		ys = []
-		
-		# Trim data, averaging buckets
-		if interval > 1:
-			for i in range(len(self.xs)):
-				nextX = 0
-				nextXFloat = 0.0
-				xs.append([])
-				ys.append([])
-				bucket = []
-				for j in range(len(self.xs[i])):
-					# If break in data, reset bucket
-					if self.ys[i][j] is False:
-						bucket = []
-					else:
-						bucket.append(self.ys[i][j])
-
-					if j == nextX:
-						xs[i].append(self.xs[i][j])
-						if bucket:
-							ys[i].append(sum(bucket) / len(bucket))
-							bucket = []
-						else:
-							# Break in data
-							ys[i].append(False)
-						nextXFloat += interval
-						nextX = int(nextXFloat)
-				
-				# Add in last point
-				xs[i].append(self.xs[i][-1])
-				ys[i].append(self.ys[i][-1])
-		else:
-			xs = self.xs
-			ys = self.ys
+		# Downsample to the width of the chart
+		(xs, ys) = self.getSampled(self.chartSpanX)
 
 		axesX = self.chartMinX
 		chartWidth = self.chartSpanX
@@ -613,9 +576,6 @@ class ChartWidget(QWidget, chart.Chart):
 				painter.drawConvexPolygon(QPolygonF([QPointF(x, y), QPointF(x + self.transactionSize * 2/3, y + self.transactionSize), QPointF(x - self.transactionSize * 2/3, y + self.transactionSize)]))
 				painter.setPen(QPen(Qt.white))
 				self.drawString("c", x, y + self.transactionSize * 2 / 3, 9, "center middle")
-
-		painter.end()
-		return
 	
 	def resizeEvent(self, event):
 		w = self.size().width()
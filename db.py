@@ -33,6 +33,7 @@ except:
 import sys
 import os, os.path
 import threading
+import time
 import appGlobal
 try:
 	# Server
@@ -40,20 +41,123 @@ try:
 except:
 	import sqlite3 as sqlite
 
+class WriterLock:
+	'''Lets one thread at a time write to a database file.
+	Other writers wait here instead of in the sqlite busy handler.  A lock held by a thread that exited is free.'''
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.owner = False
+	
+	def acquire(self, timeout):
+		'''Return True if the lock was acquired before timeout seconds.
+		The lock is not reentrant, a thread writing with two Db objects for the same file would wait for itself.'''
+		end = time.time() + timeout
+		self.condition.acquire()
+		try:
+			if self.owner == threading.currentThread():
+				raise sqlite.OperationalError("this thread is already writing to the database")
+			while self.owner and self.owner.isAlive():
+				remaining = end - time.time()
+				if remaining <= 0:
+					return False
+				self.condition.wait(remaining)
+			self.owner = threading.currentThread()
+			return True
+		finally:
+			self.condition.release()
+	
+	def release(self):
+		self.condition.acquire()
+		if self.owner == threading.currentThread():
+			self.owner = False
+			self.condition.notify()
+		self.condition.release()
+
+# Writer lock for every database file, key is the absolute path
+writerLocks = {}
+writerLocksMutex = threading.Lock()
+
+def getWriterLock(name):
+	writerLocksMutex.acquire()
+	try:
+		path = os.path.abspath(name)
+		if not path in writerLocks:
+			writerLocks[path] = WriterLock()
+		return writerLocks[path]
+	finally:
+		writerLocksMutex.release()
+
+# Number of writes to every database file by this process, key is the absolute path
+# Readers keep the count they read at and read again when it changes
+changeCounts = {}
+changeCountsMutex = threading.Lock()
+
+def getLogFiles(name):
+	'''Return the write ahead log files of database name that exist'''
+	return [name + suffix for suffix in ["-wal", "-shm"] if os.path.exists(name + suffix)]
+
 class Db:
+	# Seconds to wait for another writer
+	timeout = 30
+	
+	# Open connections, a thread waits for another thread to exit when all are in use
+	maxConns = 8
+	
+	# Connections of exited threads kept for new threads
+	maxIdleConns = 4
+	
+	# Day ordinal (as in datetime.toordinal) of a "YYYY-MM-DD HH:MM:SS" date column
+	daySql = "cast(julianday(substr(date, 1, 10)) - 1721424.5 as integer)"
+	
 	def __init__(self, name, host = "", user = "", password = ""):
 		self.name = name
+		self.path = os.path.abspath(name)
 		self.host = host
 		self.user = user
 		self.password = password
 		
+		# Connections, transaction depth and if the writer lock is held are per thread, key is thread name
 		self.conns = {}
 		self.connParams = {}
-		self.transactionDepth = 0
+		self.transactionDepths = {}
+		self.writing = {}
+		self.changesAtBegin = {}
+		self.idleConns = []
+		self.connsMutex = threading.Lock()
+		self.writerLock = getWriterLock(name)
 		self.lastQuery = False
+		
+		# Generated sql for select, insert, update and delete
+		# Key is the table, columns and shape of the where clause
+		self.sqlCache = {}
 
 	def close(self):
-		self.getConn().close()
+		'''Close the connection of this thread and idle connections, a new one is opened if the database is used again.
+		Connections other threads are using stay open.'''
+		id = threading.currentThread().getName()
+		self.connsMutex.acquire()
+		try:
+			self.releaseExitedConns()
+			conns = self.idleConns
+			self.idleConns = []
+			if id in self.conns:
+				conns.append(self.conns.pop(id))
+				if self.transactionDepths.pop(id, 0) > 0:
+					conns[-1].execute("rollback transaction")
+					self.releaseWriter()
+				self.changesAtBegin.pop(id, False)
+			
+			# Write the log into the database so the file can be moved or deleted
+			for conn in conns:
+				try:
+					conn.execute("pragma wal_checkpoint(truncate)")
+				except Exception:
+					pass
+				break
+			for conn in conns:
+				conn.close()
+		finally:
+			self.connsMutex.release()
 
 	def getConnParam(self):
 		id = threading.currentThread().getName()
@@ -64,10 +168,7 @@ class Db:
 		
 	def getConn(self):
 		def dict_factory(cursor, row):
-			d = {}
-			for idx, col in enumerate(cursor.description):
-				d[col[0]] = row[idx]
-			return d
+			return dict(zip([col[0] for col in cursor.description], row))
 
 		def boolAdapter(b):
 			if b:
@@ -77,14 +178,62 @@ class Db:
 
 		# Return connection for current thread
 		id = threading.currentThread().getName()
-		if not id in self.conns:
-			sqlite.register_adapter(bool, boolAdapter)
-			
-			conn = sqlite.connect(self.name, timeout=30, isolation_level = None)
-			conn.row_factory = dict_factory
+		conn = self.conns.get(id)
+		if conn:
+			return conn
+		
+		# Threads keep their connection until they exit, wait for one to exit if all are in use
+		end = time.time() + self.timeout
+		self.connsMutex.acquire()
+		try:
+			self.releaseExitedConns()
+			while not self.idleConns and len(self.conns) >= self.maxConns:
+				if time.time() > end:
+					raise sqlite.OperationalError("all %d connections to %s are in use" % (self.maxConns, self.name))
+				self.connsMutex.release()
+				try:
+					time.sleep(0.05)
+				finally:
+					self.connsMutex.acquire()
+				self.releaseExitedConns()
+			if self.idleConns:
+				conn = self.idleConns.pop()
+			else:
+				sqlite.register_adapter(bool, boolAdapter)
+				
+				# Connections are handed to new threads when their thread exits
+				conn = sqlite.connect(self.name, timeout = self.timeout, isolation_level = None, check_same_thread = False)
+				conn.row_factory = dict_factory
+				
+				# Readers do not block the writer and the writer does not block readers
+				conn.execute("pragma journal_mode = wal")
+				conn.execute("pragma synchronous = normal")
+				conn.execute("pragma cache_size = -8192")
+				conn.execute("pragma mmap_size = 67108864")
 			self.connParams[id] = "?"
 			self.conns[id] = conn
-		return self.conns[id]
+		finally:
+			self.connsMutex.release()
+		return conn
+	
+	def releaseExitedConns(self):
+		'''Move connections of threads that exited to idleConns, closing the ones that do not fit'''
+		alive = {}
+		for thread in threading.enumerate():
+			alive[thread.getName()] = True
+		for id in self.conns.keys():
+			if id in alive:
+				continue
+			conn = self.conns.pop(id)
+			if self.transactionDepths.pop(id, 0) > 0:
+				conn.execute("rollback transaction")
+			# The writer lock of an exited thread is already free
+			self.writing.pop(id, False)
+			self.changesAtBegin.pop(id, False)
+			if len(self.idleConns) < self.maxIdleConns:
+				self.idleConns.append(conn)
+			else:
+				conn.close()
 	
 	def getMysqlConn(self):
 		# Return connection for current thread
@@ -172,6 +321,43 @@ class Db:
 		if appGlobal.getApp():
 			appGlobal.getApp().checkTableMutex.release()
 		
+	def getSchemaVersion(self):
+		return self.getConn().execute("pragma user_version").fetchone()["user_version"]
+	
+	def setSchemaVersion(self, version):
+		self.getConn().execute("pragma user_version = %d" % version)
+	
+	def migrate(self, migrations):
+		'''Run the migrations the database has not seen yet, the schema version is the number applied.
+		Migrations are run in order and must only ever be appended to.'''
+		if self.getSchemaVersion() >= len(migrations):
+			return
+		
+		self.beginTransaction()
+		try:
+			# Another thread or process may have migrated while we waited for the writer lock
+			version = self.getSchemaVersion()
+			for migration in migrations[version:]:
+				migration()
+			if version < len(migrations):
+				self.setSchemaVersion(len(migrations))
+		except:
+			self.rollbackTransaction()
+			raise
+		self.commitTransaction()
+	
+	def hasColumn(self, table, column):
+		'''Return True if table exists and has column'''
+		try:
+			meta = self.getConn().execute("select * from " + table + " limit 0").description
+		except Exception:
+			return False
+		return column in [m[0] for m in meta]
+	
+	def fillDays(self, table):
+		'''Set the integer day column of table to the day ordinal of its date column'''
+		self.query("update " + table + " set day = " + Db.daySql + " where day is null")
+	
 	def query(self, queryStr, tuple = False, reRaiseException = False):
 		reRaiseException = True
 		try:
@@ -192,115 +378,176 @@ class Db:
 			# Return empty string
 			return self.getConn().execute("select 0 where 1 = 0")
 	
-	def delete(self, table, where = False):
-		deleteStr = "delete from " + table
-		deleteTuple = []
-		if where:
-			deleteStr += " where "
-			first = True
-			for key in where:
-				if first:
-					first = False
-				else:
-					deleteStr += " and "
-				
-				deleteStr += key + "=" + self.getConnParam()
-				deleteTuple.append(where[key])
-		
-		self.query(deleteStr, deleteTuple)
-		
-	def select(self, table, orderBy = False, where = False, limit = False, what = False):
-		selectStr = "select "
-		if what:
-			selectStr += what
+	def queryTuples(self, queryStr, tuple = False):
+		'''Same as query but rows are tuples instead of dictionaries.
+		Faster for reading many rows, column names are in cursor.description.'''
+		cursor = self.getConn().cursor()
+		cursor.row_factory = None
+		if tuple:
+			self.lastQuery = "%s %s" % (queryStr, tuple)
+			cursor.execute(queryStr, tuple)
 		else:
-			selectStr += "*"
-		selectStr += " from " + table;
-		selectTuple = []
-
-		# TODO: make sure key is not bad
+			self.lastQuery = queryStr
+			cursor.execute(queryStr)
+		return cursor
+	
+	def executeMany(self, queryStr, tuples):
+		'''Execute queryStr once for every tuple'''
+		self.lastQuery = queryStr
+		cursor = self.getConn().executemany(queryStr, tuples)
+		self.wrote()
+		return cursor
+	
+	def getChanges(self):
+		'''Return the number of writes to this database file by this process'''
+		return changeCounts.get(self.path, 0)
+	
+	def wrote(self):
+		'''Count a write.  Writes in a transaction are counted when it ends.'''
+		if not self.inTransaction():
+			self.countChange()
+	
+	def countChange(self):
+		changeCountsMutex.acquire()
+		changeCounts[self.path] = changeCounts.get(self.path, 0) + 1
+		changeCountsMutex.release()
+	
+	def endedTransaction(self):
+		'''Count a change if the transaction that ended modified any rows'''
+		changes = self.changesAtBegin.pop(threading.currentThread().getName(), None)
+		if self.getConn().total_changes != changes:
+			self.countChange()
+	
+	def whereShape(self, where):
+		'''Return (shape, values) for a where dictionary.  shape is used to build and cache sql.'''
+		shape = []
+		values = []
 		if where:
-			selectStr += " where ";
-			first = True
 			for key in where.keys():
-				if first:
-					first = False
-				else:
-					selectStr += " and "
 				if where[key] == "is null" or where[key] == "is not null":
-					selectStr += key + " " + where[key]
+					shape.append((key, where[key]))
 				else:
-					selectStr += key
-					if key.find("=") == -1 and key.find(">") == -1 and key.find("<") == -1:
-						selectStr += "=" + self.getConnParam()
-					else:
-						selectStr += "" + self.getConnParam()
-					selectTuple.append(where[key])
-		
-		if orderBy:
-			selectStr += " order by " + orderBy
-		
-		if limit:
-			selectStr += " limit " + str(limit)
-
-		return self.query(selectStr, selectTuple)
+					shape.append((key, False))
+					values.append(where[key])
+		return (tuple(shape), values)
 	
-	def insert(self, table, data):
-		insertStr = "insert into " + table + " ("
-		insertTuple = []
-
+	def whereSql(self, shape, param):
+		sql = ""
 		first = True
-		for key in data.keys():
+		for (key, isNull) in shape:
 			if first:
 				first = False
 			else:
-				insertStr += ", "
-			insertStr += key
-
-		insertStr += ") values ("
-
-		first = True
-		for i in data.keys():
-			if first:
-				first = False
-				insertStr += self.getConnParam()
+				sql += " and "
+			if isNull:
+				sql += key + " " + isNull
+			elif key.find("=") == -1 and key.find(">") == -1 and key.find("<") == -1:
+				sql += key + "=" + param
 			else:
-				insertStr += ", " + self.getConnParam()
-			insertTuple.append(data[i]);
-
-		insertStr += ")"
+				sql += key + param
+		return sql
+	
+	def delete(self, table, where = False):
+		(shape, deleteTuple) = self.whereShape(where)
+		param = self.getConnParam()
+		cacheKey = ("delete", table, shape, param)
+		deleteStr = self.sqlCache.get(cacheKey)
+		if not deleteStr:
+			deleteStr = "delete from " + table
+			if shape:
+				deleteStr += " where " + self.whereSql(shape, param)
+			self.sqlCache[cacheKey] = deleteStr
+		
+		self.query(deleteStr, deleteTuple)
+		self.wrote()
+	
+	def buildSelect(self, table, orderBy = False, where = False, limit = False, what = False):
+		'''Return (sql, tuple) for select'''
+		(shape, selectTuple) = self.whereShape(where)
+		param = self.getConnParam()
+		cacheKey = ("select", table, orderBy, limit, what, shape, param)
+		selectStr = self.sqlCache.get(cacheKey)
+		if not selectStr:
+			selectStr = "select "
+			if what:
+				selectStr += what
+			else:
+				selectStr += "*"
+			selectStr += " from " + table
+	
+			# TODO: make sure key is not bad
+			if shape:
+				selectStr += " where " + self.whereSql(shape, param)
+			
+			if orderBy:
+				selectStr += " order by " + orderBy
+			
+			if limit:
+				selectStr += " limit " + str(limit)
+			self.sqlCache[cacheKey] = selectStr
+		
+		return (selectStr, selectTuple)
+		
+	def select(self, table, orderBy = False, where = False, limit = False, what = False):
+		(selectStr, selectTuple) = self.buildSelect(table, orderBy, where, limit, what)
+		return self.query(selectStr, selectTuple)
+	
+	def selectTuples(self, table, orderBy = False, where = False, limit = False, what = False):
+		'''Same as select but rows are tuples, see queryTuples'''
+		(selectStr, selectTuple) = self.buildSelect(table, orderBy, where, limit, what)
+		return self.queryTuples(selectStr, selectTuple)
+	
+	def insert(self, table, data):
+		keys = data.keys()
+		param = self.getConnParam()
+		cacheKey = ("insert", table, tuple(keys), param)
+		insertStr = self.sqlCache.get(cacheKey)
+		if not insertStr:
+			insertStr = "insert into " + table + " (" + ", ".join(keys) + ") values ("
+			insertStr += ", ".join([param] * len(keys)) + ")"
+			self.sqlCache[cacheKey] = insertStr
 
-		return self.query(insertStr, insertTuple)
+		cursor = self.query(insertStr, [data[key] for key in keys])
+		self.wrote()
+		return cursor
 	
 	def update(self, table, data, where):
-		updateStr = "update " + table + " set "
-		updateTuple = []
-
-		# TODO: make sure key is not bad
-		first = True
-		for key in data.keys():
-			if first:
-				first = False
-			else:
-				updateStr += ", "
-			updateStr += key + "=" + self.getConnParam()
-			updateTuple.append(data[key])
+		keys = data.keys()
+		(shape, whereTuple) = self.whereShape(where)
+		param = self.getConnParam()
+		cacheKey = ("update", table, tuple(keys), shape, param)
+		updateStr = self.sqlCache.get(cacheKey)
+		if not updateStr:
+			# TODO: make sure key is not bad
+			updateStr = "update " + table + " set "
+			updateStr += ", ".join([key + "=" + param for key in keys])
+			updateStr += " where " + self.whereSql(shape, param)
+			self.sqlCache[cacheKey] = updateStr
 
-		updateStr += " where "
+		cursor = self.query(updateStr, [data[key] for key in keys] + whereTuple)
+		self.wrote()
+		return cursor
 
-		first = True
-		for key in where.keys():
-			if first:
-				first = False
-			else:
-				updateStr += " and "
-			if where[key] == "is null" or where[key] == "is not null":
-				updateStr += key + " " + where[key]
+	def insertMany(self, table, cols, rows, replace = False):
+		'''Insert a list of row tuples with one statement.  Return the number of rows written.
+		If replace is True rows that violate a unique index replace the existing row.'''
+		if not rows:
+			return 0
+		
+		param = self.getConnParam()
+		cacheKey = ("insertMany", table, tuple(cols), replace, param)
+		insertStr = self.sqlCache.get(cacheKey)
+		if not insertStr:
+			if replace:
+				insertStr = "insert or replace into "
 			else:
-				updateStr += key + "=" + self.getConnParam()
-				updateTuple.append(where[key])
-
-		return self.query(updateStr, updateTuple)
+				insertStr = "insert into "
+			insertStr += table + " (" + ", ".join(cols) + ") values ("
+			insertStr += ", ".join([param] * len(cols)) + ")"
+			self.sqlCache[cacheKey] = insertStr
+		
+		self.executeMany(insertStr, rows)
+		return len(rows)
 
 	# Return true on insert, false on update
 	def insertOrUpdate(self, table, data, on = {}):
@@ -323,29 +570,115 @@ class Db:
 				self.update(table, data, on)
 		return False
 	
+	def getTransactionDepth(self):
+		return self.transactionDepths.get(threading.currentThread().getName(), 0)
+	
 	def inTransaction(self):
-		return self.transactionDepth > 0
+		return self.getTransactionDepth() > 0
 
 	def beginTransaction(self):
-		self.transactionDepth += 1
-		if self.transactionDepth == 1:
-			self.getConn().execute("begin immediate transaction")
-		#if self.transactionDepth == 1:
+		id = threading.currentThread().getName()
+		depth = self.transactionDepths.get(id, 0) + 1
+		if depth == 1:
+			# Roll back transactions left open by threads that exited
+			self.connsMutex.acquire()
+			try:
+				self.releaseExitedConns()
+			finally:
+				self.connsMutex.release()
+			
+			# One writer at a time.  If the lock times out sqlite's busy handler decides.
+			self.writing[id] = self.writerLock.acquire(self.timeout)
+			try:
+				self.getConn().execute("begin immediate transaction")
+			except:
+				self.releaseWriter()
+				raise
+			self.changesAtBegin[id] = self.getConn().total_changes
+		self.transactionDepths[id] = depth
+		#if depth == 1:
 		#	print "DB begin transaction"
 	
+	def releaseWriter(self):
+		if self.writing.pop(threading.currentThread().getName(), False):
+			self.writerLock.release()
+	
 	def rollbackTransaction(self):
-		self.transactionDepth = 0
-		self.getConn().execute("rollback transaction")
+		self.transactionDepths[threading.currentThread().getName()] = 0
+		try:
+			self.getConn().execute("rollback transaction")
+		finally:
+			self.releaseWriter()
+		# Readers may have cached rows that were rolled back
+		self.endedTransaction()
 		#print "DB rollback transaction"
 
 	def commitTransaction(self):
-		if self.transactionDepth == 1:
-			self.transactionDepth = 0
-			self.getConn().execute("commit transaction")
-		if self.transactionDepth >= 1:
-			self.transactionDepth -= 1
-			#if self.transactionDepth == 0:
-			#	print "DB committed transaction"
-			#else:
-			#	print "DB reduce transaction depth"
+		id = threading.currentThread().getName()
+		depth = self.transactionDepths.get(id, 0)
+		if depth >= 1:
+			self.transactionDepths[id] = depth - 1
+		if depth == 1:
+			try:
+				self.getConn().execute("commit transaction")
+			finally:
+				self.releaseWriter()
+			self.endedTransaction()
+			#print "DB committed transaction"
+
 
+if __name__ == "__main__":
+	import tempfile
+	import shutil
+	
+	path = tempfile.mkdtemp()
+	try:
+		db = Db(os.path.join(path, "test.db"))
+		db.checkTable("prices", [
+			{"name": "ticker", "type": "text"},
+			{"name": "date", "type": "datetime"},
+			{"name": "close", "type": "float"}])
+		db.insertMany("prices", ["ticker", "date", "close"], [("A", "2010-01-04 00:00:00", 1.0), ("A", "2010-01-05 00:00:00", 2.0), ("B", "2010-01-04 00:00:00", 3.0), (None, "2010-01-04 00:00:00", 4.0)])
+		
+		print "test 1 - generated sql is cached by shape"
+		assert([r["close"] for r in db.select("prices", where = {"ticker": "A"}, orderBy = "date").fetchall()] == [1.0, 2.0])
+		size = len(db.sqlCache)
+		assert(db.buildSelect("prices", where = {"ticker": "B"}, orderBy = "date") == ("select * from prices where ticker=? order by date", ["B"]))
+		assert([r["close"] for r in db.select("prices", where = {"ticker": "B"}, orderBy = "date").fetchall()] == [3.0])
+		assert(len(db.sqlCache) == size)
+		assert([r["close"] for r in db.select("prices", where = {"ticker": "is null"}).fetchall()] == [4.0])
+		assert([r["close"] for r in db.select("prices", where = {"ticker": "A", "date >": "2010-01-04 00:00:00"}).fetchall()] == [2.0])
+		db.update("prices", {"close": 5.0}, {"ticker": "A", "date": "2010-01-04 00:00:00"})
+		db.update("prices", {"close": 6.0}, {"ticker": "B", "date": "2010-01-04 00:00:00"})
+		assert([r["close"] for r in db.select("prices", orderBy = "ticker, date", where = {"ticker": "is not null"}).fetchall()] == [5.0, 2.0, 6.0])
+		db.delete("prices", {"ticker": "B"})
+		db.delete("prices", {"ticker": "is null"})
+		assert(db.select("prices", what = "count(*) as count").fetchone()["count"] == 2)
+		
+		print "test 2 - tuple reads"
+		rows = db.selectTuples("prices", what = "date, close", where = {"ticker": "A"}, orderBy = "date").fetchall()
+		assert(rows == [("2010-01-04 00:00:00", 5.0), ("2010-01-05 00:00:00", 2.0)])
+		cursor = db.queryTuples("select ticker, close from prices where close > ?", (3.0,))
+		assert([d[0] for d in cursor.description] == ["ticker", "close"])
+		assert(cursor.fetchall() == [("A", 5.0)])
+		# Other queries still return dictionaries
+		assert(db.select("prices", where = {"ticker": "A"}, orderBy = "date", limit = 1).fetchone()["close"] == 5.0)
+		
+		print "test 3 - day ordinals of dates"
+		import datetime
+		dates = [datetime.datetime(1900, 1, 1), datetime.datetime(1969, 12, 31, 23, 59, 59), datetime.datetime(2000, 2, 29, 12), datetime.datetime(2038, 1, 19, 3, 14, 8), datetime.datetime(2100, 12, 31)]
+		db.insertMany("prices", ["ticker", "date"], [("C", d.strftime("%Y-%m-%d %H:%M:%S")) for d in dates])
+		db.checkTable("prices", [
+			{"name": "ticker", "type": "text"},
+			{"name": "date", "type": "datetime"},
+			{"name": "close", "type": "float"},
+			{"name": "day", "type": "integer"}])
+		db.update("prices", {"day": 7}, {"ticker": "A"})
+		db.fillDays("prices")
+		rows = db.selectTuples("prices", what = "day", where = {"ticker": "C"}, orderBy = "date").fetchall()
+		assert(rows == [(d.toordinal(),) for d in dates])
+		# Days that are already set are kept
+		assert(db.selectTuples("prices", what = "day", where = {"ticker": "A"}).fetchall() == [(7,), (7,)])
+		db.close()
+	finally:
+		shutil.rmtree(path)
@@ -25,7 +25,6 @@
 
 import math
 import re
-import sgmlop
 
 from transaction import *
 from userprice import *
@@ -42,10 +41,7 @@ class FileFormat:
 	
 	def StartParse(self, text, portfolio, status):
 		# Count lines
-		self.lines = 0
-		for i, l in enumerate(text):
-			pass
-		self.lines = i + 1
+		self.lines = text.count("\n") + 1
 		
 		self.Parse(text, portfolio, status)
 		
@@ -75,56 +71,41 @@ class FileFormat:
 		numOld = 0
 		newTickers = []
 		
-		# Count of number of matching transactions with same id
-		# Key is transaction, value is count
-		noIdCount = {}
+		# Earliest date of a new transaction
+		self.firstNewDate = False
 		
 		portfolio.db.beginTransaction()
-	
+		
+		existing = ExistingTransactions(portfolio.db)
+		newRows = []
 		for transaction in self.transactions:
 			# Check if transaction exists
 			if transaction.uniqueId:
 				# Check by uniqueId
-				res = portfolio.db.select("transactions", where = {"uniqueId": transaction.uniqueId})
-				row = res.fetchone()
-				notFound = not row
+				notFound = not existing.hasId(transaction.uniqueId)
 			else:
 				# This transaction does not have a unique id
 				# Check by duplicate transactions
 				# If identical transactions are not found do not save
 				# Otherwise assign a unique id
-				
-				# Build noIdCount for this transaction only once
-				if not transaction in noIdCount:
-					# Count how many transactions there are that are equal to this not counting uniqueId
-					where = transaction.getSaveData()
-					del where["uniqueId"]
-					del where["edited"]
-					del where["deleted"]
-					res = portfolio.db.select("transactions", where = where)
-					if res.fetchone():
-						# Count how many matching transactions
-						noIdCount[transaction] = 1
-						while res.fetchone():
-							noIdCount[transaction] += 1
-					else:
-						# No matching transactions
-						noIdCount[transaction] = 0
-				
-				if noIdCount[transaction] == 0:
+				if existing.takeHash(transaction.getHash()):
+					notFound = False
+				else:
 					# New data, assign unique id
 					notFound = True
 					transaction.uniqueId = "__" + portfolio.portPrefs.getTransactionId() + "__"
-				else:
-					notFound = False
-					noIdCount[transaction] -= 1
 	
 			if notFound:
-				transaction.save(portfolio.db)
+				existing.addId(transaction.uniqueId)
+				data = transaction.getSaveData()
+				newRows.append([data[c] for c in Transaction.saveColumns] + [transaction.getHash()])
 				numNew += 1
+				if not self.firstNewDate or transaction.date < self.firstNewDate:
+					self.firstNewDate = transaction.date
 			else:
 				numOld += 1
 		
+		portfolio.db.insertMany("transactions", Transaction.saveColumns + ["hash"], newRows)
 		portfolio.db.commitTransaction()
 
 		return (numNew, numOld, newTickers)
@@ -165,6 +146,159 @@ ofxTransactions = {
 	"transfer": 1
 }
 
+# Best attempt repairs of malformed OFX tags, applied to one tag and the data following it
+# Search for ! inside an unclosed tag
+# Only for non-letters
+# Ex: <sh!ares1<price> becomes <shares>1<price>
+ofxExclaimInTagRe = re.compile(r"(<[a-zA-z]+)!([a-zA-Z]+)([-_0-9:\[\]\.]+<)")
+# Search for ! that should be a closed >
+# Ex: <units!6<unitprice>... becomes <units>6<unitprice>...
+ofxExclaimCloseRe = re.compile(r"(<[a-zA-z]+)!([-_0-9a-zA-Z:\[\]\.]*<)")
+# Search for ! plus any number of whitespace and replace with empty string
+ofxExclaimRe = re.compile(r"!\s*")
+# Replace any space inside tags <xx y> to <xxy>
+ofxTagSpaceRe = re.compile(r"(<[a-zA-z]*)\s+([-_0-9a-zA-Z:\[\]\.]*>)")
+# Best attempt at replacing missing tags
+# Ex: <INVBUY   <INVTRAN><FITID>xxx becomes <INVBUY><INVTRAN><FITID>xxx
+ofxMissingCloseRe = re.compile(r"(<[/a-zA-Z]*)\s*([-_0-9a-zA-Z:\[\]\.]*)\s*<")
+# A well formed tag that needs no repairs
+ofxTagRe = re.compile(r"<[^<>\s]+>")
+
+ofxEntityRe = re.compile(r"&(#?\w+);")
+ofxEntities = {"amp": "&", "apos": "'", "gt": ">", "lt": "<", "quot": '"'}
+
+def ofxChunks(ofx, size = 65536):
+	'''Return an iterator of chunks of an OFX string, file or iterator'''
+	if isinstance(ofx, basestring):
+		return (ofx[i:i + size] for i in xrange(0, len(ofx), size))
+	return ofx
+
+def ofxData(data):
+	'''Split data at entities.  Standard entities are replaced, others are dropped.'''
+	pieces = []
+	last = 0
+	for match in ofxEntityRe.finditer(data):
+		pieces.append(data[last:match.start()])
+		name = match.group(1)
+		if name in ofxEntities:
+			pieces.append(ofxEntities[name])
+		elif name.startswith("#"):
+			try:
+				if name[1:2] in ["x", "X"]:
+					char = int(name[2:], 16)
+				else:
+					char = int(name[1:])
+				if char <= 255:
+					pieces.append(chr(char))
+			except ValueError:
+				pass
+		last = match.end()
+	pieces.append(data[last:])
+	return pieces
+
+def ofxTokens(chunks):
+	'''Tokenize an OFX document read from an iterator of chunks.
+	Yields ("start", tag), ("end", tag) and ("data", data) one tag at a time so the document is never copied as a whole.'''
+	buffer = ""
+	for chunk in chunks:
+		buffer += chunk.replace("\n", "")
+		
+		# Every < starts a tag, tokenize up to the last one which may not be complete
+		begin = 0
+		while True:
+			end = buffer.find("<", begin + 1)
+			if end == -1:
+				break
+			for token in ofxTagTokens(buffer[begin:end], True):
+				yield token
+			begin = end
+		buffer = buffer[begin:]
+	
+	for token in ofxTagTokens(buffer, False):
+		yield token
+
+def ofxTagTokens(text, hasNext):
+	'''Tokenize one tag and the data following it.  hasNext is True if another tag follows.'''
+	if not text:
+		return
+	if text[0] != "<":
+		yield ("data", text)
+		return
+	
+	if "!" in text or not ofxTagRe.match(text):
+		# Repairs look at the start of the next tag
+		if hasNext:
+			text += "<"
+		text = ofxExclaimInTagRe.sub(r"\1\2>\3", text)
+		text = ofxExclaimCloseRe.sub(r"\1>\2", text)
+		text = ofxExclaimRe.sub("", text)
+		count = 1
+		while count > 0:
+			(text, count) = ofxTagSpaceRe.subn(r"\1\2", text)
+		count = 1
+		while count > 0:
+			(text, count) = ofxMissingCloseRe.subn(r"\1>\2<", text)
+		if hasNext:
+			text = text[:-1]
+	
+	close = text.find(">")
+	if close == -1:
+		tag = text[1:]
+		data = ""
+	else:
+		tag = text[1:close]
+		data = text[close + 1:]
+	
+	# Skip processing instructions and comments
+	if tag and tag[0] not in "?-":
+		if tag[0] == "/":
+			yield ("end", tag[1:])
+		elif tag[-1] == "/":
+			tag = tag[:-1].split(" ")[0]
+			yield ("start", tag)
+			yield ("end", tag)
+		else:
+			yield ("start", tag.split(" ")[0])
+	
+	if "&" in data:
+		for piece in ofxData(data):
+			if piece:
+				yield ("data", piece)
+	elif data:
+		yield ("data", data)
+
+class ExistingTransactions:
+	'''uniqueIds and content hashes of the transactions in a portfolio, read once per import.
+	hashCounts maps a hash to the number of transactions with that hash that have not been matched.'''
+	def __init__(self, db):
+		self.ids = {}
+		self.hashCounts = {}
+		
+		# Fill hashes of transactions saved before hashes were stored
+		cursor = db.selectTuples("transactions", what = "rowid, " + ", ".join(Transaction.hashColumns), where = {"hash": "is null"})
+		missing = [(Transaction.hashValues(row[1:]), row[0]) for row in cursor.fetchall()]
+		if missing:
+			param = db.getConnParam()
+			db.executeMany("update transactions set hash = %s where rowid = %s" % (param, param), missing)
+		
+		for (uniqueId, hash) in db.selectTuples("transactions", what = "uniqueId, hash").fetchall():
+			self.ids[uniqueId] = True
+			self.hashCounts[hash] = self.hashCounts.get(hash, 0) + 1
+	
+	def hasId(self, uniqueId):
+		return uniqueId in self.ids
+	
+	def addId(self, uniqueId):
+		self.ids[uniqueId] = True
+	
+	def takeHash(self, hash):
+		'''Return True and use up one transaction if an unmatched transaction has this hash'''
+		count = self.hashCounts.get(hash, 0)
+		if count == 0:
+			return False
+		self.hashCounts[hash] = count - 1
+		return True
+
 def hasKey(t, key):
 	return key in t and len(t[key]) > 0
 
@@ -180,41 +314,7 @@ class Ofx(FileFormat):
 		return False
 	
 	def Parse(self, ofx, portfolio, status):
-		# Check for matching ORG and FID of other brokerages
-		# Choose proper brokerage if one was not specified
-		match = re.search("<ORG>\s*([^<\n]+)", ofx)
-		if match:
-			checkOrg = match.group(1).strip(" ")
-		else:
-			checkOrg = False
-		match = re.search("<FID>\s*([^<\n]+)", ofx)
-		if match:
-			checkFid = match.group(1).strip(" ")
-		else:
-			checkFid = False
-
-		# User chosen brokerage gets a score of 1
 		# Choose a better brokerage if we match org and fid
-		brokerage = getApp().plugins.getBrokerage(portfolio.brokerage)
-		if brokerage:
-			bestBrokerageScore = 1
-		else:
-			bestBrokerageScore = 0
-		
-		for testBrokerage in getApp().plugins.brokerages.values():
-			score = 0
-			if checkOrg and checkOrg == testBrokerage.getOrg():
-				score += 1
-			if checkFid and checkFid == testBrokerage.getFid():
-				score += 1
-			
-			if score > bestBrokerageScore and brokerage.getName() != portfolio.brokerage:
-				brokerage = testBrokerage
-				bestBrokerageScore = score
-				
-				if status:
-					status.addMessage("Using %s brokerage" % brokerage.getName())
-		
 		class ParsedTransaction(dict):
 			def hasKey(self, key):
 				return key in self and len(self[key]) > 0
@@ -282,12 +382,13 @@ class Ofx(FileFormat):
 			
 			endDate = False
 			
+			org = False
+			fid = False
+			
 			tagCount = 0
 	
 			def finish_starttag(self, tag, attrs):
 				self.tagCount += 1
-				if status:
-					status.setStatus(level = 10 + 90 * self.tagCount / self.tags)
 				
 				if self.inTranLevel:
 					self.inTranLevel += 1
@@ -354,6 +455,10 @@ class Ofx(FileFormat):
 					self.currentPosStock[tag] = self.currentData
 				elif self.currentLedgerBal != False and self.currentData != False:
 					self.currentLedgerBal[tag] = self.currentData
+				elif tag == "org" and self.org is False:
+					self.org = self.currentData
+				elif tag == "fid" and self.fid is False:
+					self.fid = self.currentData
 				elif tag == "dtstart":
 					# Ignore dtstart
 					pass
@@ -380,41 +485,59 @@ class Ofx(FileFormat):
 					#print "data =", data
 					self.currentData += data
 
-		parser = sgmlop.XMLParser()
 		target = xmlHandler()
-
-		# Replace any newlines with an empty string
-		ofx = re.sub("\n", "", ofx)
 		
-		# Search for ! inside an unclosed tag
-		# Only for non-letters
-		# Ex: <sh!ares1<price> becomes <shares>1<price>
-		ofx = re.sub(r"(<[a-zA-z]+)!([a-zA-Z]+)([-_0-9:\[\]\.]+<)", r"\1\2>\3", ofx)
-
-		# Search for ! that should be a closed >
-		# Ex: <units!6<unitprice>... becomes <units>6<unitprice>...
-		ofx = re.sub(r"(<[a-zA-z]+)!([-_0-9a-zA-Z:\[\]\.]*<)", r"\1>\2", ofx)
+		# Read in chunks, updating status as each chunk is parsed
+		def readChunks():
+			if isinstance(ofx, basestring):
+				size = len(ofx)
+			else:
+				size = False
+			read = 0
+			lastLevel = False
+			for chunk in ofxChunks(ofx):
+				yield chunk
+				read += len(chunk)
+				if status and size:
+					level = 10 + 90 * read / size
+					if level != lastLevel:
+						status.setStatus(level = level)
+						lastLevel = level
 
-		# Search for ! plus any number of whitespace and replace with empty string
-		ofx = re.sub("!\s*", "", ofx)
-		
-		# Replace any space inside tags <xx y> to <xxy>
-		count = 1
-		while count > 0:
-			(ofx, count) = re.subn(r"(<[a-zA-z]*)\s+([-_0-9a-zA-Z:\[\]\.]*>)", r"\1\2", ofx)
-		
-		# Best attempt at replacing missing tags
-		# Ex: <INVBUY   <INVTRAN><FITID>xxx becomes <INVBUY><INVTRAN><FITID>xxx
-		count = 1
-		while count > 0:
-			(ofx, count) = re.subn(r"(<[/a-zA-Z]*)\s*([-_0-9a-zA-Z:\[\]\.]*)\s*<", r"\1>\2<", ofx)
+		# Parse it
+		for (token, value) in ofxTokens(readChunks()):
+			if token == "data":
+				target.handle_data(value)
+			elif token == "start":
+				target.finish_starttag(value, {})
+			else:
+				target.finish_endtag(value)
 		
-		# Count tags
-		target.tags = ofx.count("<")
+		# Check for matching ORG and FID of other brokerages
+		# Choose proper brokerage if one was not specified
+		checkOrg = target.org
+		checkFid = target.fid
+
+		# User chosen brokerage gets a score of 1
+		brokerage = getApp().plugins.getBrokerage(portfolio.brokerage)
+		if brokerage:
+			bestBrokerageScore = 1
+		else:
+			bestBrokerageScore = 0
 		
-		# Parse it
-		parser.register(target)
-		parser.parse(ofx)
+		for testBrokerage in getApp().plugins.brokerages.values():
+			score = 0
+			if checkOrg and checkOrg == testBrokerage.getOrg():
+				score += 1
+			if checkFid and checkFid == testBrokerage.getFid():
+				score += 1
+			
+			if score > bestBrokerageScore and brokerage.getName() != portfolio.brokerage:
+				brokerage = testBrokerage
+				bestBrokerageScore = score
+				
+				if status:
+					status.addMessage("Using %s brokerage" % brokerage.getName())
 		
 		# Update stockInfo table
 		ids = {}
@@ -1626,3 +1749,35 @@ class Qif(FileFormat):
 def getFileFormats():
 	return [Ofx(), Ofx2(), AmeritradeCsv(), OptionsHouseCsv(), FidelityCsv(), Qif()]
 
+
+if __name__ == "__main__":
+	def tokens(ofx, size):
+		return list(ofxTokens(ofxChunks(ofx, size)))
+	
+	print "test 1 - tags, data and entities"
+	ofx = "OFXHEADER:100\n\n<OFX><FI>\n<ORG>AT&amp;T &#39;s &bad; co</FI><SECID/><?xml x?><UNITS>5</OFX>"
+	expected = [
+		("data", "OFXHEADER:100"),
+		("start", "OFX"), ("start", "FI"), ("start", "ORG"),
+		("data", "AT"), ("data", "&"), ("data", "T "), ("data", "'"), ("data", "s "), ("data", " co"),
+		("end", "FI"), ("start", "SECID"), ("end", "SECID"),
+		("start", "UNITS"), ("data", "5"), ("end", "OFX")]
+	assert(tokens(ofx, 65536) == expected)
+	
+	print "test 2 - repaired tags"
+	assert(tokens("<UN!ITS>5<PRICE>", 65536) == [("start", "UNITS"), ("data", "5"), ("start", "PRICE")])
+	assert(tokens("<UNITS!5<PRICE>", 65536) == [("start", "UNITS"), ("data", "5"), ("start", "PRICE")])
+	assert(tokens("<UNIT PRICE>5<FEE>", 65536) == [("start", "UNITPRICE"), ("data", "5"), ("start", "FEE")])
+	assert(tokens("</SECID   <FEE>", 65536) == [("end", "SECID"), ("start", "FEE")])
+	
+	print "test 3 - chunk sizes"
+	lines = ["OFXHEADER:100", "", "<OFX><INVTRANLIST>"]
+	for i in range(200):
+		lines.append("<BUYSTOCK><INVTRAN><FITID>id%d<MEMO>Smith &amp; Co %d</INVTRAN><UNITS>%d<UNIT PRICE>1.5<COMMISSION!9.99</BUYSTOCK>" % (i, i, i))
+	lines.append("</INVTRANLIST></OFX>")
+	ofx = "\n".join(lines)
+	whole = tokens(ofx, len(ofx))
+	assert(len(whole) > 200 * 10)
+	for size in [7, 100, 65536]:
+		assert(tokens(ofx, size) == whole)
+	assert(list(ofxTokens(iter(lines))) == whole)
@@ -95,6 +95,7 @@ import tutorial
 
 import appGlobal
 import autoUpdater
+import positionReplay
 
 # For dependencies when building standalone apps
 import plugin
@@ -306,6 +307,7 @@ class MainWindow(QMainWindow):
 				task = app.getBigTask()
 			status.setFinished()
 		
+		positionReplay.stopPool()
 		QCoreApplication.exit()
 
 	def closeEvent(self, event):
@@ -362,6 +364,10 @@ class Icarra2(QApplication):
 		
 		# Initialize members
 		self.prefs = prefs
+		
+		# Fork rebuild workers before other threads start, changes to the number of processes apply on restart
+		positionReplay.startPool(prefs.getRebuildProcesses())
+		
 		self.stockData = StockData()
 		self.ofxDebugFrame = False
 		self.portfolio = False
@@ -469,7 +475,7 @@ class Icarra2(QApplication):
 		prefs.addPortfolio("Sample Portfolio")
 		prefs.setLastTab("Summary")
 		prefs.setLastPortfolio("Sample Portfolio")
-		p = Portfolio("Sample Portfolio")
+		p = getPortfolio("Sample Portfolio")
 		p.db.beginTransaction()
 
 		t = Transaction(1, "__CASH__", datetime.datetime(2008, 1, 2), Transaction.deposit, amount = 20000)
@@ -578,8 +584,7 @@ class Icarra2(QApplication):
 			a.setChecked(a.text().replace("&&", "&") == name)
 
 		try:
-			self.portfolio = Portfolio(name)
-			self.portfolio.readFromDb()
+			self.portfolio = getPortfolio(name)
 	
 			self.main.ts.rebuild()
 
@@ -631,7 +636,7 @@ class Icarra2(QApplication):
 	def buildPortfolioMenuNames(self):
 		self.portfolioMenuNames = {}
 		for name in prefs.getPortfolios():
-			p = Portfolio(name)
+			p = getPortfolio(name)
 			if not p:
 				continue
 
@@ -765,7 +770,7 @@ if "--rebuild" in sys.argv:
 	app = Icarra2(sys.argv)
 	
 	try:
-		p = Portfolio(sys.argv[2])
+		p = getPortfolio(sys.argv[2])
 		app.portfolio = p
 		p.rebuildPositionHistory(app.stockData)
 	except Exception, e:
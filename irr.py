@@ -1,11 +1,10 @@
 def calcValue(dates, inflows, thisRate):
 	try:
-		maxDate = dates[-1]
+		offsets = dayOffsets(dates)
 		val = 0
 		# val = sum(i) inflow[i] * thisRate ^ days[i]
 		for i in xrange(len(dates)):
-			days = (maxDate - dates[i]).days
-			val += inflows[i] * pow(thisRate, days)
+			val += inflows[i] * pow(thisRate, offsets[i])
 		return val
 	except Exception, e:
 		# Possible over/under flow
@@ -13,11 +12,11 @@ def calcValue(dates, inflows, thisRate):
 
 def calcValueDeriv(dates, inflows, thisRate):
 	try:
-		maxDate = dates[-1]
+		offsets = dayOffsets(dates)
 		val = 0
 		# val' = sum(i) inflow[i] * days[i] * thisRate ^ (days[i] - 1)
 		for i in xrange(len(dates)):
-			days = maxDate - dates[i]
+			days = offsets[i]
 			if days == 0:
 				continue
 			val += inflows[i] * days * pow(thisRate, days - 1)
@@ -75,9 +74,131 @@ def irrNewton(dates, inflows, r = 1.000261157876068):
 
 	return mid
 
+def dayOffsets(dates):
+	"Return the number of days from each date to the last date.  Dates may be datetimes or day ordinals."
+	maxDate = dates[-1]
+	if isinstance(maxDate, (int, long)):
+		return [maxDate - d for d in dates]
+	return [(maxDate - d).days for d in dates]
+
+def calcValueAndDeriv(offsets, inflows, thisRate):
+	"Return (value, derivative) at thisRate.  For rates above 1 both are divided by thisRate ^ max(offsets) to avoid overflow.  The sign and root are unchanged."
+	if thisRate > 1:
+		shift = max(offsets)
+	else:
+		shift = 0
+	val = 0.0
+	valPrime = 0.0
+	for i in xrange(len(offsets)):
+		days = offsets[i] - shift
+		term = inflows[i] * pow(thisRate, days)
+		val += term
+		valPrime += term * days / thisRate
+	return (val, valPrime)
+
+def irrHybrid(dates, inflows):
+	"Array of dates and inflows, same as irrBinary.  Newton's method safeguarded by the irrBinary bracket: steps that leave the bracket fall back to bisection.  Returns rate of return per day."
+	if len(dates) != len(inflows):
+		raise Exception("dates do not match inflows")
+	if len(dates) == 1:
+		return 0
+
+	low = 0.9
+	high = 1.1
+	offsets = dayOffsets(dates)
+	(valLow, valPrime) = calcValueAndDeriv(offsets, inflows, low)
+	(valHigh, valPrime) = calcValueAndDeriv(offsets, inflows, high)
+	# Every rate is a root, use the irrBinary answer
+	if valLow == 0 and valHigh == 0:
+		return irrBinary(dates, inflows)
+	if valLow == 0:
+		return low
+	if valHigh == 0:
+		return high
+	# No sign change, there is no root or more than one
+	if (valLow < 0) == (valHigh < 0):
+		return irrBinary(dates, inflows)
+	increasing = valLow < 0
+
+	mid = (high + low) / 2
+	for reps in xrange(100):
+		(val, valPrime) = calcValueAndDeriv(offsets, inflows, mid)
+		if val == 0:
+			return mid
+		
+		# Shrink bracket around the root
+		if (val < 0) == increasing:
+			low = mid
+		else:
+			high = mid
+		if high - low <= 1.0e-12:
+			break
+		
+		if valPrime != 0:
+			next = mid - val / valPrime
+		else:
+			next = low
+		if next <= low or next >= high:
+			next = (high + low) / 2
+		if abs(next - mid) < 1.0e-15:
+			return next
+		mid = next
+
+	return mid
+
+def irrBatch(series):
+	"Solve irrHybrid for a list of (dates, inflows).  Returns a list of rates of return per day."
+	return [irrHybrid(dates, inflows) for (dates, inflows) in series]
+
 #for i in xrange(100000):
 #	r = irrBinary([1, 100, 300], [100, 50, -200])
 #	r = irrNewton([1, 100, 300], [100, 50, -200])
 
 #print irrBinary([731776, 732065, 732119, 732349, 732477, 733177, 733220], [1253.4400000000001, -1533.8100000000002, 1012.3299999999999, -638.63999999999999, -10.210000000000001, 303.0, -227.37])
 #print irrBinary([731776, 732065, 732119, 732349, 732477, 733177, 733221], [1253.4400000000001, -1533.8100000000002, 1012.3299999999999, -638.63999999999999, -10.210000000000001, 303.0, -227.37])
+
+if __name__ == "__main__":
+	def checkRate(rate, expected):
+		if abs(rate - expected) > 1.0e-9:
+			print "rate", rate, "!=", expected
+			assert(False)
+	
+	print "test 1 - one year"
+	checkRate(irrHybrid([0, 365], [100.0, -110.0]), pow(1.1, 1 / 365.0))
+	checkRate(irrHybrid([733000, 733365], [100.0, -110.0]), pow(1.1, 1 / 365.0))
+	assert(irrHybrid([0], [100.0]) == 0)
+	
+	print "test 2 - sign changes"
+	# This series has more than one root, any of them solves it
+	dates = [731776, 732065, 732119, 732349, 732477, 733177, 733220]
+	inflows = [1253.44, -1533.81, 1012.33, -638.64, -10.21, 303.0, -227.37]
+	rate = irrHybrid(dates, inflows)
+	assert(rate > 0.9 and rate < 1.1)
+	assert(abs(calcValue(dates, inflows, rate)) < 1.0e-6)
+	dates = [0, 100, 200, 300]
+	inflows = [1000.0, -500.0, 800.0, -1400.0]
+	checkRate(irrHybrid(dates, inflows), irrBinary(dates, inflows))
+	assert(abs(calcValue(dates, inflows, irrHybrid(dates, inflows))) < 1.0e-6)
+	
+	print "test 3 - zero first flow"
+	checkRate(irrHybrid([0, 10, 375], [0.0, 100.0, -110.0]), pow(1.1, 1 / 365.0))
+	checkRate(irrHybrid([0, 365], [0.0, 0.0]), irrBinary([0, 365], [0.0, 0.0]))
+	
+	print "test 4 - rates above 1 over long periods"
+	# The bracket ends overflow unless values are scaled
+	checkRate(irrHybrid([0, 365 * 40], [100.0, -100.0 * pow(1.1, 40)]), pow(1.1, 1 / 365.0))
+	checkRate(irrHybrid([0, 365 * 40], [100.0, -100.0 * pow(0.9, 40)]), pow(0.9, 1 / 365.0))
+	checkRate(irrHybrid([0, 30], [100.0, -800.0]), pow(8.0, 1 / 30.0))
+	
+	print "test 5 - batch"
+	series = [
+		([0, 365], [100.0, -110.0]),
+		([0], [100.0]),
+		([0, 100, 200, 300], [1000.0, -500.0, 800.0, -1400.0])]
+	assert(irrBatch(series) == [irrHybrid(dates, inflows) for (dates, inflows) in series])
+	assert(irrBatch([]) == [])
+	try:
+		irrBatch([([0, 1], [100.0])])
+		assert(False)
+	except Exception, e:
+		assert(str(e) == "dates do not match inflows")
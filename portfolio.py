@@ -30,6 +30,8 @@ from userprice import *
 from positionCheck import *
 from twrr import *
 import irr
+import positionReplay
+import benchmarkCache
 
 import prefs
 try:
@@ -42,9 +44,14 @@ import chart
 import time
 import datetime
 import os
+import sys
 import copy
 import operator
 import uuid
+import cPickle
+import bisect
+import multiprocessing
+import threading
 
 def floatCompare(a, b):
 	if a > b:
@@ -64,23 +71,28 @@ class PortfolioPrefs(prefs.Prefs):
 	def __init__(self, db):
 		prefs.Prefs.__init__(self, db)
 		
-		self.checkDefaults("dirty", "True")
-		self.checkDefaults("positionIncSplits", "False")
-		self.checkDefaults("positionIncDividends", "True")
-		self.checkDefaults("positionIncFees", "False")
-		self.checkDefaults("positionIncBenchmark", "True")
-		self.checkDefaults("chartType", "Value")
-		self.checkDefaults("positionPeriod", "Since Inception")
-		self.checkDefaults("performanceCurrent", "False")
-		self.checkDefaults("performanceDividends", "True")
-		self.checkDefaults("lastImport", "ofx")
-		self.checkDefaults("combinedComponents", "")
-		self.checkDefaults("brokerage", "False")
-		self.checkDefaults("sync", "")
-		self.checkDefaults("autoAdjust", "False")
-		self.checkDefaults("autoSplit", "False")
-		self.checkDefaults("autoDividend", "False")
-		self.checkDefaults("autoDividendReinvest", "False")
+		self.checkAllDefaults([
+			("dirty", "True"),
+			("dirtyFrom", ""),
+			("dirtyTickersOnly", "False"),
+			("positionIncSplits", "False"),
+			("positionIncDividends", "True"),
+			("positionIncFees", "False"),
+			("positionIncBenchmark", "True"),
+			("chartType", "Value"),
+			("positionPeriod", "Since Inception"),
+			("performanceCurrent", "False"),
+			("performanceDividends", "True"),
+			("lastImport", "ofx"),
+			("combinedComponents", ""),
+			("brokerage", "False"),
+			("sync", ""),
+			("autoAdjust", "False"),
+			("autoSplit", "False"),
+			("autoDividend", "False"),
+			("autoDividendReinvest", "False"),
+			("basisMethod", Basis.fifo),
+			("lastRebuild", "")])
 
 	def getTransactionId(self):
 		return uuid.uuid4().hex
@@ -88,6 +100,23 @@ class PortfolioPrefs(prefs.Prefs):
 	def getDirty(self):
 		return self.getPreference("dirty") == "True"
 
+	def getDirtyFrom(self):
+		"""Return the first date that needs to be rebuilt or False if the entire portfolio is dirty"""
+		dirtyFrom = self.getPreference("dirtyFrom")
+		if not dirtyFrom:
+			return False
+		return Transaction.parseDate(dirtyFrom)
+	
+	def getDirtyTickers(self):
+		"""Return a dictionary of ticker to the first date that needs to be rebuilt.
+		Return False if every ticker is dirty from getDirtyFrom."""
+		if self.getPreference("dirtyTickersOnly") != "True":
+			return False
+		dirtyTickers = {}
+		for (ticker, date) in self.db.selectTuples("dirtyTickers", what = "ticker, dirtyFrom").fetchall():
+			dirtyTickers[ticker] = Transaction.parseDate(date)
+		return dirtyTickers
+
 	def getPositionIncSplits(self):
 		return self.getPreference("positionIncSplits") == "True"
 
@@ -143,134 +172,238 @@ class PortfolioPrefs(prefs.Prefs):
 	def getAutoDividendReinvest(self):
 		return self.getPreference("autoDividendReinvest") == "True"
 
+	def getBasisMethod(self):
+		"""Return the lot selection method when selling, one of Basis.fifo, Basis.lifo or Basis.hifo"""
+		return self.getPreference("basisMethod")
+
 	def setDirty(self, dirty):
+		# Either everything is dirty or nothing is, clear dirtyFrom
+		self.db.beginTransaction()
+		self.setPreference("dirty", dirty)
+		self.setPreference("dirtyFrom", "")
+		self.setPreference("dirtyTickersOnly", "False")
+		self.db.delete("dirtyTickers")
+		self.db.commitTransaction()
+
+	def setDirtyFrom(self, date):
+		"""Mark the portfolio as dirty starting at date.  Position history before date is still valid."""
+		dirtyFrom = self.getDirtyFrom()
+		if self.getDirty() and not dirtyFrom:
+			# Entire portfolio is already dirty
+			return
+		tickersOnly = self.getDirty() and self.getDirtyTickers() is not False
+		if dirtyFrom and dirtyFrom <= date:
+			if not tickersOnly:
+				return
+			date = dirtyFrom
+
+		# Every ticker is dirty from date, forget dirty tickers
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": dirty}, {"name": "dirty"})
+		self.setPreference("dirty", "True")
+		self.setPreference("dirtyFrom", date.strftime("%Y-%m-%d 00:00:00"))
+		self.setPreference("dirtyTickersOnly", "False")
+		self.db.delete("dirtyTickers")
+		self.db.commitTransaction()
+
+	def setTickerDirtyFrom(self, ticker, date):
+		"""Mark only ticker as dirty starting at date.  Positions that depend on ticker are rebuilt with it."""
+		if self.getDirty() and self.getDirtyTickers() is False:
+			# Every ticker is already dirty, make sure it is dirty from date
+			self.setDirtyFrom(date)
+			return
+		
+		dirtyFrom = self.getDirtyFrom()
+		dateStr = date.strftime("%Y-%m-%d 00:00:00")
+		self.db.beginTransaction()
+		cursor = self.db.select("dirtyTickers", where = {"ticker": ticker})
+		row = cursor.fetchone()
+		if not row:
+			self.db.insert("dirtyTickers", {"ticker": ticker, "dirtyFrom": dateStr})
+		elif Transaction.parseDate(row["dirtyFrom"]) > date:
+			self.db.update("dirtyTickers", {"dirtyFrom": dateStr}, {"ticker": ticker})
+		if not self.getDirty() or not dirtyFrom or date < dirtyFrom:
+			self.setPreference("dirtyFrom", dateStr)
+		self.setPreference("dirty", "True")
+		self.setPreference("dirtyTickersOnly", "True")
 		self.db.commitTransaction()
 
 	def setPositionIncSplits(self, inc):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": inc}, {"name": "positionIncSplits"})
+		self.setPreference("positionIncSplits", inc)
 		self.db.commitTransaction()
 
 	def setPositionIncDividends(self, inc):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": inc}, {"name": "positionIncDividends"})
+		self.setPreference("positionIncDividends", inc)
 		self.db.commitTransaction()
 
 	def setPositionIncFees(self, inc):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": inc}, {"name": "positionIncFees"})
+		self.setPreference("positionIncFees", inc)
 		self.db.commitTransaction()
 
 	def setPositionIncBenchmark(self, inc):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": inc}, {"name": "positionIncBenchmark"})
+		self.setPreference("positionIncBenchmark", inc)
 		self.db.commitTransaction()
 
 	def setChartType(self, type):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": type}, {"name": "chartType"})
+		self.setPreference("chartType", type)
 		self.db.commitTransaction()
 
 	def setPositionPeriod(self, period):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": period}, {"name": "positionPeriod"})
+		self.setPreference("positionPeriod", period)
 		self.db.commitTransaction()
 
 	def setPerformanceCurrent(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "performanceCurrent"})
+		self.setPreference("performanceCurrent", value)
 		self.db.commitTransaction()
 
 	def setPerformanceDividends(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "performanceDividends"})
+		self.setPreference("performanceDividends", value)
+		self.db.commitTransaction()
+
+	def setLastRebuild(self):
+		"""Record when position history was last rebuilt.  Portfolios caching this history read it again when it changes."""
+		self.db.beginTransaction()
+		self.setPreference("lastRebuild", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"))
 		self.db.commitTransaction()
 
 	def setLastImport(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "lastImport"})
+		self.setPreference("lastImport", value)
 		self.db.commitTransaction()
 
 	def setCombinedComponents(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "combinedComponents"})
+		self.setPreference("combinedComponents", value)
 		self.db.commitTransaction()
 
 	def setBrokerage(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "brokerage"})
+		self.setPreference("brokerage", value)
 		self.db.commitTransaction()
 
 	def setUrl(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "url"})
+		self.setPreference("url", value)
 		self.db.commitTransaction()
 
 	def setSync(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "sync"})
+		self.setPreference("sync", value)
 		self.db.commitTransaction()
 
 	def setAutoAdjust(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "autoAdjust"})
+		self.setPreference("autoAdjust", value)
 		self.db.commitTransaction()
 
 	def setAutoSplit(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "autoSplit"})
+		self.setPreference("autoSplit", value)
 		self.db.commitTransaction()
 
 	def setAutoDividend(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "autoDividend"})
+		self.setPreference("autoDividend", value)
 		self.db.commitTransaction()
 
 	def setAutoDividendReinvest(self, value):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": value}, {"name": "autoDividendReinvest"})
+		self.setPreference("autoDividendReinvest", value)
+		self.db.commitTransaction()
+
+	def setBasisMethod(self, value):
+		self.db.beginTransaction()
+		self.setPreference("basisMethod", value)
 		self.db.commitTransaction()
 
 class Portfolio:	
+	# Columns of positionHistory rows passed to stageHistory
+	historyColumns = ["date", "ticker", "shares", "options", "value", "normSplit", "normDividend", "normFee", "profitSplit", "profitDividend", "profitFee"]
+	# Running totals of a position checkpoint stored in their own columns
+	checkpointColumns = ["shares", "value", "adjustedValue", "totalFees", "totalDividends", "totalProfit", "price"]
+	
 	def __init__(self, name = False, brokerage = "", username = "", account = "", customDb = False):
+		# A shared portfolio is read and rebuilt by one thread at a time
+		self.lock = threading.RLock()
 		self.open(name, customDb)
 		
 	def open(self, name, customDb = False):
 		self.name = name
-
-		if prefs.prefs:
-			info = prefs.prefs.getPortfolioInfo(name)
-			if not info:
-				raise Exception("No portfolio " + name)
-			self.brokerage = info["brokerage"]
-			self.username = info["username"]
-			self.account = info["account"]
+		self.readInfo()
 	
 		if customDb:
 			self.db = Db(customDb)
 		else:
 			self.db = Db(appGlobal.getApp().prefs.getPortfolioPath(name))
 
-		self.db.beginTransaction()
+		# Append schema changes to the list, opening an up to date portfolio only reads its version
+		self.db.migrate([self.createTables, self.dropStaleCheckpoints, self.addCheckpointTotals])
 
 		self.portPrefs = PortfolioPrefs(self.db)
-		self.portPrefs.checkDefaults("nextTransactionId", "1")
-		self.portPrefs.checkDefaults("lastTicker", "__COMBINED__")
-		self.portPrefs.checkDefaults("benchmark", "S&P 500")
-		self.portPrefs.checkDefaults("isBrokerage", "True")
-		self.portPrefs.checkDefaults("isBank", "False")
-		self.portPrefs.checkDefaults("isBenchmark", "False")
-		self.portPrefs.checkDefaults("isCombined", "False")
-		self.portPrefs.checkDefaults("url", "")
-		self.portPrefs.checkDefaults("summaryYears", "lastYear")
-		self.portPrefs.checkDefaults("summaryChart1", chart.oneYearVsBenchmarkCash)
+		self.portPrefs.checkAllDefaults([
+			("nextTransactionId", "1"),
+			("lastTicker", "__COMBINED__"),
+			("benchmark", "S&P 500"),
+			("isBrokerage", "True"),
+			("isBank", "False"),
+			("isBenchmark", "False"),
+			("isCombined", "False"),
+			("url", ""),
+			("summaryYears", "lastYear"),
+			("summaryChart1", chart.oneYearVsBenchmarkCash)])
 		if self.isBank():
-			self.portPrefs.checkDefaults("summaryChart2", chart.oneMonthSpending)
+			self.portPrefs.checkAllDefaults([("summaryChart2", chart.oneMonthSpending)])
 		else:
-			self.portPrefs.checkDefaults("summaryChart2", chart.oneMonthMovers)
+			self.portPrefs.checkAllDefaults([("summaryChart2", chart.oneMonthMovers)])
+		
+		# List of transactions
+		self.transactions = []
+		self.transactionIndex = False
+		
+		# List of user prices
+		self.userPrices = []
+		
+		# Change count of the database when transactions were read
+		self.changes = False
+		
+	def close(self):
+		self.db.close()
+	
+	def readInfo(self):
+		'''Read brokerage, username and account from prefs'''
+		self.infoChanges = False
+		if prefs.prefs:
+			self.infoChanges = prefs.prefs.db.getChanges()
+			info = prefs.prefs.getPortfolioInfo(self.name)
+			if not info:
+				raise Exception("No portfolio " + self.name)
+			self.brokerage = info["brokerage"]
+			self.username = info["username"]
+			self.account = info["account"]
+	
+	def refresh(self):
+		'''Read prefs and transactions again if they were written since they were read'''
+		self.lock.acquire()
+		try:
+			if prefs.prefs and self.infoChanges != prefs.prefs.db.getChanges():
+				self.readInfo()
+			if self.changes != self.db.getChanges():
+				self.readFromDb()
+		finally:
+			self.lock.release()
 
+	def createTables(self):
+		self.db.checkTable("prefs", [
+			{"name": "name", "type": "text"},
+			{"name": "value", "type": "text"}])
+		
 		self.db.checkTable("stockInfo", [
 			{"name": "uniqueId", "type": "text"},
 			{"name": "uniqueIdType", "type": "text"},
@@ -292,8 +425,10 @@ class Portfolio:
 			{"name": "optionExpire", "type": "text"},
 			{"name": "edited", "type": "text not null default False"},
 			{"name": "deleted", "type": "bool not null default False"},
-			{"name": "auto", "type": "bool not null default False"}], index = [
-			{"name": "tickerDate", "cols": ["ticker", "date"]}])
+			{"name": "auto", "type": "bool not null default False"},
+			{"name": "hash", "type": "text"}], index = [
+			{"name": "tickerDate", "cols": ["ticker", "date"]},
+			{"name": "transactionId", "cols": ["uniqueId"]}])
 		
 		self.db.checkTable("userPrices", [
 			{"name": "date", "type": "datetime"},
@@ -306,6 +441,8 @@ class Portfolio:
 			{"name": "shares", "type": "float"},
 			{"name": "value", "type": "float"}])
 
+		# day is the ordinal of date for range queries
+		hasDays = self.db.hasColumn("positionHistory", "day")
 		self.db.checkTable("positionHistory", [
 			{"name": "date", "type": "datetime"},
 			{"name": "ticker", "type": "text"},
@@ -317,8 +454,24 @@ class Portfolio:
 			{"name": "normFee", "type": "float"},
 			{"name": "profitSplit", "type": "float"},
 			{"name": "profitDividend", "type": "float"},
-			{"name": "profitFee", "type": "float"}],
-			index = [{"name": "positionHistoryIndex", "cols": ["ticker, date"]}])
+			{"name": "profitFee", "type": "float"},
+			{"name": "day", "type": "integer"}],
+			index = [
+				{"name": "positionHistoryIndex", "cols": ["ticker, date"]},
+				{"name": "positionHistoryDayIndex", "cols": ["ticker, day"]}])
+		if not hasDays:
+			self.db.fillDays("positionHistory")
+		
+		self.db.checkTable("positionCheckpoint", [
+			{"name": "date", "type": "datetime"},
+			{"name": "ticker", "type": "text"},
+			{"name": "state", "type": "blob"}],
+			index = [{"name": "positionCheckpointIndex", "cols": ["ticker, date"]}])
+		
+		self.db.checkTable("dirtyTickers", [
+			{"name": "ticker", "type": "text"},
+			{"name": "dirtyFrom", "type": "datetime"}],
+			unique = [{"name": "dirtyTickerIndex", "cols": ["ticker"]}])
 		
 		self.db.checkTable("allocation", [
 			{"name": "ticker", "type": "text"},
@@ -338,17 +491,26 @@ class Portfolio:
 		self.db.checkTable("availCategories", [
 			{"name": "category", "type": "text"}],
 			unique = [{"name": "categoryIndex", "cols": ["category"]}])
-
-		self.db.commitTransaction()
-		
-		# List of transactions
-		self.transactions = []
-		
-		# List of user prices
-		self.userPrices = []
-		
-	def close(self):
-		self.db.close()
+	
+	def dropStaleCheckpoints(self):
+		# Checkpoints saved before basis lots were kept in a LotLedger can not be restored
+		self.db.delete("positionCheckpoint")
+	
+	def addCheckpointTotals(self):
+		# Running totals have their own columns and state only holds plain lists and dictionaries
+		self.db.delete("positionCheckpoint")
+		self.db.checkTable("positionCheckpoint", [
+			{"name": "date", "type": "datetime"},
+			{"name": "ticker", "type": "text"},
+			{"name": "shares", "type": "float"},
+			{"name": "value", "type": "float"},
+			{"name": "adjustedValue", "type": "float"},
+			{"name": "totalFees", "type": "float"},
+			{"name": "totalDividends", "type": "float"},
+			{"name": "totalProfit", "type": "float"},
+			{"name": "price", "type": "float"},
+			{"name": "state", "type": "blob"}],
+			index = [{"name": "positionCheckpointIndex", "cols": ["ticker, date"]}])
 	
 	def strToDatetime(self, date, zeroHMS = False):
 		# Remove HMS if specified
@@ -359,8 +521,12 @@ class Portfolio:
 		return Transaction.parseDate(date)
 	
 	def delete(self, prefs):
+		closePortfolio(self.name)
 		self.db.close()
-		os.remove(prefs.getPortfolioPath(self.name))
+		path = prefs.getPortfolioPath(self.name)
+		os.remove(path)
+		for logFile in getLogFiles(path):
+			os.remove(logFile)
 		prefs.deletePortfolio(self.name)
 	
 	def updateFromFile(self, data, app, status = False):
@@ -433,7 +599,11 @@ class Portfolio:
 					if status:
 						status.addMessage(message)
 	
-			self.portPrefs.setDirty(True)
+			# Only history after the first new transaction needs to be rebuilt
+			if numNew > 0 and format.firstNewDate:
+				self.portPrefs.setDirtyFrom(format.firstNewDate)
+			else:
+				self.portPrefs.setDirty(True)
 			if status:
 				status.setStatus("Finished\nImported %d new transactions.\n%d transactions had already been imported." % (numNew, numOld), 100)
 				status.setFinished()
@@ -446,40 +616,48 @@ class Portfolio:
 			raise
 
 	def readFromDb(self):
-		res = self.db.select("transactions")
+		self.lock.acquire()
+		try:
+			# Read the change count first so writes during the read are read again
+			self.changes = self.db.getChanges()
+			res = self.db.selectTuples("transactions", what = "uniqueId, ticker, date, type, total, shares, pricePerShare, fee, optionStrike, optionExpire, edited, deleted, ticker2, subType, auto")
 		
-		self.transactions = []
-		for row in res.fetchall():
-			t = Transaction(
-				uniqueId = row["uniqueId"],
-				ticker = row["ticker"].upper(),
-				date = row["date"],
-				transactionType = row["type"],
-				amount = row["total"],
-				shares = row["shares"],
-				pricePerShare = row["pricePerShare"],
-				fee = row["fee"],
-				optionStrike = row["optionStrike"],
-				optionExpire = row["optionExpire"],
-				edited = row["edited"],
-				deleted = row["deleted"],
-				ticker2 = row["ticker2"],
-				subType = row["subType"],
-				auto = row["auto"])
-			self.transactions.append(t)
-		
-		# Sort transactions
-		self.transactions.sort()
+			self.transactions = []
+			for (uniqueId, ticker, date, transType, total, shares, pricePerShare, fee, optionStrike, optionExpire, edited, deleted, ticker2, subType, auto) in res.fetchall():
+				t = Transaction(
+					uniqueId = uniqueId,
+					ticker = ticker.upper(),
+					date = date,
+					transactionType = transType,
+					amount = total,
+					shares = shares,
+					pricePerShare = pricePerShare,
+					fee = fee,
+					optionStrike = optionStrike,
+					optionExpire = optionExpire,
+					edited = edited,
+					deleted = deleted,
+					ticker2 = ticker2,
+					subType = subType,
+					auto = auto)
+				self.transactions.append(t)
+		
+			# Sort transactions
+			self.transactions.sort(key = Transaction.sortKey, reverse = True)
+			self.transactionIndex = False
 	
-		res = self.db.select("userPrices")
+			res = self.db.select("userPrices")
 		
-		for row in res.fetchall():
-			ticker = row["ticker"]
-			p = UserPrice(
-				row["date"],
-				ticker,
-				row["price"])
-			self.userPrices.append(p)
+			self.userPrices = []
+			for row in res.fetchall():
+				ticker = row["ticker"]
+				p = UserPrice(
+					row["date"],
+					ticker,
+					row["price"])
+				self.userPrices.append(p)
+		finally:
+			self.lock.release()
 
 	def isValid(self):
 		return self.getPositionFirstLast("__COMBINED__")
@@ -493,19 +671,15 @@ class Portfolio:
 			for name in components:
 				if not name:
 					continue
-				p = Portfolio(name)
-				p.readFromDb()
+				p = getPortfolio(name)
 				pTickers = p.getTickers(includeAllocation)
 				for ticker in pTickers:
 					tickers[ticker] = ticker
 		else:
 			# Regular portfolio
 			tickers = {}
-			for t in self.transactions:
-				if t.ticker and not t.deleted and not t.ticker in tickers:
-					tickers[t.ticker] = t.ticker
-				if t.ticker2 and not t.deleted and not t.ticker2 in tickers:
-					tickers[t.ticker2] = t.ticker2
+			for ticker in self.getTransactionIndex()["tickers"]:
+				tickers[ticker] = ticker
 					
 			# Add in positionCheck
 			# Do not include options (ends in " call" or " put")
@@ -541,22 +715,22 @@ class Portfolio:
 		return self.portPrefs.getPreference("isCombined") == "True"
 
 	def makeBenchmark(self):
-		self.db.update("prefs", {"value": "True"}, {"name": "isBenchmark"})
-		self.db.update("prefs", {"value": "False"}, {"name": "isBrokerage"})
-		self.db.update("prefs", {"value": "False"}, {"name": "isBank"})
-		self.db.update("prefs", {"value": "False"}, {"name": "isCombined"})
+		self.portPrefs.setPreference("isBenchmark", "True")
+		self.portPrefs.setPreference("isBrokerage", "False")
+		self.portPrefs.setPreference("isBank", "False")
+		self.portPrefs.setPreference("isCombined", "False")
 	
 	def makeCombined(self):
-		self.db.update("prefs", {"value": "True"}, {"name": "isCombined"})
-		self.db.update("prefs", {"value": "False"}, {"name": "isBrokerage"})
-		self.db.update("prefs", {"value": "False"}, {"name": "isBank"})
-		self.db.update("prefs", {"value": "False"}, {"name": "isBenchmark"})
+		self.portPrefs.setPreference("isCombined", "True")
+		self.portPrefs.setPreference("isBrokerage", "False")
+		self.portPrefs.setPreference("isBank", "False")
+		self.portPrefs.setPreference("isBenchmark", "False")
 	
 	def makeBank(self):
-		self.db.update("prefs", {"value": "True"}, {"name": "isBank"})
-		self.db.update("prefs", {"value": "False"}, {"name": "isBrokerage"})
-		self.db.update("prefs", {"value": "False"}, {"name": "isCombined"})
-		self.db.update("prefs", {"value": "False"}, {"name": "isBenchmark"})
+		self.portPrefs.setPreference("isBank", "True")
+		self.portPrefs.setPreference("isBrokerage", "False")
+		self.portPrefs.setPreference("isCombined", "False")
+		self.portPrefs.setPreference("isBenchmark", "False")
 	
 	def getCategories(self):
 		# Read categories from DB
@@ -619,7 +793,7 @@ class Portfolio:
 		return self.portPrefs.getPreference("benchmark")
 
 	def setBenchmark(self, benchmark):
-		self.db.update("prefs", {"value": benchmark}, {"name": "benchmark"})
+		self.portPrefs.setPreference("benchmark", benchmark)
 
 	def getSummaryYears(self):
 		return self.portPrefs.getPreference("summaryYears")
@@ -631,16 +805,16 @@ class Portfolio:
 		return int(self.portPrefs.getPreference("summaryChart2"))
 
 	def setSummaryYears(self, all):
-		self.db.update("prefs", {"value": all}, {"name": "summaryYears"})
+		self.portPrefs.setPreference("summaryYears", all)
 
 	def setSummaryChart1(self, type):
-		self.db.update("prefs", {"value": type}, {"name": "summaryChart1"})
+		self.portPrefs.setPreference("summaryChart1", type)
 
 	def setSummaryChart2(self, type):
-		self.db.update("prefs", {"value": type}, {"name": "summaryChart2"})
+		self.portPrefs.setPreference("summaryChart2", type)
 
 	def setLastTicker(self, last):
-		self.db.update("prefs", {"value": last}, {"name": "lastTicker"})
+		self.portPrefs.setPreference("lastTicker", last)
 	
 	def getStartDate(self):
 		cursor = self.db.select("transactions", orderBy = "date asc", limit = 1)
@@ -670,10 +844,103 @@ class Portfolio:
 			return Transaction.parseDate(row["date"])
 		return False		
 
+	def getTransactionIndex(self):
+		"""Index of self.transactions, built on first use and cleared when transactions are read from the database.
+		ticker and type map to (transactions, dates) sorted by date ascending, all is every transaction.
+		tickers is every ticker and ticker2 of non-deleted transactions, tables caches getTransactionTable."""
+		if self.transactionIndex:
+			return self.transactionIndex
+		
+		byTicker = {}
+		byType = {}
+		allTrans = ([], [])
+		tickers = {}
+		for t in reversed(self.transactions):
+			keys = [t.ticker.upper()]
+			if t.ticker2 and t.ticker2 != "False" and t.ticker2.upper() != keys[0]:
+				keys.append(t.ticker2.upper())
+			for key in keys:
+				if not key in byTicker:
+					byTicker[key] = ([], [])
+				byTicker[key][0].append(t)
+				byTicker[key][1].append(t.date)
+			
+			if not t.type in byType:
+				byType[t.type] = ([], [])
+			byType[t.type][0].append(t)
+			byType[t.type][1].append(t.date)
+			
+			allTrans[0].append(t)
+			allTrans[1].append(t.date)
+			
+			if not t.deleted:
+				if t.ticker:
+					tickers[t.ticker] = True
+				if t.ticker2:
+					tickers[t.ticker2] = True
+		
+		self.transactionIndex = {"ticker": byTicker, "type": byType, "all": allTrans, "tickers": tickers.keys(), "tables": {}}
+		return self.transactionIndex
+	
+	def getTransactionTable(self, ticker = False):
+		"""Return a TransactionTable of the non-deleted transactions matching ticker or ticker2 (all tickers if False)."""
+		index = self.getTransactionIndex()
+		if ticker:
+			ticker = ticker.upper()
+		if not ticker in index["tables"]:
+			if ticker:
+				transactions = index["ticker"].get(ticker, ([], []))[0]
+			else:
+				transactions = index["all"][0]
+			index["tables"][ticker] = TransactionTable([t for t in transactions if not t.deleted])
+		return index["tables"][ticker]
+	
+	def getTransactionRange(self, ticker = False, types = False, first = False, last = False, ascending = True, getDeleted = False):
+		"""Return transactions matching ticker or ticker2 (all tickers if False) whose type is in types (all types if False)
+		and whose date is between first and last inclusive.
+		Transactions are not copied and, unlike getTransactions, no cash transactions are created for __CASH__."""
+		index = self.getTransactionIndex()
+		if ticker:
+			(transactions, dates) = index["ticker"].get(ticker.upper(), ([], []))
+		elif types and len(types) == 1:
+			(transactions, dates) = index["type"].get(types[0], ([], []))
+		else:
+			(transactions, dates) = index["all"]
+		
+		if first:
+			begin = bisect.bisect_left(dates, first)
+		else:
+			begin = 0
+		if last:
+			end = bisect.bisect_right(dates, last)
+		else:
+			end = len(dates)
+		
+		ret = []
+		for t in transactions[begin:end]:
+			if (getDeleted or not t.deleted) and (not types or t.type in types):
+				ret.append(t)
+		
+		if not ascending:
+			ret.reverse()
+		
+		return ret
+	
 	def getTransactions(self, ticker = False, ascending = False, getDeleted = False, deletedOnly = False, buysToCash = True, limit = False, transType = False):
 		retTrans = []
 		
-		if ticker:
+		if ticker and ticker.upper() != "__CASH__":
+			# Transactions matching ticker or ticker2 from the index
+			index = self.getTransactionIndex()
+			for t in reversed(index["ticker"].get(ticker.upper(), ([], []))[0]):
+				if type(transType) == int and t.type != transType:
+					continue
+				if not getDeleted and not deletedOnly and t.deleted:
+					continue
+				if deletedOnly and not t.deleted:
+					continue
+				retTrans.append(t)
+		elif ticker:
 			ticker = ticker.upper()
 			for t in self.transactions:
 				# Ignore type if type is specified and it doesn't match
@@ -692,7 +959,7 @@ class Portfolio:
 						retTrans.append(t)
 					elif t.getCashMod() != 0:
 						# Transaction modifies cash, create copy
-						t2 = copy.deepcopy(t)
+						t2 = t.copy()
 						t2.ticker = "__CASH__"
 						t2.fee = 0.0
 						if t.getCashMod() > 0:
@@ -706,14 +973,14 @@ class Portfolio:
 						retTrans.append(t2)
 				elif ticker == "__CASH__" and t.type == Transaction.transferIn:
 					# Tranfser in must get a deposit to signify that value was added to the account
-					t2 = copy.deepcopy(t)
+					t2 = t.copy()
 					t2.type = Transaction.deposit
 					t2.total = abs(t2.total)
 					t2.fee = 0.0
 					retTrans.append(t2)			
 				elif ticker == "__CASH__" and t.type == Transaction.transferOut:
 					# Tranfser out must get a withdrawal to signify that value was removed from the account
-					t2 = copy.deepcopy(t)
+					t2 = t.copy()
 					t2.type = Transaction.withdrawal
 					t2.total = abs(t2.total)
 					t2.fee = 0.0
@@ -723,7 +990,11 @@ class Portfolio:
 					# or the requested ticker matches ticker or ticker2
 					retTrans.append(t)
 		else:
-			for t in self.transactions:
+			if type(transType) == int:
+				transactions = reversed(self.getTransactionIndex()["type"].get(transType, ([], []))[0])
+			else:
+				transactions = self.transactions
+			for t in transactions:
 				if type(transType) == int and t.type != transType:
 					continue
 				
@@ -778,48 +1049,7 @@ class Portfolio:
 		return retPrices
 	
 	def addUserAndTransactionPrices(self, ticker, prices, optionPrices, transactions):
-		userPrices = self.getUserPrices(ticker)
-		
-		# Use buys/sells to add to user price
-		for t in transactions:
-			if t.type in [Transaction.buy, Transaction.sell, Transaction.transferIn, Transaction.transferOut, Transaction.short, Transaction.cover, Transaction.buyToOpen, Transaction.sellToClose, Transaction.sellToOpen, Transaction.buyToClose]:
-				# Add to user prices
-				# Note there may already be a user price for this date
-				
-				price = False
-				if t.pricePerShare:
-					price = t.pricePerShare
-				elif t.shares > 0:
-					price = abs(t.total / t.shares)
-				
-				# Add user price if we found pricing information
-				if price:
-					if t.isOption():
-						if not t.formatTicker() in optionPrices:
-							optionPrices[t.formatTicker()] = []
-						optionPrices[t.formatTicker()].append({'volume': 0, 'high': price, 'low': price, 'date': t.date, 'close': price, 'open': price})
-					else:
-						userPrices.append(UserPrice(t.date, t.ticker, price))
-
-		# Add user prices and transaction prices to prices array
-		appended = False
-		for p in userPrices:
-			date = self.strToDatetime(p.date, zeroHMS = True)
-
-			# Check if date is already there
-			found = False
-			for p2 in prices:
-				if p2["date"] == date:
-					found = True
-					break
-			if not found:
-				appended = True
-				prices.append({'volume': 0, 'high': p.price, 'low': p.price, 'date': date, 'close': p.price, 'open': p.price})
-		
-		# If we added prices, sort by date
-		if appended:
-			prices.sort(key = lambda p: p['date'])
-		
+		positionReplay.addUserAndTransactionPrices(prices, optionPrices, transactions, self.getUserPrices(ticker))
 	
 	def getPositionCheck(self, ticker):
 		checks = []
@@ -861,11 +1091,13 @@ class Portfolio:
 	def getPositionHistory(self, ticker, startDate = False):
 		where = {"ticker": ticker}
 		if startDate:
-			where["date >="] = "%d-%02d-%02d 00:00:00" % (startDate.year, startDate.month, startDate.day)
-		cursor = self.db.select("positionHistory", where = where)
+			where["day >="] = startDate.toordinal()
+		cursor = self.db.selectTuples("positionHistory", what = ", ".join(Portfolio.historyColumns), where = where)
+		names = [col[0] for col in cursor.description]
 		
 		ret = {}
-		for row in cursor.fetchall():
+		for values in cursor.fetchall():
+			row = dict(zip(names, values))
 			row["date"] = self.strToDatetime(row["date"])
 			ret[row["date"]] = row
 		
@@ -918,57 +1150,189 @@ class Portfolio:
 		d1 = self.strToDatetime(row['minDate'])
 		d2 = self.strToDatetime(row['maxDate'])
 		return (d1, d2)
+
+	def getPositionsFirstLast(self):
+		"""Return getPositionFirstLast for every ticker with one query.  Key is ticker."""
+		cursor = self.db.query("select ticker, min(date) as minDate, max(date) as maxDate from positionHistory group by ticker")
+		
+		ret = {}
+		for row in cursor.fetchall():
+			if row['minDate'] is None or row['maxDate'] is None:
+				continue
+			ret[row['ticker']] = (self.strToDatetime(row['minDate']), self.strToDatetime(row['maxDate']))
+		return ret
 	
-	def sumInflow(self, first, last, ticker = False):
-		transactions = self.getTransactions(ticker, transType = Transaction.deposit)
+	def getPositionsOnDates(self, ticker, dates):
+		"""Return getPositionOnDate for each of dates with one query.  Key is date, missing dates are not included."""
+		dateStrs = {}
+		for date in dates:
+			dateStrs[date.strftime("%Y-%m-%d %H:%M:%S")] = True
+		dateStrs = dateStrs.keys()
 		
-		# Filter for transactions in time period, then sum
-		tInDate = filter(lambda t: first <= t.date <= last, transactions)
-		sumA = reduce(lambda x, t: x + abs(t.total), tInDate, 0.0)
-
-		transactions = self.getTransactions(ticker, transType = Transaction.withdrawal)
+		cursor = self.db.query("select * from positionHistory where ticker=? and date in (" + ", ".join(["?"] * len(dateStrs)) + ")", tuple([ticker] + dateStrs))
+		ret = {}
+		for row in cursor.fetchall():
+			row["date"] = self.strToDatetime(row["date"])
+			ret[row["date"]] = row
+		return ret
+	
+	def getPosition(self, ticker, date, positions = False):
+		"""Return position on date from positions returned by getPositionsOnDates.  Read from the database if positions is False."""
+		if positions is False:
+			return self.getPositionOnDate(ticker, date)
+		return positions.get(date, False)
+
+	def getPositionCheckpoint(self, ticker, before):
+		"""Return (date, state) of the last rebuild checkpoint for ticker before the given date, or False"""
+		where = {"ticker": ticker, "date <": before.strftime("%Y-%m-%d 00:00:00")}
+		cursor = self.db.select("positionCheckpoint", where = where, orderBy = "date desc", limit = 1)
+		row = cursor.fetchone()
+		if not row:
+			return False
 		
-		# Filter for transactions in time period, then sum
-		tInDate = filter(lambda t: first <= t.date <= last, transactions)
-		sumA = reduce(lambda x, t: x - abs(t.total), tInDate, sumA)
-
+		state = cPickle.loads(str(row["state"]))
+		for c in self.checkpointColumns:
+			state[c] = row[c]
+		return (self.strToDatetime(row["date"]), state)
+	
+	def savePositionCheckpoints(self, ticker, checkpoints):
+		"""Save a list of (date string, state) for ticker.  Only the newest checkpointMonths + 1 checkpoints of ticker are kept."""
+		rows = []
+		for (date, state) in checkpoints:
+			state = state.copy()
+			row = [date, ticker] + [state.pop(c) for c in self.checkpointColumns]
+			row.append(sqlite.Binary(cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)))
+			rows.append(row)
+		self.db.insertMany("positionCheckpoint", ["date", "ticker"] + self.checkpointColumns + ["state"], rows)
+		self.db.query("delete from positionCheckpoint where ticker=? and date not in (select date from positionCheckpoint where ticker=? order by date desc limit ?)",
+			(ticker, ticker, positionReplay.checkpointMonths + 1))
+	
+	def beginHistoryStaging(self):
+		"""Rebuilt position history is written to a temporary staging table and copied into positionHistory by commitHistoryStaging"""
+		self.db.query("create temp table if not exists positionHistoryStaging as select * from positionHistory where 0")
+		self.db.query("delete from positionHistoryStaging")
+		self.stagedHistory = []
+		
+		# Key is ticker, value is the date string up to which saved history is kept, empty if none is kept.  False if none is kept.
+		self.keptHistory = {}
+	
+	def getStagedPositionOnDate(self, ticker, date):
+		"""Return getPositionOnDate while history is staged.  Staged positions are read first, then saved history that is kept."""
+		self.flushHistory()
+		dateStr = date.strftime("%Y-%m-%d %H:%M:%S")
+		cursor = self.db.select("positionHistoryStaging", where = {"ticker": ticker, "date": dateStr})
+		row = cursor.fetchone()
+		if not row:
+			if self.keptHistory is False or self.keptHistory.get(ticker, dateStr) < dateStr:
+				return False
+			cursor = self.db.select("positionHistory", where = {"ticker": ticker, "date": dateStr})
+			row = cursor.fetchone()
+			if not row:
+				return False
+		
+		row["date"] = self.strToDatetime(row["date"])
+		return row
+	
+	def stageHistory(self, row):
+		"""Add a positionHistory row, a tuple in historyColumns order.  Rows are written in batches."""
+		self.stagedHistory.append(row)
+		if len(self.stagedHistory) >= 10000:
+			self.flushHistory()
+	
+	def flushHistory(self):
+		self.db.insertMany("positionHistoryStaging", Portfolio.historyColumns, self.stagedHistory)
+		self.stagedHistory = []
+	
+	def commitHistoryStaging(self, deletes = False):
+		"""Replace position history with the staging table.
+		deletes is a list of (query, tuple) that remove the history being replaced, all history is removed if False."""
+		self.flushHistory()
+		if deletes is False:
+			self.db.delete("positionHistory")
+		else:
+			for (query, values) in deletes:
+				self.db.query(query, values)
+		
+		cols = ", ".join(Portfolio.historyColumns)
+		self.db.query("insert into positionHistory (" + cols + ", day) select " + cols + ", " + Db.daySql + " from positionHistoryStaging")
+		self.db.query("delete from positionHistoryStaging")
+	
+	def addHistoryValues(self, combinedValue, ticker, last = False):
+		"""Add the saved value of ticker on each day up to last to combinedValue, keyed by day ordinal"""
+		where = {"ticker": ticker}
+		if last:
+			where["day <="] = last.toordinal()
+		cursor = self.db.selectTuples("positionHistory", what = "day, value", where = where)
+		for (d, v) in cursor.fetchall():
+			if d in combinedValue:
+				combinedValue[d] += v
+			else:
+				combinedValue[d] = v
+	
+	def getIncrementalRebuildDate(self):
+		"""Return the first date that has to be rebuilt if an incremental rebuild is possible, otherwise False.
+		Combined, bank and benchmark portfolios, portfolios with automatic adjustments, splits or dividends
+		and portfolios without checkpoints are always rebuilt from the beginning."""
+		dirtyFrom = self.portPrefs.getDirtyFrom()
+		if not dirtyFrom or not self.isBrokerage() or self.isCombined() or self.isBenchmark():
+			return False
+		
+		# Automatically generated transactions depend on the entire history
+		if self.portPrefs.getAutoAdjust() or self.portPrefs.getAutoSplit() or self.portPrefs.getAutoDividend():
+			return False
+		
+		# Need checkpoints from a previous rebuild
+		cursor = self.db.select("positionCheckpoint", what = "count(*) as count")
+		if cursor.fetchone()["count"] == 0:
+			return False
+		
+		return dirtyFrom
+	
+	def setStockDataDirty(self, date, ticker = False):
+		"""Mark the portfolio as dirty after receiving new stock data starting at date.
+		If ticker is given only positions depending on ticker are rebuilt."""
+		# Transactions without a price use the nearest price within 7 days
+		if ticker:
+			self.portPrefs.setTickerDirtyFrom(ticker, date - datetime.timedelta(days = 7))
+		else:
+			self.portPrefs.setDirtyFrom(date - datetime.timedelta(days = 7))
+	
+	def sumInflow(self, first, last, ticker = False):
+		table = self.getTransactionTable(ticker)
+		total = table.total
+		
+		sumA = 0.0
+		for i in table.getIndexes(first, last, [Transaction.deposit]):
+			sumA += abs(total[i])
+		for i in table.getIndexes(first, last, [Transaction.withdrawal]):
+			sumA -= abs(total[i])
 
 		# Next do transferIn and transferOut
-		transactions = self.getTransactions(ticker, transType = Transaction.transferIn)
-		tInDate = filter(lambda t: first <= t.date <= last, transactions)
-		sumB = reduce(lambda x, t: x + abs(t.total), tInDate, 0.0)
-
-		transactions = self.getTransactions(ticker, transType = Transaction.transferOut)
-		tInDate = filter(lambda t: first <= t.date <= last, transactions)
-		sumB = reduce(lambda x, t: x - abs(t.total), tInDate, sumB)
+		sumB = 0.0
+		for i in table.getIndexes(first, last, [Transaction.transferIn]):
+			sumB += abs(total[i])
+		for i in table.getIndexes(first, last, [Transaction.transferOut]):
+			sumB -= abs(total[i])
 
 		return sumA + sumB
 
 	def sumDistributions(self, first, last, ticker = False):
-		transactions = self.getTransactions(ticker, transType = Transaction.dividend)
-		
-		# Filter for transactions in time period, then sum
-		tInDate = filter(lambda t: first <= t.date <= last, transactions)
-		sum = reduce(lambda x, t: x + t.getTotal(), tInDate, 0.0)
-
-		transactions = self.getTransactions(ticker, transType = Transaction.dividendReinvest)
-		
-		# Filter for transactions in time period, then sum
-		tInDate = filter(lambda t: first <= t.date <= last, transactions)
-		sum = reduce(lambda x, t: x + t.getTotal(), tInDate, sum)
+		table = self.getTransactionTable(ticker)
+		sum = 0.0
+		for i in table.getIndexes(first, last, [Transaction.dividend, Transaction.dividendReinvest]):
+			sum += table.netTotal[i]
 
 		return sum
 	
 	def sumFees(self, first, last, ticker = False):
-		transactions = self.getTransactions(ticker)
-		
-		# Filter for transactions in time period, then sum
-		tInDate = filter(lambda t: first <= t.date <= last, transactions)
-		sum = reduce(lambda x, t: x + abs(t.fee), tInDate, 0.0)
+		table = self.getTransactionTable(ticker)
+		sum = 0.0
+		for i in table.getIndexes(first, last):
+			sum += abs(table.fee[i])
 		return sum
 
 	# Returns (performance string, years)
-	def calculatePerformanceTimeWeighted(self, ticker, first, last, divide = True, dividend = True, format = True, isInception = False):
+	def calculatePerformanceTimeWeighted(self, ticker, first, last, divide = True, dividend = True, format = True, isInception = False, positions = False):
 		if last < first:
 			return ("n/a", 0)
 		
@@ -980,8 +1344,8 @@ class Portfolio:
 			return ("n/a", years)
 
 		# Computer starting and ending values
-		val1 = self.getPositionOnDate(ticker, first)
-		val2 = self.getPositionOnDate(ticker, last)
+		val1 = self.getPosition(ticker, first, positions)
+		val2 = self.getPosition(ticker, last, positions)
 		if not val1 or not val2:
 			return ("n/a", years)
 		if dividend:
@@ -1011,28 +1375,37 @@ class Portfolio:
 		return (ret, years)
 	
 	# Returns (performance string, years)
-	def calculatePerformanceIRR(self, ticker, first, last, divide = True, dividend = True, format = True, isInception = False):
+	def calculatePerformanceIRR(self, ticker, first, last, divide = True, dividend = True, format = True, isInception = False, positions = False, transactions = False):
+		(dates, inflows, years) = self.getIRRCashFlows(ticker, first, last, isInception, positions, transactions)
+		if not dates:
+			return ("n/a", years)
+		
+		return self.formatIRR(irr.irrHybrid(dates, inflows), first, last, years, format)
+	
+	# Returns (dates, inflows, years) for calculating IRR from first to last
+	# dates is False if IRR can not be calculated
+	def getIRRCashFlows(self, ticker, first, last, isInception = False, positions = False, transactions = False):
 		if ticker == "__CASH__":
 			raise Exception("Cannot calculate IRR for cash")
 		if last < first:
-			return ("n/a", 0)
+			return (False, False, 0)
 		
 		# Next normalize
 		diff = last - first
 		days = diff.days
 		years = (days + 1) / 365.25
 		if days == 0:
-			return ("n/a", years)
+			return (False, False, years)
 
 		# Computer starting and ending values
-		val1 = self.getPositionOnDate(ticker, first)
-		val2 = self.getPositionOnDate(ticker, last)
+		val1 = self.getPosition(ticker, first, positions)
+		val2 = self.getPosition(ticker, last, positions)
 		if not val1 or not val2:
-			return ("n/a", years)
+			return (False, False, years)
 		val1 = val1["value"]
 		val2 = val2["value"]
 		if abs(val1) < 1.0e-6:
-			return ("n/a", years)
+			return (False, False, years)
 		
 		# Build dates and inflows
 		dates = []
@@ -1049,11 +1422,8 @@ class Portfolio:
 		#		print dates[i], inflows[i]
 
 		# Get transactions
-		if ticker == "__COMBINED__" or ticker == "__BENCHMARK__":
-			thisTicker = False
-		else:
-			thisTicker = ticker
-		transactions = self.getTransactions(thisTicker, ascending = True, buysToCash = False)
+		if transactions is False:
+			transactions = self.getIRRTransactions(ticker)
 		
 		for t in transactions:
 			if t.getDate() < first:
@@ -1083,8 +1453,19 @@ class Portfolio:
 		# Add current value (if any)
 		dates.append(last)
 		inflows.append(-val2)
-
-		ret = irr.irrBinary(dates, inflows)
+		
+		return (dates, inflows, years)
+	
+	def getIRRTransactions(self, ticker):
+		if ticker == "__COMBINED__" or ticker == "__BENCHMARK__":
+			thisTicker = False
+		else:
+			thisTicker = ticker
+		return self.getTransactions(thisTicker, ascending = True, buysToCash = False)
+	
+	# Returns (performance string, years) from a daily rate of return
+	def formatIRR(self, ret, first, last, years, format = True):
+		days = (last - first).days
 		if days > 365:
 			ret = pow(ret, 365)
 		else:
@@ -1095,11 +1476,10 @@ class Portfolio:
 		if format:
 			ret = "%.2f%%" % (100.0 * ret - 100.0)
 		
-		#print ticker, ret, val1, val2, years, days, first, last
 		return (ret, years)
 		
 	# Returns (performance string, years)
-	def calculatePerformanceProfit(self, ticker, first, last, divide = True, dividend = True, format = True, isInception = False):
+	def calculatePerformanceProfit(self, ticker, first, last, divide = True, dividend = True, format = True, isInception = False, positions = False):
 		if last < first:
 			return ("n/a", 0)
 		
@@ -1109,8 +1489,8 @@ class Portfolio:
 		years = (days + 1) / 365.25
 		
 		# Computer starting and ending values
-		val1 = self.getPositionOnDate(ticker, first)
-		val2 = self.getPositionOnDate(ticker, last)
+		val1 = self.getPosition(ticker, first, positions)
+		val2 = self.getPosition(ticker, last, positions)
 		if not val1 or not val2:
 			return ("n/a", 0)
 		if dividend:
@@ -1134,7 +1514,7 @@ class Portfolio:
 		return (ret, years)
 	
 	# Returns (performance string, years)
-	def calculatePerformanceValue(self, ticker, first, last, divide = True, dividend = True, format = True, isInception = False):
+	def calculatePerformanceValue(self, ticker, first, last, divide = True, dividend = True, format = True, isInception = False, positions = False):
 		if last < first:
 			return ("n/a", 0)
 		
@@ -1144,8 +1524,8 @@ class Portfolio:
 		years = (days + 1) / 365.25
 		
 		# Computer starting and ending values
-		val1 = self.getPositionOnDate(ticker, first)
-		val2 = self.getPositionOnDate(ticker, last)
+		val1 = self.getPosition(ticker, first, positions)
+		val2 = self.getPosition(ticker, last, positions)
 		if not val1 or not val2:
 			return ("n/a", years)
 		if dividend:
@@ -1256,7 +1636,8 @@ class Portfolio:
 		stockDividends = {}
 		currentStockDividend = {}
 		for ticker in positions:
-			stockPrices[ticker] = stockData.getPrices(ticker)
+			# List of (date, close)
+			stockPrices[ticker] = list(stockData.iterPrices(ticker, ["date", "close"]))
 			currentStockPrice[ticker] = 0
 			stockDividends[ticker] = stockData.getDividends(ticker)
 			currentStockDividend[ticker] = 0
@@ -1277,10 +1658,10 @@ class Portfolio:
 						break
 
 			# Get current price
-			while currentStockPrice[ticker] < len(stockPrices[ticker]) and stockPrices[ticker][currentStockPrice[ticker]]["date"] < date:
+			while currentStockPrice[ticker] < len(stockPrices[ticker]) and stockPrices[ticker][currentStockPrice[ticker]][0] < date:
 				currentStockPrice[ticker] += 1
-			if currentStockPrice[ticker] < len(stockPrices[ticker]) and stockPrices[ticker][currentStockPrice[ticker]]["date"] == date:
-				val = stockPrices[ticker][currentStockPrice[ticker]]
+			if currentStockPrice[ticker] < len(stockPrices[ticker]) and stockPrices[ticker][currentStockPrice[ticker]][0] == date:
+				val = stockPrices[ticker][currentStockPrice[ticker]][1]
 				stockVal[ticker] = val
 
 			# Compute value if we own shares
@@ -1292,11 +1673,11 @@ class Portfolio:
 					# Possible bug if multiple dividends on the same day
 					while currentStockDividend[ticker] < len(stockDividends[ticker]) and stockDividends[ticker][currentStockDividend[ticker]]["date"] < date:
 						currentStockDividend[ticker] += 1
-					if val["close"] > 0 and currentStockDividend[ticker] < len(stockDividends[ticker]) and stockDividends[ticker][currentStockDividend[ticker]]["date"] == date:
+					if val > 0 and currentStockDividend[ticker] < len(stockDividends[ticker]) and stockDividends[ticker][currentStockDividend[ticker]]["date"] == date:
 						div = stockDividends[ticker][currentStockDividend[ticker]]
 
 						amount = div["value"] * shares[ticker]
-						buyShares = amount / val["close"]
+						buyShares = amount / val
 						shares[ticker] += buyShares
 
 						t = Transaction(
@@ -1306,12 +1687,12 @@ class Portfolio:
 							Transaction.dividendReinvest,
 							amount,
 							shares = buyShares,
-							pricePerShare = val["close"],
+							pricePerShare = val,
 							auto = True)
 						t.save(self.db)
 						transactionId += 1
 					
-					newValue += shares[ticker] * val["close"]
+					newValue += shares[ticker] * val
 					doNewValue = True
 				if doNewValue:
 					value = newValue + cash
@@ -1328,7 +1709,7 @@ class Portfolio:
 					for ticker in positions:
 						if ticker not in stockVal:
 							continue
-						close = stockVal[ticker]["close"]
+						close = stockVal[ticker]
 						if close <= 0:
 							continue
 							
@@ -1353,7 +1734,7 @@ class Portfolio:
 					for ticker in positions:
 						if ticker not in stockVal:
 							continue
-						close = stockVal[ticker]["close"]
+						close = stockVal[ticker]
 						if close <= 0:
 							continue
 							
@@ -1408,7 +1789,7 @@ class Portfolio:
 
 		# Read transactions from subPorts and insert into this portfolio
 		for portName in subPorts:
-			sp = Portfolio(portName)
+			sp = getPortfolio(portName)
 			res = sp.db.select('transactions', where = {'deleted': 'False'})
 			for t in res.fetchall():
 				t["edited"] = False
@@ -1666,15 +2047,24 @@ class Portfolio:
 				
 				dividendIndex += 1
 
+	def beginRebuild(self, description, update = False):
+		"""Only allow one thread to update a portfolio at a time.  Other threads wait to read this portfolio until endRebuild."""
+		appGlobal.getApp().beginBigTask(description, update)
+		self.lock.acquire()
+	
+	def endRebuild(self):
+		self.lock.release()
+		appGlobal.getApp().endBigTask()
+	
 	def rebuildBankPositionHistory(self, update = False):
-		# Only allow one thread to update a portfolio at a time
-		appGlobal.getApp().beginBigTask('rebuilding ' + self.name, update)
+		self.beginRebuild('rebuilding ' + self.name, update)
 		
 		self.db.beginTransaction()
 		try:
-			# Delete auto transactions and position history
+			# Delete auto transactions
+			# Position history is replaced when finished
 			self.db.delete("transactions", {"auto": "True"})
-			self.db.delete("positionHistory")
+			self.beginHistoryStaging()
 			
 			self.readFromDb()
 
@@ -1686,7 +2076,7 @@ class Portfolio:
 			portfolioFirstDate = self.getStartDate()
 			if not portfolioFirstDate:
 				self.db.rollbackTransaction()
-				appGlobal.getApp().endBigTask()
+				self.endRebuild()
 				return
 			
 			# cashToAdd[date] = deposit amount
@@ -1772,391 +2162,157 @@ class Portfolio:
 
 						currentTrans += 1
 
-					self.db.insert("positionHistory", {
-						"date": date.strftime("%Y-%m-%d 00:00:00"),
-						"ticker": ticker,
-						"shares": value,
-						"options": 0,
-						"value": value,
-						"normSplit": 1,
-						"normDividend": normDividend,
-						"normFee": normFee,
-						"profitSplit": 0,
-						"profitDividend": profitDividend,
-						"profitFee": profitFee})
+					self.stageHistory((
+						date.strftime("%Y-%m-%d 00:00:00"),
+						ticker,
+						value,
+						0,
+						value,
+						1,
+						normDividend,
+						normFee,
+						0,
+						profitDividend,
+						profitFee))
 
 					date += datetime.timedelta(1)
 			
 			# The cash position is the combined position
-			query = "insert into positionHistory (date, ticker, shares, options, value, normSplit, normDividend, normFee, profitSplit, profitDividend, profitFee) select date, '__COMBINED__', shares, options, value, normSplit, normDividend, normFee, profitSplit, profitDividend, profitFee from positionHistory where ticker='__CASH__'"
+			self.flushHistory()
+			query = "insert into positionHistoryStaging (date, ticker, shares, options, value, normSplit, normDividend, normFee, profitSplit, profitDividend, profitFee) select date, '__COMBINED__', shares, options, value, normSplit, normDividend, normFee, profitSplit, profitDividend, profitFee from positionHistoryStaging where ticker='__CASH__'"
 			self.db.query(query)
+			self.commitHistoryStaging()
 		except Exception:
 			self.db.rollbackTransaction()
 			if update:
 				update.addException()
 				update.setFinished()
 			else:
+				self.endRebuild()
 				raise
 		
 		self.db.commitTransaction()
-		appGlobal.getApp().endBigTask()
-
-	def rebuildPositionHistory(self, stockData, update = False):
-		# TODO: do not combine individual days
-		def addToBasis(ticker, d, s, pps):
-			if ticker not in basis:
-				basis[ticker] = {}
-			if d in basis[ticker]:
-				# Update basis for this day
-				(oldShares, oldPricePerShare) = basis[ticker][d]
-				newShares = s + oldShares
-				if newShares == 0:
-					self.db.rollbackTransaction()
-					appGlobal.getApp().endBigTask()
-					raise Exception("Added shares to 0")
-				newPricePerShare = (oldShares * oldPricePerShare + s * pps) / newShares
-				basis[ticker][d] = (newShares, newPricePerShare)
-			else:
-				basis[ticker][d] = (s, pps)
-		
-			# Update combined basis
-			d = datetime.datetime(d.year, d.month, d.day)
-			if not d in combinedBasis:
-				combinedBasis[d] = 0.0
-			combinedBasis[d] += abs(s * pps)
-		
-		def getShares(ticker):
-			if not ticker in basis:
-				return 0
-			
-			s = 0
-			for d in basis[ticker]:
-				s += basis[ticker][d][0]
-			return s
-		
-		def getBasis(ticker, update = False, shareCount = False):
-			if not ticker in basis:
-				return 0
-		
-			basisVal = 0
-			basisShares = 0
-			if shareCount:
-				# Use up all shares in shareCount
-				for d in basis[ticker]:
-					(s, pps) = basis[ticker][d]
-					if s > shareCount:
-						basisVal += shareCount * pps
-						basisShares += shareCount
-						shareCount -= shareCount
-						break
-					else:
-						basisVal += s * pps
-						basisShares += s
-						shareCount -= s
-				if update and shareCount > 0:
-					update.addError("Invalid share count for " + ticker)
-			else:
-				# Compute over all shares
-				for d in basis[ticker]:
-					(s, pps) = basis[ticker][d]
-					basisVal += s * pps
-					basisShares += s
-			
-			if basisShares == 0:
-				return 0
-			else:
-				return basisVal / basisShares
-
-		def getBasisValue(ticker):
-			if not ticker in basis:
-				return 0
+		self.endRebuild()
+
+	def replayPositions(self, levels, getJob, stockData, update = False):
+		"""Replay positions one level of the dependency graph at a time.
+		getJob(ticker) returns the job of a position, or False to skip it, when its level is replayed.
+		Positions in a level are independent and are replayed by positionReplay.pool if it was started.
+		Yield (job, result) as each position finishes."""
+		# Ticker changes need the position of the original ticker the day before
+		# Key is (ticker, date string)
+		originals = {}
+		for t in self.getTransactions(transType = Transaction.tickerChange):
+			originals[t.ticker] = True
+		positions = {}
 		
-			val = 0
-			# Compute over all shares
-			for d in basis[ticker]:
-				(s, pps) = basis[ticker][d]
-				val += s * pps
-			
-			return val
-
-		def removeFromBasis(ticker, remove):
-			while ticker in basis and len(basis[ticker]) > 0 and abs(remove) > 0:
-				(s, pricePerShare) = basis[ticker][basis[ticker].keys()[0]]
-				if abs(s) > abs(remove):
-					basis[ticker][basis[ticker].keys()[0]] = (s - remove, pricePerShare)
-					remove = 0
-
-					# Update combined basis
-					d = datetime.datetime(t.date.year, t.date.month, t.date.day)
-					if not d in combinedBasis:
-						combinedBasis[d] = 0.0
-					else:
-						combinedBasis[d] -= abs(remove * pricePerShare)
-				else:
-					del basis[ticker][basis[ticker].keys()[0]]
-					remove -= s
-
-					# Update combined basis
-					d = datetime.datetime(t.date.year, t.date.month, t.date.day)
-					if not d in combinedBasis:
-						combinedBasis[d] = 0.0
-					else:
-						combinedBasis[d] -= abs(s * pricePerShare)
-			if abs(remove) > 1.0e-6:
-				if update:
-					if ticker in basis:
-						update.addError("Could not finish basis for %s %s %s" % (ticker, remove, basis[ticker]))
-					else:
-						update.addError("Could not finish basis for %s %s (no basis)" % (ticker, remove))
-			
-		def adjustBasisStockDividend(ticker, adjustShares):
-			"""Add or remove shares from basis"""
-			shares = getShares(ticker)
-			if shares == 0:
-				if update:
-					update.addError("Split but zero shares for " + ticker)
-				return
-			shareFactor = (shares + adjustShares) / shares
-			if shareFactor == 0:
-				if update:
-					update.addError("Split to zero shares for " + ticker)
-				return
-			
-			for d in basis[ticker]:
-				(s, pps) = basis[ticker][d]
-				basis[ticker][d] = (s * shareFactor, pps / shareFactor)
-		
-		def adjustBasisValue(ticker, percent):
-			"""Modify basis value by percent"""
-			for d in basis[ticker]:
-				(s, pps) = basis[ticker][d]
-				basis[ticker][d] = (s, pps * percent)
-		
-		def dumpOptionsBasis():
-			print "options dump"
-			for d in longOptionsBasis:
-				for i in range(len(longOptionsBasis[d])):
-					(ignoreTicker, s, pps, strike, expire) = longOptionsBasis[d][i]
-					print "long ", ignoreTicker, s, strike, expire, "pps", pps
-			for d in shortOptionsBasis:
-				for i in range(len(shortOptionsBasis[d])):
-					(ignoreTicker, s, pps, strike, expire) = shortOptionsBasis[d][i]
-					print "short", ignoreTicker, s, strike, expire, "pps", pps
-
-		# TODO: do not combine individual days
-		def addToOptionsBasis(ticker, d, s, pps, strike, expire):
-			# Decide whether short or long
-			if s > 0:
-				b = longOptionsBasis
-			else:
-				b = shortOptionsBasis
-			
-			if d in b:
-				# Update basis for this day
-				b[d].append((ticker, s, pps, strike, expire))
-			else:
-				b[d] = [(ticker, s, pps, strike, expire)]
+		numTickers = 0
+		for level in levels:
+			numTickers += len(level)
 		
-			# Update combined basis
-			# TODO: Should this be done?
-			d = datetime.datetime(d.year, d.month, d.day)
-			if not d in combinedBasis:
-				combinedBasis[d] = 0.0
-			combinedBasis[d] += abs(s * pps)
-		
-		def getOptionsShares(ticker):
-			s = 0
-			for d in longOptionsBasis:
-				for i in range(len(longOptionsBasis[d])):
-					s += longOptionsBasis[d][i][1]
-			for d in shortOptionsBasis:
-				for i in range(len(shortOptionsBasis[d])):
-					s += abs(shortOptionsBasis[d][i][1])
-			return s
-		
-		def getOptionsBasis(ticker, update = False):
-			basisVal = 0
-			basisShares = 0
-			# Compute over all shares
-			for d in longOptionsBasis:
-				for i in range(len(longOptionsBasis[d])):
-					(ignoreTicker, s, pps, strike, expire) = longOptionsBasis[d][i]
-					basisVal += s * pps
-					basisShares += s
-			for d in shortOptionsBasis:
-				for i in range(len(shortOptionsBasis[d])):
-					(ignoreTicker, s, pps, strike, expire) = shortOptionsBasis[d][i]
-					basisVal += s * pps
-					basisShares += s
-			
-			if basisShares == 0:
-				return 0
-			else:
-				return basisVal / basisShares
-
-		def getOptionsBasisValue(ticker, update = False):
-			basisVal = 0
-			# Compute over all shares
-			for d in longOptionsBasis:
-				for i in range(len(longOptionsBasis[d])):
-					(ignoreTicker, s, pps, strike, expire) = longOptionsBasis[d][i]
-					basisVal += s * pps
-			for d in shortOptionsBasis:
-				for i in range(len(shortOptionsBasis[d])):
-					(ignoreTicker, s, pps, strike, expire) = shortOptionsBasis[d][i]
-					basisVal += s * pps
-			
-			return basisVal
-		
-		def getOptionsValue(ticker):
-			value = 0.0
-			
-			for d in longOptionsBasis:
-				for i in range(len(longOptionsBasis[d])):
-					(optionTicker, s, pps, strike, expire) = longOptionsBasis[d][i]
-					
-					# TODO: Determine price for this option
-					price = pps
-					
-					value += s * price
-
-			for d in shortOptionsBasis:
-				for i in range(len(shortOptionsBasis[d])):
-					(optionTicker, s, pps, strike, expire) = shortOptionsBasis[d][i]
-
-					# TODO: Determine price for this option
-					price = pps
-
-					value += (pps - price) * s
-			
-			return value
-		
-		def getSpecificOptionsBasis(optionStrike, optionExpire):
-			basisVal = 0
-			basisShares = 0
-			# Compute over matching shares
-			for d in longOptionsBasis:
-				for i in range(len(longOptionsBasis[d])):
-					(ignoreTicker, s, pps, strike, expire) = longOptionsBasis[d][i]
-					if strike == optionStrike and expire == optionExpire:
-						basisVal += s * pps
-						basisShares += s
-			for d in shortOptionsBasis:
-				for i in range(len(shortOptionsBasis[d])):
-					(ignoreTicker, s, pps, strike, expire) = shortOptionsBasis[d][i]
-					if strike == optionStrike and expire == optionExpire:
-						basisVal += s * pps
-						basisShares += s
-			
-			if basisShares == 0:
-				return 0
-			else:
-				return basisVal / basisShares
-
-		def expireOptions(ticker, optionStrike, optionExpire, date):
-			for thisBasis in [longOptionsBasis, shortOptionsBasis]:
-				for d in thisBasis:
-					for i in range(len(thisBasis[d])):
-						(thisTicker, s, pps, strike, expire) = thisBasis[d][i]
-						if ticker.endswith("call"):
-							optionType = Transaction.optionCall
+		count = 0
+		for level in levels:
+			levelJobs = {}
+			for ticker in level:
+				job = getJob(ticker)
+				if not job:
+					count += 1
+					continue
+				
+				# Use positions replayed in earlier levels, otherwise the saved history
+				job["positions"] = {}
+				for t in job["transactions"]:
+					if t.type == Transaction.tickerChange and t.ticker2 == ticker and t.ticker != ticker:
+						key = (t.ticker, (t.date - datetime.timedelta(1)).strftime("%Y-%m-%d %H:%M:%S"))
+						if key in positions:
+							job["positions"][key] = positions[key]
 						else:
-							optionType = Transaction.optionPut
-						price = appGlobal.getApp().stockData.getOptionPrice(thisTicker, optionExpire, optionStrike, date, optionType)
-						if ticker == thisTicker and strike == optionStrike and expire == optionExpire:
-							if s < 0:
-								# Sell to open / buy to close
-								#twrr.removeShares(thisTicker + " shares", abs(s) * 100, optionStrike)
-								twrr.coverShares(thisTicker, abs(s), 0)
-							else:
-								# Buy to open / sell to close
-								#twrr.removeShares(thisTicker + " shares", abs(s) * 100, optionStrike)
-								twrr.removeShares(thisTicker, abs(s), 0)
-							removeFromOptionsBasis(thisTicker, s, strike, expire)
-
-		def checkOptionsExpiration(ticker, date):
-			# Return True if expired an option
-			expired = False
+							job["positions"][key] = self.getStagedPositionOnDate(t.ticker, t.date - datetime.timedelta(1))
+				levelJobs[ticker] = job
 			
-			for thisBasis in [longOptionsBasis, shortOptionsBasis]:
-				for d in thisBasis:
-					for i in range(len(thisBasis[d])):
-					#while i < len(thisBasis[d]):
-						(thisTicker, s, pps, strike, expire) = thisBasis[d][i]
-						# Expire 2 days after the friday
-						date2 = datetime.datetime(date.year, date.month, date.day)
-						expire2 = datetime.datetime(expire.year, expire.month, expire.day) + datetime.timedelta(days = 2)
-						if date2 >= expire2:
-							expired = True
-							expireOptions(ticker, strike, expire, date)
-							'''removeFromOptionsBasis(thisTicker, s, strike, expire)
-							if s > 0:
-								# Buy to open
-								twrr.removeShares(thisTicker, abs(s), 0)
-							elif s < 0:
-								# Sell to open
-								twrr.coverShares(thisTicker, abs(s) * 100, strike)
-								twrr.removeSharesNoPrice(thisTicker + "income", abs(s))'''
-			
-			return expired
-		
-		def removeFromOptionsBasis(ticker, remove, strike, expire):
-			if remove > 0:
-				thisBasis = longOptionsBasis
-			else:
-				thisBasis = shortOptionsBasis
+			# The pool is started once by the main thread, a fork here could copy locks held by other threads
+			pool = False
+			if len(levelJobs) > 1:
+				pool = positionReplay.pool
+			if pool:
+				results = pool.imap_unordered(positionReplay.replayInWorker, [levelJobs[ticker] for ticker in level if ticker in levelJobs])
 			
-			for d in thisBasis:
-				i = 0
-				while d in thisBasis and i < len(thisBasis[d]) and abs(remove) > 1.0e-6:
-					(optionTicker, s, pps, str, e) = thisBasis[d][i]
-					# Check for right ticker, strike price, expiration
-					if ticker != optionTicker or (str - strike) > 1.0e-6 or e != expire:
-						i += 1
-						continue
-					
-					if abs(s) > abs(remove):
-						thisBasis[d][i] = (ticker, s - remove, pps, str, e)
-						remove = 0
-	
-						# Update combined basis
-						upd = datetime.datetime(t.date.year, t.date.month, t.date.day)
-						if not upd in combinedBasis:
-							combinedBasis[upd] = 0.0
-						else:
-							combinedBasis[upd] -= abs(remove * pps)
-						i += 1
-					else:
-						# Remove all of basis
-						del thisBasis[d][i]
-						remove -= s
+			for ticker in level:
+				if not ticker in levelJobs:
+					continue
+				if pool:
+					# Wait for the next position, keep the application responsive
+					result = False
+					while not result:
+						if update:
+							update.appYield()
+							if update.canceled:
+								return
+						try:
+							result = results.next(0.1)
+						except multiprocessing.TimeoutError:
+							pass
+					job = levelJobs[result["ticker"]]
+					if update:
+						for (isError, message) in result["log"]:
+							if isError:
+								update.addError(message)
+							else:
+								update.addMessage(message)
+						update.setStatus("Rebuilt " + job["ticker"], 20 + 80 * count / numTickers)
+				else:
+					job = levelJobs[ticker]
+					if update:
+						update.setStatus("Rebuilding " + ticker, 20 + 80 * count / numTickers)
+						if update.canceled:
+							return
+					result = positionReplay.PositionReplay(job, stockData, update).run()
+				count += 1
+				
+				if job["ticker"] in originals:
+					for row in result["history"]:
+						positions[(row[1], row[0])] = {"shares": row[2], "value": row[4]}
+				
+				yield (job, result)
 	
-						# Update combined basis
-						upd = datetime.datetime(t.date.year, t.date.month, t.date.day)
-						if not remove in combinedBasis:
-							combinedBasis[upd] = 0.0
-						else:
-							combinedBasis[upd] -= abs(s * pps)
-			if abs(remove) > 1.0e-6:
-				if update:
-					update.addError("Could not finish options basis for %s remove %f strike %f expire %s" % (ticker, remove, strike, expire))
-		
+	def rebuildPositionHistory(self, stockData, update = False):
 		if self.isBank():
 			self.rebuildBankPositionHistory(update)
 			return
 
-		# Only allow one thread to update a portfolio at a time
-		appGlobal.getApp().beginBigTask('rebuilding a portfolio', update)
+		self.beginRebuild('rebuilding a portfolio', update)
 		
 		self.readFromDb()
-		stockData.updatePortfolioStocks(self, update)
+		newDates = {}
+		stockData.updatePortfolioStocks(self, update, newDates)
+		for (ticker, date) in newDates.items():
+			self.setStockDataDirty(date, ticker)
+		
+		# Resume positions from their checkpoints if only recent history is dirty
+		# If only some tickers are dirty the other positions are not replayed
+		resumeFrom = self.getIncrementalRebuildDate()
+		dirtyTickers = False
+		if resumeFrom:
+			dirtyTickers = self.portPrefs.getDirtyTickers()
+		
 		
 		# Begin update
 		self.db.beginTransaction()
 		try:
-			# Delete auto transactions and position history
-			self.db.delete("transactions", {"auto": "True"})
-			self.db.delete("positionHistory")
+			# Position history is built in a staging table and replaced when finished
+			# historyDeletes are the queries removing the history that is replaced
+			self.beginHistoryStaging()
+			if resumeFrom:
+				# Delete auto transactions that may change
+				# Position history is replaced from each position's checkpoint
+				self.db.query("delete from transactions where auto=? and date>=?", ("True", resumeFrom.strftime("%Y-%m-%d 00:00:00")))
+				historyDeletes = [("delete from positionHistory where ticker in ('__COMBINED__', '__BENCHMARK__')", ())]
+			else:
+				# Delete auto transactions and checkpoints
+				self.db.delete("transactions", {"auto": "True"})
+				self.db.delete("positionCheckpoint")
+				historyDeletes = False
+				self.keptHistory = False
 	
 			if self.isCombined():
 				self.rebuildCombinedTransactions(update)
@@ -2168,9 +2324,11 @@ class Portfolio:
 				if update:
 					update.addMessage("No transactions found")
 					update.setSubTask(100)
+				self.commitHistoryStaging(historyDeletes)
 				self.portPrefs.setDirty(False)
+				self.portPrefs.setLastRebuild()
 				self.db.commitTransaction()
-				appGlobal.getApp().endBigTask()
+				self.endRebuild()
 				return
 			
 			if self.isBenchmark():
@@ -2192,74 +2350,59 @@ class Portfolio:
 			portfolioFirstDate = self.getStartDate()
 			if not portfolioFirstDate:
 				self.db.rollbackTransaction()
-				appGlobal.getApp().endBigTask()
+				self.endRebuild()
 				return
 	
-			# Total combined value indexed by date
+			# Total combined value indexed by day ordinal
 			combinedValue = {}
-			
-			# Basis dictionary key is ticker, dictionary of date, content is list of (shares, price per share)
-			basis = {}
-	
-			# Total combined basis indexed by date
-			# First pass through = individual basis adjustments
-			combinedBasis = {}
 	
+			# Replay positions in dependency order
+			# The new ticker of a spinoff or ticker change is replayed after the original ticker
 			tickers = self.getTickers(includeAllocation = True)
-	
-			# Check for spinoffs or changeTickers.  Move these to back.  Check for situations like A->B, B->C, D->C
-			moveBack = {}
+			transactions = {}
 			for ticker in tickers:
-				transactions = self.getTransactions(ticker, ascending = True)
-				for t in transactions:
-					if t.type in [Transaction.spinoff, Transaction.tickerChange] and ticker == t.ticker2:
-						if not t.ticker2 in moveBack:
-							moveBack[t.ticker2] = []
-						moveBack[t.ticker2].append(t.ticker)
-			# Now do a weird kind of bubble sort putting each ticker behind each other one
-			# This is not perfect but it's pretty good
-			for ticker in tickers[:]:
-				if not ticker in moveBack:
-					continue
-				
-				# Keep moving back by one until it is behind everything it needs
-				moveIt = True
-				while moveIt:
-					# Check if don't need to move
-					numBefore = 0
-					for ticker2 in tickers:
-						if ticker == ticker2:
-							moveIt = numBefore != len(moveBack[ticker])
-							break
-						elif ticker2 in moveBack[ticker]:
-							numBefore += 1
-					
-					if moveIt:
-						# Move ticker back one
-						index = tickers.index(ticker)
-						tickers = tickers[:index] + [tickers[index + 1], ticker] + tickers[index + 2:]
+				transactions[ticker] = self.getTransactions(ticker, ascending = True)
+			deps = positionReplay.getDependencies(tickers, transactions)
+			levels = positionReplay.getLevels(tickers, deps)
+			tickers = [ticker for level in levels for ticker in level]
+			if dirtyTickers is not False:
+				dirtyTickers = positionReplay.getDirtyDates(tickers, deps, dirtyTickers)
+			basisMethod = self.portPrefs.getBasisMethod()
 			
 			# cashToAdd[date] = deposit amount
 			cashToAdd = {}
-	
-			count = 0
+			
+			# Add automatic transactions and find the checkpoint of each position
+			checkpoints = {}
+			cleanTickers = []
 			for ticker in tickers:
-				if update:
-					update.setStatus("Rebuilding " + ticker, 20 + 80 * count / len(tickers))
-					if update.canceled:
-						break
-				count += 1
+				if update and update.canceled:
+					break
 				
-				#if update:
-				#	if ticker == "__CASH__":
-				#		update.addMessage("Computing cash position")
-				#	else:
-				#		update.addMessage("Computing position " + ticker)
-				transactions = self.getTransactions(ticker, ascending = True)
+				# Find the checkpoint to resume this position from
+				# History after the checkpoint will be rebuilt
+				# Positions that are not dirty keep their history and are not replayed
+				checkpoint = False
+				if dirtyTickers is not False and not ticker in dirtyTickers:
+					cleanTickers.append(ticker)
+				else:
+					if resumeFrom:
+						if dirtyTickers:
+							checkpoint = self.getPositionCheckpoint(ticker, dirtyTickers[ticker])
+						else:
+							checkpoint = self.getPositionCheckpoint(ticker, resumeFrom)
+						if checkpoint:
+							checkpointStr = checkpoint[0].strftime("%Y-%m-%d 00:00:00")
+							historyDeletes.append(("delete from positionHistory where ticker=? and date>?", (ticker, checkpointStr)))
+							self.keptHistory[ticker] = checkpointStr
+							self.db.query("delete from positionCheckpoint where ticker=? and date>?", (ticker, checkpointStr))
+						else:
+							historyDeletes.append(("delete from positionHistory where ticker=?", (ticker,)))
+							self.keptHistory[ticker] = ""
+							self.db.delete("positionCheckpoint", {"ticker": ticker})
+					checkpoints[ticker] = checkpoint
 				
-				# Options basis key is date, content is list of (shares, price per share, strike, expire)
-				longOptionsBasis = {}
-				shortOptionsBasis = {}
+				transactions = self.getTransactions(ticker, ascending = True)
 				
 				if self.portPrefs.getAutoAdjust():
 					self.addPositionCheckTransactions(ticker, transactions, portfolioFirstDate, cashToAdd, update)
@@ -2306,436 +2449,69 @@ class Portfolio:
 						
 						# Re-read transactions from database
 						self.readFromDb()
-						transactions = self.getTransactions(ticker, ascending = True)
+			
+			# Positions that are not replayed still fill in the prices of their buys for cash and the combined position
+			for ticker in cleanTickers:
+				positionReplay.fillMissingPrices(ticker, self.getTransactions(ticker, ascending = True), stockData)
+				self.addHistoryValues(combinedValue, ticker)
+			
+			# Positions are replayed from the final transactions
+			# Jobs are created when their level is replayed, after the prices of earlier levels are filled in
+			def getJob(ticker):
+				if not ticker in checkpoints:
+					return False
+				transactions = self.getTransactions(ticker, ascending = True)
 				
 				# If no transactions for a stock, skip
 				# The cash position may have no transactions if all we have is a transfer in
 				if not transactions and ticker != "__CASH__":
 					if update:
 						update.addError("No transactions for " + ticker)
-					continue
-	
-				# Get stock data
+					return False
+				
 				if ticker == "__CASH__":
-					prices = {}
-					prices[0] = {}
-					prices[0]["close"] = 1.0
-					#for t in transactions:
-					#	print t
+					userPrices = []
 				else:
-					prices = stockData.getPrices(ticker, startDate = transactions[0].date)
-					optionPrices = {}
-					if not prices:
-						# No prices print error
-						if update:
-							firstStockDate = stockData.getFirstDate(ticker)
-							lastStockDate = stockData.getLastDate(ticker)
-							if firstStockDate and lastStockDate:
-								update.addError("No usable stock data found for %s.  Icarra has data for %s from %s to %s.  The first transaction for %s is on %s." % (ticker, ticker, firstStockDate.strftime("%m/%d/%Y"), lastStockDate.strftime("%m/%d/%Y"), ticker, transactions[0].formatDate()))
-							else:
-								update.addError("No stock data found for %s" % ticker)
-					self.addUserAndTransactionPrices(ticker, prices, optionPrices, transactions)
-					if not prices and not optionPrices:
-						# Still no data, ignore
-						continue
-	
-				# Loop through first date until now
-				currentTrans = 0
-				currentPrice = 0
-				# Begin on first transaction.  Always begin cash on portfolio first date.
-				if transactions and ticker != "__CASH__":
-					date = transactions[0].getDate()
-				else:
-					date = portfolioFirstDate
-				date = datetime.datetime(date.year, date.month, date.day, 23, 59, 59)
-				price = False
-				shares = 0.0
-				value = 0.0
-				adjustedValue = 0.0
-				totalFees = 0
-				totalDividends = 0
-				totalProfit = 0 # Profit after fees
-				yieldCount = 0
-				doneWithTicker = False
-				twrr = Twrr() # Time weighted rate of return
-				if ticker == "__CASH__":
-					twrr.addShares("__CASH__", 0, 1)
-				while date < now and not doneWithTicker:
-					yieldCount += 1
-					if yieldCount == 100:
-						yieldCount = 0
-						if update:
-							update.appYield()
-							if update.canceled:
-								break
-					totalTrans = 0
-					todayDividends = 0
-					twrr.beginTransactions()
-					while currentTrans < len(transactions) and transactions[currentTrans].getDate() <= date and not doneWithTicker:
-						t = transactions[currentTrans]
-						
-						# Check that first transaction is a buy or transferIn (if not cash), or a spinoff or tickerChange and we are ticker2
-						if currentTrans == 0 and ticker != "__CASH__":
-							if not t.type in [Transaction.buy, Transaction.short, Transaction.buyToOpen, Transaction.sellToOpen, Transaction.transferIn] and ((t.type != Transaction.spinoff and t.type != Transaction.tickerChange) or t.ticker2 != ticker):
-								if update:
-									update.addError("The first transaction for %s does not add to its shares.  Ignoring position." % ticker)
-								doneWithTicker = True
-								break
-						currentTrans += 1
-						totalTrans += 1
-	
-						if t.type == Transaction.deposit:
-							shares += t.getTotal()
-							twrr.addShares(ticker, t.getTotal(), 1)
-						elif t.type == Transaction.withdrawal:
-							shares += t.getTotal()
-							twrr.removeShares(ticker, -t.getTotal(), 1)
-						elif t.type == Transaction.buy or t.type == Transaction.transferIn:
-							# Lookup price if unavailable
-							if t.pricePerShare < 1.0e-6:
-								p = stockData.getNearestPrice(ticker, t.date)
-								if p:
-									t.pricePerShare = p["close"]
-									t.setTotal(t.pricePerShare * abs(t.shares) - t.getFee())
-								else:
-									if update:
-										update.addError("Buy transaction has no price per share %s" % t)
-									continue
-	
-							totalProfit -= abs(t.total)
-							twrr.addShares(t.formatTicker(), t.getShares(), t.pricePerShare)							
-
-							# Check for transfer in option
-							if t.isOption():
-								# Add to basis tracker
-								addToOptionsBasis(t.formatTicker(), t.date, t.shares, t.pricePerShare, t.optionStrike, t.optionExpire)
-							else:
-								shares += abs(t.shares)
-
-								# Add to basis tracker
-								addToBasis(ticker, t.date, t.shares, t.pricePerShare)
-						elif t.type == Transaction.sell:
-							if shares <= 0:
-								if update:
-									update.addError("Sell transaction but no shares %s" % t)
-								continue
-							shares -= abs(t.shares)
-							totalProfit += t.getTotal()
-							twrr.removeShares(ticker, t.getShares(), t.pricePerShare)
-							
-							# Remove t.shares from basis tracker
-							removeFromBasis(ticker, abs(t.shares))
-						elif t.type == Transaction.buyToOpen:
-							totalProfit -= abs(t.total)
-							# Use formatTicker() because it includes strike, option
-							#twrr.addShares(t.formatTicker() + " shares", t.getShares() * 100, t.optionStrike)
-							twrr.addShares(t.formatTicker(), t.getShares(), t.pricePerShare)
-							
-							# Add to basis tracker
-							addToOptionsBasis(t.formatTicker(), t.date, t.shares, t.pricePerShare, t.optionStrike, t.optionExpire)
-						elif t.type == Transaction.sellToClose:
-							totalProfit += t.getTotal()
-							#twrr.removeShares(t.formatTicker() + " shares", t.getShares() * 100, t.optionStrike)
-							twrr.removeShares(t.formatTicker(), t.getShares(), t.pricePerShare)
-							
-							# Remove t.shares from basis tracker
-							removeFromOptionsBasis(t.formatTicker(), abs(t.shares), t.optionStrike, t.optionExpire)
-						elif t.type == Transaction.short:
-							# Lookup price if unavailable
-							if not t.pricePerShare:
-								if update:
-									update.addError("Transaction has no price per share %s" % t)
-								continue
-	
-							# Shorts reduce shares and add to basis
-							shares -= abs(t.shares)
-							totalProfit += t.getTotal()
-							twrr.shortShares(ticker, t.getShares(), t.pricePerShare)
-							
-							# Add to basis tracker
-							addToBasis(ticker, t.date, -abs(t.shares), t.pricePerShare)
-						elif t.type == Transaction.cover:
-							if shares >= 0:
-								if update:
-									update.addError("Cover transaction but no shares %s" % t)
-								continue
-
-							# Cover adds to shares and removes from basis
-							shares += abs(t.shares)
-							twrr.coverShares(ticker, t.getShares(), t.pricePerShare)
-							
-							# Remove t.shares from basis tracker
-							totalProfit += t.getTotal()
-							removeFromBasis(ticker, -abs(t.shares))
-						elif t.type == Transaction.sellToOpen:
-							# Shorts reduce shares and add to basis
-							totalProfit += t.getTotal()
-							
-							# For sellToOpen we track 2 positions: One is exposure to the underlying stock,
-							# the other is the value of the options.  Assume 100 shares per option.
-							#twrr.addShares(t.formatTicker() + " shares", t.getShares() * 100, t.optionStrike)
-							twrr.shortShares(t.formatTicker(), t.getShares(), t.pricePerShare)
-							
-							# Add to basis tracker
-							addToOptionsBasis(t.formatTicker(), t.date, -abs(t.shares), t.pricePerShare, t.optionStrike, t.optionExpire)
-						elif t.type == Transaction.buyToClose:
-							#twrr.removeShares(t.formatTicker() + " shares", t.getShares() * 100, t.optionStrike)
-							twrr.coverShares(t.formatTicker(), t.getShares(), t.pricePerShare)
-							
-							# Remove t.shares from basis tracker
-							totalProfit += t.getTotal()
-							removeFromOptionsBasis(t.formatTicker(), -abs(t.shares), t.optionStrike, t.optionExpire)
-						elif t.type in [Transaction.assign, Transaction.exercise, Transaction.expire]:
-							expireOptions(t.formatTicker(), t.optionStrike, t.optionExpire, t.date)
-						elif t.type == Transaction.dividend:
-							todayDividends += t.getTotalIgnoreFee()
-							twrr.addDividend(t.getTotalIgnoreFee())
-							if ticker == "__CASH__":
-								twrr.addShares(ticker, t.getTotalIgnoreFee(), 1)
-							# Fee will be subtracted from todayDividends later
-							if t.getFee():
-								todayDividends += t.getFee()
-						elif t.type == Transaction.expense:
-							# Note: Fees for all transactions are handled somewhere else
-							# Here we only keep track of fees from the total
-							if t.total:
-								if t.fee:
-									thisFee = abs(t.total) - abs(t.fee)
-								else:
-									thisFee = abs(t.total)
-								totalFees += thisFee
-								totalProfit -= thisFee
-							else:
-								totalProfit -= t.getFee()
-						elif t.type == Transaction.dividendReinvest:
-							if t.pricePerShare < 1.0e-6:
-								if t.getTotalIgnoreFee() > 0 and t.shares > 0:
-									t.pricePerShare = t.getTotalIgnoreFee() / t.shares
-								else:
-									p = stockData.getNearestPrice(ticker, t.date)
-									if p:
-										t.pricePerShare = p["close"]
-									else:
-										if update:
-											update.addError("Dividend reinvest transaction has no price per share %s" % t)
-										continue
-							
-							# Add to today's dividends, but don't count as profit
-							# Because we are increasing share count
-							shares += abs(t.shares)
-							todayDividends += t.getTotalIgnoreFee()
-							totalProfit -= t.getTotalIgnoreFee()
-							twrr.addDividendReinvest(ticker, t.getShares(), t.pricePerShare)
-	
-							# Add to basis tracker
-							addToBasis(ticker, t.date, t.shares, t.pricePerShare)
-						elif t.type == Transaction.transferOut:
-							if t.pricePerShare < 1.0e-6:
-								if t.getTotalIgnoreFee() > 0:
-									t.pricePerShare = t.getTotalIgnoreFee() / t.shares
-								elif price:
-									# Use last price data
-									t.pricePerShare = price
-								else:
-									p = stockData.getNearestPrice(ticker, t.date)
-									if p:
-										t.pricePerShare = p["close"]
-									else:
-										if update:
-											update.addError("transaction has no price per share %s" % t)
-										continue
-							
-							totalProfit += t.getTotal()
-							twrr.removeShares(t.formatTicker(), t.getShares(), t.pricePerShare)
-
-							if t.isOption():
-								# Remove t.shares from basis tracker
-								removeFromOptionsBasis(t.formatTicker(), abs(t.shares), t.optionStrike, t.optionExpire)
-							else:
-								shares -= abs(t.shares)
-
-								# Remove t.shares from basis tracker
-								removeFromBasis(ticker, abs(t.shares))
-						elif t.type in [Transaction.stockDividend, Transaction.split]:
-							if t.type == Transaction.stockDividend:
-								adjustShares = t.shares
-							elif t.getTotal() > 0:
-								# A 2-1 split has a value of 2.0
-								adjustShares = math.floor(shares * (t.getTotal() - 1.0))
-							else:
-								raise Exception("Invalid split value for %s" % t)
-							shares += adjustShares
-							adjustBasisStockDividend(ticker, adjustShares)
-							
-							twrr.stockDividendShares(ticker, adjustShares)
-						elif t.type == Transaction.adjustment:
-							adjustedValue += t.getTotal()
-							twrr.addAdjustment(t.getTotal())
-						elif t.type == Transaction.spinoff:
-							# Determine price per share
-							if t.pricePerShare:
-								pps = t.pricePerShare
-							else:
-								if update:
-									update.addError("Transaction has no price per share: %s" % t)
-								continue
-	
-							# Dividend if ticker, buy if ticker2
-							if t.ticker == ticker:
-								spinoffValue = t.shares * pps
-								if value > 0:
-									basisValue = getBasisValue(ticker)
-									totalProfit += spinoffValue
-									twrr.adjustBasis(ticker, spinoffValue)
-									
-									# Adjust basis
-									percent = (basisValue - spinoffValue) / basisValue
-									if percent < 0:
-										percent = 0
-									if percent >= 0:
-										adjustBasisValue(ticker, percent)
-									elif update:
-										update.addError("adjust basis for spinoff, percent less than 0: %f - %f" % (basisValue, spinoffValue))
-							else:
-								shares += abs(t.shares)
-								totalProfit -= pps
-								twrr.addShares(ticker, t.getShares(), pps)
-								
-								# TODO: Handle for options?
-								addToBasis(ticker, t.date, t.shares, pps)
-						elif t.type == Transaction.tickerChange:
-							if ticker == t.ticker:
-								# Old ticker
-								# TODO: Handle for options?
-								removeFromBasis(ticker, shares)
-								shares = 0
-								
-								# Force exit from loop, this stock no longer exists
-								doneWithTicker = True
-							else:
-								# New ticker, get stock data of original ticker
-								if currentTrans != 1:
-									if update:
-										update.addMessage("The ticker change transaction from %s to %s is not the first transaction for %s." % (t.ticker, t.ticker2, t.ticker2))
-									continue
-								pos = self.getPositionOnDate(t.ticker, t.date - datetime.timedelta(1))
-								if not pos:
-									if update:
-										update.addMessage("The ticker change transaction from %s to %s does not have data" % (t.ticker, t.ticker2))
-									continue
-								
-								# Start calculating based off of the position data
-								# First use given transaction shares, if not, use position shares
-								if t.shares > 0:
-									shares = abs(t.shares)
-								elif pos["shares"] > 0:
-									shares = abs(pos["shares"])
-								if shares > 0:
-									pps = pos["value"] / shares
-									# TODO: Handle for options?
-									addToBasis(ticker, t.date, shares, pps)
-						elif update:
-							update.addError("Did not use transaction %s for rebuilding" % t)
-						
-						# Adjust for fee
-						if t.fee:
-							totalFees += t.fee
-						if t.getFee():
-							twrr.addFee(t.getFee())
-							if ticker == "__CASH__":
-								twrr.removeShares(ticker, t.getFee(), 1)
-								shares -= t.getFee()
-								value -= t.getFee()
-					
-					# Do not automatically expire options
-					expired = checkOptionsExpiration(ticker, date)
-					if expired:
-						totalTrans += 1
-					
-					# Build current value based on shares and price
-					if currentPrice < len(prices):
-						# Advance to next price if not cash
-						if ticker != "__CASH__":
-							while currentPrice < len(prices) - 1 and prices[currentPrice + 1]["date"] <= date:
-								currentPrice += 1
-
-						price = prices[currentPrice]["close"]
-						if ticker == "__CASH__":
-							value = shares
-						elif getShares(ticker) >= 0:
-							value = getShares(ticker) * price + adjustedValue
-						else:
-							# Short
-							value = (price - getBasis(ticker)) * getShares(ticker) + adjustedValue
-						
-						twrr.setValue(ticker, price)
-						
-						# Use yesterday's value or today's value if position was opened today
-						if todayDividends > 0:
-							totalProfit += todayDividends
-							totalDividends += todayDividends
-
-							if ticker == "__CASH__":
-								shares += todayDividends
-								value += todayDividends
-
-						# Adjust fee factor for fees today's fees
-						# Use today's value or yesterday's value if position was closed today
-					elif price:
-						# Use last price
-						value = getShares(ticker) * price + adjustedValue
-					else:
-						# No price
-						value = 0
-					
-					try:
-						twrr.endTransactions()
-					except Exception, e:
-						if update:
-							update.addException()
-						else:
-							raise
-
-					# Update value based on options
-					# TODO: Calculate value of options better!!!
-					optionsShares = getOptionsShares(ticker)
-					value += getOptionsValue(ticker)
-					
-					if ticker == "__CASH__":
-						profitFee = totalProfit
-					else:
-						profitFee = value + totalProfit
-					
-					profitDividend = profitFee + totalFees
-					profitSplit = profitDividend - totalDividends
-
-					if (abs(shares) + abs(getOptionsShares(ticker)) > 1.0e-6 or totalTrans > 0 or currentTrans < len(transactions) or ticker == "__CASH__") and not doneWithTicker:
-						self.db.insert("positionHistory", {
-							"date": date.strftime("%Y-%m-%d 00:00:00"),
-							"ticker": ticker,
-							"shares": getShares(ticker),
-							"options": getOptionsShares(ticker),
-							"value": value,
-							"normSplit": twrr.getReturnSplit(),
-							"normDividend": twrr.getReturnDiv(),
-							"normFee": twrr.getReturnFee(),
-							"profitSplit": profitSplit,
-							"profitDividend": profitDividend,
-							"profitFee": profitFee})
-	
-					d = datetime.datetime(date.year, date.month, date.day)				
+					userPrices = self.getUserPrices(ticker)
+				return {
+					"ticker": ticker,
+					"transactions": transactions,
+					"userPrices": userPrices,
+					"firstDate": portfolioFirstDate,
+					"now": now,
+					"checkpoint": checkpoints[ticker],
+					"basisMethod": basisMethod}
+			
+			for (job, result) in self.replayPositions(levels, getJob, stockData, update):
+				if result["skipped"]:
+					continue
+				ticker = job["ticker"]
+				
+				# Keep prices filled in by the replay for the combined position
+				for (i, pricePerShare, total) in result["prices"]:
+					job["transactions"][i].pricePerShare = pricePerShare
+					job["transactions"][i].total = total
+				
+				# Existing history before the checkpoint is part of the combined value
+				if job["checkpoint"]:
+					self.addHistoryValues(combinedValue, ticker, job["checkpoint"][0])
+				
+				for row in result["history"]:
+					self.stageHistory(row)
+				self.savePositionCheckpoints(ticker, result["checkpoints"])
+				for (d, value) in result["values"]:
 					if d in combinedValue:
 						combinedValue[d] += value
 					else:
 						combinedValue[d] = value
-	
-					date += datetime.timedelta(1)
 
 			# Now build combined position
 			if update:
 				update.addMessage("Computing combined portfolio")
-			allTransactions = self.getTransactions(ascending = True)
-			cashTransactions = self.getTransactions("__CASH__", ascending = True, buysToCash = False)
+			allTransactions = self.getTransactionTable()
+			cashTransactions = TransactionTable(self.getTransactions("__CASH__", ascending = True, buysToCash = False))
+			allDays = allTransactions.days
+			cashDays = cashTransactions.days
 			currentAllTrans = 0
 			currentCashTrans = 0
 			lastValue = 0.0
@@ -2748,43 +2524,45 @@ class Portfolio:
 			totalFees = 0
 			normFee = 1.0
 			normSplit = 1.0
-			dates = sorted(combinedValue.keys())
-			for date in dates:
-				endOfDay = datetime.datetime(date.year, date.month, date.day, 23, 59, 59)
-				value = combinedValue[date]
+			days = sorted(combinedValue.keys())
+			for day in days:
+				value = combinedValue[day]
 	
 				# Update deposited/withdrawn money
 				cashInToday = 0
 				todayDividends = 0
 				todayFees = 0
-				while currentCashTrans < len(cashTransactions) and cashTransactions[currentCashTrans].date <= endOfDay:
-					t = cashTransactions[currentCashTrans]
-					if t.type in [Transaction.deposit, Transaction.transferIn]:
-						cashIn += t.getTotal()
-						cashInToday += t.getTotal()
-					elif t.type in [Transaction.withdrawal, Transaction.transferOut]:
-						cashIn += t.getTotal()
-						cashInToday += t.getTotal()
-					elif t.type in [Transaction.dividend, Transaction.adjustment, Transaction.expense]:
+				while currentCashTrans < len(cashDays) and cashDays[currentCashTrans] <= day:
+					i = currentCashTrans
+					transType = cashTransactions.type[i]
+					if transType in [Transaction.deposit, Transaction.transferIn]:
+						cashIn += cashTransactions.netTotal[i]
+						cashInToday += cashTransactions.netTotal[i]
+					elif transType in [Transaction.withdrawal, Transaction.transferOut]:
+						cashIn += cashTransactions.netTotal[i]
+						cashInToday += cashTransactions.netTotal[i]
+					elif transType in [Transaction.dividend, Transaction.adjustment, Transaction.expense]:
 						# Dividends/adjustments are not cash in/out
 						pass
 					else:
-						cashIn -= abs(t.total)
-						cashInToday -= abs(t.total)
+						cashIn -= abs(cashTransactions.total[i])
+						cashInToday -= abs(cashTransactions.total[i])
 					currentCashTrans += 1
 				
 				# Update todayFees, todayDividends
-				while currentAllTrans < len(allTransactions) and allTransactions[currentAllTrans].date <= endOfDay:
-					t = allTransactions[currentAllTrans]
-					if t.type == Transaction.expense:
-						todayFees += abs(t.total) + abs(t.fee)
-					elif t.fee and value > 0:
-						todayFees += abs(t.fee)
+				while currentAllTrans < len(allDays) and allDays[currentAllTrans] <= day:
+					i = currentAllTrans
+					transType = allTransactions.type[i]
+					fee = allTransactions.fee[i]
+					if transType == Transaction.expense:
+						todayFees += abs(allTransactions.total[i]) + abs(fee)
+					elif fee and value > 0:
+						todayFees += abs(fee)
 					
-					if t.type in [Transaction.dividend, Transaction.dividendReinvest] and value > 0:
-						todayDividends += abs(t.total)
-						if t.fee:
-							todayDividends += abs(t.fee)
+					if transType in [Transaction.dividend, Transaction.dividendReinvest] and value > 0:
+						todayDividends += abs(allTransactions.total[i])
+						if fee:
+							todayDividends += abs(fee)
 					
 					currentAllTrans += 1
 
@@ -2852,17 +2630,18 @@ class Portfolio:
 				profitDividend = profitFee + totalFees
 				profitSplit = profitDividend - totalDividends
 				
-				self.db.insert("positionHistory", {
-					"date": date.strftime("%Y-%m-%d 00:00:00"),
-					"ticker": "__COMBINED__",
-					"shares": value,
-					"value": value,
-					"normSplit": normSplit,
-					"normDividend": normDividend,
-					"normFee": normFee,
-					"profitSplit": profitSplit,
-					"profitDividend": profitDividend,
-					"profitFee": profitFee})
+				self.stageHistory((
+					positionReplay.dayToStr(day),
+					"__COMBINED__",
+					value,
+					None,
+					value,
+					normSplit,
+					normDividend,
+					normFee,
+					profitSplit,
+					profitDividend,
+					profitFee))
 				
 				lastValue = value
 			
@@ -2870,70 +2649,75 @@ class Portfolio:
 			if update:
 				update.addMessage("Computing benchmark")
 			currentCashTrans = 0
-			dates = sorted(combinedValue.keys())
 			first = True
 			if not self.isBenchmark():
-				benchmark = Portfolio(self.getBenchmark())
+				benchmark = benchmarkCache.getHistory(self.getBenchmark())
 
 				benchmarkShares = 0
 				totalCashIn = 0
-				benchmarkValues = benchmark.getPositionHistory("__COMBINED__")
-				for date in dates:
-					endOfDay = datetime.datetime(date.year, date.month, date.day, 23, 59, 59)
-					
+				for day in days:
 					# Update deposited/withdrawn money
 					cashInToday = 0
-					while currentCashTrans < len(cashTransactions) and cashTransactions[currentCashTrans].date <= endOfDay:
-						t = cashTransactions[currentCashTrans]
-						if t.type in [Transaction.deposit, Transaction.transferIn]:
-							cashInToday += abs(t.total)
-						elif t.type in [Transaction.withdrawal, Transaction.transferOut]:
-							cashInToday -= abs(t.total)
-						elif t.type in [Transaction.dividend, Transaction.adjustment, Transaction.expense]:
+					while currentCashTrans < len(cashDays) and cashDays[currentCashTrans] <= day:
+						transType = cashTransactions.type[currentCashTrans]
+						total = abs(cashTransactions.total[currentCashTrans])
+						if transType in [Transaction.deposit, Transaction.transferIn]:
+							cashInToday += total
+						elif transType in [Transaction.withdrawal, Transaction.transferOut]:
+							cashInToday -= total
+						elif transType in [Transaction.dividend, Transaction.adjustment, Transaction.expense]:
 							# Dividends/adjustments are not cash in/out
 							pass
 						else:
-							cashIn -= abs(t.total)
+							cashIn -= total
 						currentCashTrans += 1
 					
 					# Buy or sell shares
+					i = benchmark.find(day)
 					if cashInToday != 0:
 						totalCashIn += cashInToday
-						if date in benchmarkValues and benchmarkValues[date]['value'] != 0:
-							benchmarkShares += cashInToday / benchmarkValues[date]['value']
+						if i != -1 and benchmark.value[i] != 0:
+							benchmarkShares += cashInToday / benchmark.value[i]
 					
 					# Update values
-					if date in benchmarkValues:
-						value = benchmarkShares * benchmarkValues[date]['value']
+					if i != -1:
+						value = benchmarkShares * benchmark.value[i]
 						
 						if first:
 							first = False
-							firstNormSplit = benchmarkValues[date]['normSplit']
-							firstNormDividend = benchmarkValues[date]['normDividend']
-							firstNormFee = benchmarkValues[date]['normFee']
-
-						self.db.insert("positionHistory", {
-							"date": date.strftime("%Y-%m-%d 00:00:00"),
-							"ticker": "__BENCHMARK__",
-							"shares": benchmarkShares,
-							"value": value,
-							"normSplit": benchmarkValues[date]['normSplit'] / firstNormSplit,
-							"normDividend": benchmarkValues[date]['normDividend'] / firstNormDividend,
-							"normFee": benchmarkValues[date]['normFee'] / firstNormFee,
-							"profitSplit": value - totalCashIn,
-							"profitDividend": value - totalCashIn,
-							"profitFee": value - totalCashIn})
-
+							firstNormSplit = benchmark.normSplit[i]
+							firstNormDividend = benchmark.normDividend[i]
+							firstNormFee = benchmark.normFee[i]
+
+						self.stageHistory((
+							positionReplay.dayToStr(day),
+							"__BENCHMARK__",
+							benchmarkShares,
+							None,
+							value,
+							benchmark.normSplit[i] / firstNormSplit,
+							benchmark.normDividend[i] / firstNormDividend,
+							benchmark.normFee[i] / firstNormFee,
+							value - totalCashIn,
+							value - totalCashIn,
+							value - totalCashIn))
+
+			self.commitHistoryStaging(historyDeletes)
 			self.portPrefs.setDirty(False)
+			self.portPrefs.setLastRebuild()
 			self.db.commitTransaction()
-			appGlobal.getApp().endBigTask()
+			
+			# Combined portfolios use the tickers of their components
+			if not self.isCombined():
+				appGlobal.getApp().prefs.setPortfolioTickers(self.name, tickers)
+			self.endRebuild()
 			if update:
 				update.finishSubTask("Finished rebuilding " + self.name)
 		except Exception:
 			# An error occurred.  Rollback this update.
 			if self.db.inTransaction():
 				self.db.rollbackTransaction()
-			appGlobal.getApp().endBigTask()
+			self.endRebuild()
 			if update:
 				update.addException()
 				update.setFinished()
@@ -3243,19 +3027,23 @@ class Portfolio:
 		# Benchmark's don't have benchmarks
 		if doBenchmark:
 			if self.isBenchmark():
-				benchmark = self
+				benchmarkName = self.name
 			else:
-				benchmark = Portfolio(self.getBenchmark())
+				benchmarkName = self.getBenchmark()
 	
 			# Rebuild benchmark if dirty and if auto rebuilding is not enabled
-			if benchmark and benchmark.portPrefs.getDirty() and not appGlobal.getApp().prefs.getBackgroundRebuild():
-				benchmark.rebuildPositionHistory(stockData)
-			if benchmark:
-				benchmarkHistory = benchmark.getPositionHistory("__COMBINED__", startDate)
-				benchmarkKeys = sorted(benchmarkHistory.keys())
+			if not appGlobal.getApp().prefs.getBackgroundRebuild():
+				if self.isBenchmark():
+					benchmark = self
+				else:
+					benchmark = getPortfolio(benchmarkName)
+				if benchmark.portPrefs.getDirty():
+					benchmark.rebuildPositionHistory(stockData)
+			benchmarkHistory = benchmarkCache.getHistory(benchmarkName)
+			benchmarkKeys = benchmarkHistory.getIndexes(startDate)
 	
 			# Check for empty benchmark
-			if benchmark and len(benchmarkKeys) == 0:
+			if len(benchmarkKeys) == 0:
 				return
 		
 		if chartType in ["total value", "profit", "transactions", "spending", "monthly spending"]:
@@ -3570,14 +3358,14 @@ class Portfolio:
 					for t in transactions:
                                         	# Non cash buys and sells
                                         	if t.type in [Transaction.buy, Transaction.buyToOpen, Transaction.cover, Transaction.buyToClose, Transaction.transferIn]:
-                                                	t2 = copy.deepcopy(t)
+                                                	t2 = t.copy()
                                                 	t2.ticker = "__CASH__"
                                                 	t2.fee = 0.0
                                                 	t2.type = Transaction.deposit
                                                 	t2.total = t.getCashMod()
 							moneyIn.append(t2)
                                         	elif t.type in [Transaction.sell, Transaction.sellToOpen, Transaction.short, Transaction.sellToClose, Transaction.transferOut]:
-                                                	t2 = copy.deepcopy(t)
+                                                	t2 = t.copy()
                                                 	t2.ticker = "__CASH__"
                                                 	t2.fee = 0.0
                                                 	t2.type = Transaction.withdrawal
@@ -3592,37 +3380,38 @@ class Portfolio:
 			pricesX = []
 			pricesY = []
 			if chartType == "transactions":
-				norm = veryFirstValue / benchmarkHistory[benchmarkKeys[0]]["normSplit"]
-				for p in benchmarkKeys:
-					value = norm * benchmarkHistory[p]["normSplit"]
-					pricesX.append(p)
+				norm = veryFirstValue / benchmarkHistory.normSplit[benchmarkKeys[0]]
+				for i in benchmarkKeys:
+					value = norm * benchmarkHistory.normSplit[i]
+					pricesX.append(benchmarkHistory.getDate(i))
 					pricesY.append(value)
 			elif chartType in ["profit", "value"]:
 				# Determine profit based on shares purchased
 				cashIn = 0
 				shares = 0
 				first = True
-				for p in benchmarkKeys:
+				for i in benchmarkKeys:
+					p = benchmarkHistory.getDate(i)
 					# Buy/sell benchmark
 					endOfDay = datetime.datetime(p.year, p.month, p.day, 23, 59, 59)
 					while moneyInIndex < len(moneyIn) and moneyIn[moneyInIndex].date <= endOfDay:
 						cashIn += abs(moneyIn[moneyInIndex].getTotalIgnoreFee())
-						shares += abs(moneyIn[moneyInIndex].getTotalIgnoreFee()) / benchmarkHistory[p]["value"]
+						shares += abs(moneyIn[moneyInIndex].getTotalIgnoreFee()) / benchmarkHistory.value[i]
 						moneyInIndex += 1
 					while moneyOutIndex < len(moneyOut) and moneyOut[moneyOutIndex].date <= endOfDay:
 						cashIn -= abs(moneyOut[moneyOutIndex].getTotalIgnoreFee())
-						shares -= abs(moneyOut[moneyOutIndex].getTotalIgnoreFee()) / benchmarkHistory[p]["value"]
+						shares -= abs(moneyOut[moneyOutIndex].getTotalIgnoreFee()) / benchmarkHistory.value[i]
 						moneyOutIndex += 1
 					
 					# If first value, buy enough benchmark to match starting value
 					if first and not isInception:
 						cashIn = veryFirstValue
-						shares = veryFirstValue / benchmarkHistory[p]["value"]
+						shares = veryFirstValue / benchmarkHistory.value[i]
 						first = False
 
 					# Calculate value.  Subtract of cashIn for profit.
 					if moneyInIndex > 0 or moneyOutIndex > 0:
-						value = shares * benchmarkHistory[p]["value"]
+						value = shares * benchmarkHistory.value[i]
 						if chartType == "profit":
 							value -= cashIn
 						pricesX.append(p)
@@ -3630,24 +3419,24 @@ class Portfolio:
 			else:
 				# Determine benchmark normalization
 				firstValue = False
-				for p in benchmarkKeys:
-					if p < normDate:
+				for i in benchmarkKeys:
+					if benchmarkHistory.getDate(i) < normDate:
 						continue
 					
-					firstValue = 1.0 / benchmarkHistory[p]["normDividend"]
+					firstValue = 1.0 / benchmarkHistory.normDividend[i]
 					break
 	
 				# Add based on normalized value
-				for p in benchmarkKeys:
-					price = benchmarkHistory[p]["normDividend"]
+				for i in benchmarkKeys:
+					price = benchmarkHistory.normDividend[i]
 					
 					if firstValue:
-						pricesX.append(p)
+						pricesX.append(benchmarkHistory.getDate(i))
 						pricesY.append(price * firstValue - 1)
 
 			# Add data points for combined
 			if pricesX and pricesY:
-				chartBase.addXY(pricesX, pricesY, benchmark.name, (0.5, 0.5, 0.5))
+				chartBase.addXY(pricesX, pricesY, benchmarkName, (0.5, 0.5, 0.5))
 
 	def getPerformanceTable(self, doCurrent = True, doDividend = True, type = "performance"):
 		tickers = self.getTickers()
@@ -3674,13 +3463,16 @@ class Portfolio:
 		rowMap = {}
 		performance = {}
 		
+		# Internal rates of return are solved together after all positions are read
+		irrPending = []
+		
 		# Iterate through copy of tickers, incase elements re removed
+		firstLasts = self.getPositionsFirstLast()
 		for t in copy.copy(tickers):
-			firstLast = self.getPositionFirstLast(t)
-			if not firstLast:
+			if not t in firstLasts:
 				tickers.remove(t)
 				continue
-			(first, last) = firstLast
+			(first, last) = firstLasts[t]
 			
 			# Check that the position is current
 			if last != lastDay and doCurrent:
@@ -3689,42 +3481,44 @@ class Portfolio:
 
 			performance[t] = {}
 			
+			# Use time weighted returns for cash
+			useIRR = type == "return (internal)" and t != "__CASH__"
 			if type == "profit":
 				performanceFunc = self.calculatePerformanceProfit
 			elif type == "total value":
 				performanceFunc = self.calculatePerformanceValue
-			elif type == "return (internal)" and t != "__CASH__":
-				# Use time weighted returns for cash
-				performanceFunc = self.calculatePerformanceIRR
 			else:
 				performanceFunc = self.calculatePerformanceTimeWeighted
 			
-			# Compute YTD return
-			(ret, years) = performanceFunc(t, firstDayOfYear, last, dividend = doDividend)
-			performance[t][firstDayOfYear] = (ret, years)
+			# Read position history on every period boundary at once
+			# Key is column, value is (first date, isInception)
+			periods = {
+				firstDayOfYear: (firstDayOfYear, False),
+				oneYear: (oneYear, False),
+				twoYear: (twoYear, False),
+				threeYear: (threeYear, False),
+				fiveYear: (fiveYear, False),
+				lastDay: (first, True)}
+			positions = self.getPositionsOnDates(t, [firstDayOfYear, oneYear, twoYear, threeYear, fiveYear, first, last])
+			if useIRR:
+				transactions = self.getIRRTransactions(t)
 			
-			# Compute year return
-			(ret, years) = performanceFunc(t, oneYear, last, dividend = doDividend)
-			performance[t][oneYear] = (ret, years)
-
-			# Compute two year return
-			(ret, years) = performanceFunc(t, twoYear, last, dividend = doDividend)
-			performance[t][twoYear] = (ret, years)
-
-			# Compute three year return
-			(ret, years) = performanceFunc(t, threeYear, last, dividend = doDividend)
-			performance[t][threeYear] = (ret, years)
-
-			# Compute five year return
-			(ret, years) = performanceFunc(t, fiveYear, last, dividend = doDividend)
-			performance[t][fiveYear] = (ret, years)
-
-			# Compute inception return
-			(ret, years) = performanceFunc(t, first, last, dividend = doDividend, isInception = True)
-			performance[t][lastDay] = (ret, years)
+			for (col, (periodFirst, isInception)) in periods.items():
+				if useIRR:
+					(dates, inflows, years) = self.getIRRCashFlows(t, periodFirst, last, isInception, positions, transactions)
+					performance[t][col] = ("n/a", years)
+					if dates:
+						irrPending.append((t, col, periodFirst, last, years, dates, inflows))
+				else:
+					performance[t][col] = performanceFunc(t, periodFirst, last, dividend = doDividend, isInception = isInception, positions = positions)
 			
 			row += 1
 		
+		rates = irr.irrBatch([(dates, inflows) for (t, col, periodFirst, last, years, dates, inflows) in irrPending])
+		for i in range(len(irrPending)):
+			(t, col, periodFirst, last, years, dates, inflows) = irrPending[i]
+			performance[t][col] = self.formatIRR(rates[i], periodFirst, last, years)
+		
 		# Check active columns, always include last day
 		activeCols = {lastDay: True}
 		for t in performance:
@@ -4212,11 +4006,53 @@ class Portfolio:
 		
 		return errors
 
+class PortfolioRegistry:
+	"""One shared Portfolio per name for the process, opened the first time it is used.
+	Portfolios are refreshed when handed out so their transactions are current.
+	Threads sharing a portfolio read and rebuild it one at a time, see Portfolio.lock."""
+	def __init__(self):
+		self.portfolios = {}
+		self.lock = threading.Lock()
+	
+	def getPortfolio(self, name):
+		self.lock.acquire()
+		try:
+			p = self.portfolios.get(name)
+			if not p:
+				p = Portfolio(name)
+				self.portfolios[name] = p
+		finally:
+			self.lock.release()
+		p.refresh()
+		return p
+	
+	def closePortfolio(self, name):
+		"""Close and forget a portfolio before it is renamed or deleted"""
+		self.lock.acquire()
+		try:
+			p = self.portfolios.pop(name, False)
+		finally:
+			self.lock.release()
+		if p:
+			p.close()
+		benchmarkCache.close(name)
+
+global registry
+registry = PortfolioRegistry()
+
+def getPortfolio(name):
+	global registry
+	return registry.getPortfolio(name)
+
+def closePortfolio(name):
+	global registry
+	registry.closePortfolio(name)
+
 def checkBenchmarks(prefs):
 	def doCheck(name, allocation):
 		if not prefs.hasPortfolio(name):
 			prefs.addPortfolio(name)
-		p = Portfolio(name)
+		p = getPortfolio(name)
 		if not p.isBenchmark():
 			p.makeBenchmark()
 	
@@ -4231,3 +4067,77 @@ def checkBenchmarks(prefs):
 	
 	doCheck("S&P 500", {"VFINX": 100.0})
 	doCheck("Aggressive", {"VTSMX": 75.0, "VBMFX": 25.0})
+
+if __name__ == "__main__":
+	import tempfile
+	import shutil
+	
+	class TestPrefs:
+		def __init__(self, path):
+			self.path = path
+		
+		def getPortfolioPath(self, name):
+			return os.path.join(self.path, "portfolio_" + name + ".db")
+	
+	class TestApp:
+		def __init__(self, path):
+			self.prefs = TestPrefs(path)
+			self.checkTableMutex = threading.Lock()
+		
+		def beginBigTask(self, description, status = False):
+			pass
+		
+		def endBigTask(self):
+			pass
+	
+	print "test 1 - combine portfolios sharing an imported uniqueId"
+	path = tempfile.mkdtemp()
+	try:
+		prefs.prefs = False
+		appGlobal.setApp(TestApp(path), os.path.dirname(os.path.abspath(__file__)))
+		for name in ["a", "b"]:
+			p = getPortfolio(name)
+			Transaction("ofx1", "AAA", datetime.datetime(2010, 1, 4), Transaction.buy, -1000.0, 10.0, 100.0).save(p.db)
+		c = getPortfolio("c")
+		c.makeCombined()
+		c.portPrefs.setCombinedComponents("a,b")
+		c.rebuildCombinedTransactions(False)
+		c.readFromDb()
+		assert(len(c.transactions) == 2)
+		assert([t.uniqueId for t in c.transactions] == ["ofx1", "ofx1"])
+		
+		print "test 2 - shared portfolios wait for a rebuild before reading"
+		a = getPortfolio("a")
+		assert(getPortfolio("a") is a)
+		read = threading.Event()
+		def readPortfolio():
+			getPortfolio("a").readFromDb()
+			read.set()
+		a.beginRebuild("test")
+		thread = threading.Thread(target = readPortfolio)
+		thread.start()
+		read.wait(0.2)
+		assert(not read.isSet())
+		a.endRebuild()
+		thread.join()
+		assert(read.isSet())
+		
+		print "test 3 - closing a portfolio closes its benchmark history"
+		benchmarkCache.getHistory("a")
+		assert("a" in benchmarkCache.cache.dbs)
+		closePortfolio("a")
+		assert(not "a" in benchmarkCache.cache.dbs)
+		
+		print "test 4 - history of older portfolios gets day ordinals"
+		old = Db(TestPrefs(path).getPortfolioPath("old"))
+		old.query("create table positionHistory (date datetime, ticker text, shares float, value float)")
+		old.insertMany("positionHistory", ["date", "ticker", "shares", "value"], [("2010-01-04 00:00:00", "AAA", 1.0, 10.0), ("2012-02-29 00:00:00", "AAA", 1.0, 11.0)])
+		old.close()
+		p = getPortfolio("old")
+		days = p.db.selectTuples("positionHistory", what = "day", orderBy = "date").fetchall()
+		assert(days == [(datetime.date(2010, 1, 4).toordinal(),), (datetime.date(2012, 2, 29).toordinal(),)])
+		
+		for name in ["b", "c", "old"]:
+			closePortfolio(name)
+	finally:
+		shutil.rmtree(path)
@@ -0,0 +1,954 @@
+import datetime
+import math
+import traceback
+import sys
+import multiprocessing
+
+from transaction import *
+from userprice import *
+from twrr import *
+
+# StockData of a worker process, created by initWorker
+workerStockData = False
+
+# Worker processes replaying positions, created by startPool
+pool = False
+
+# Month end checkpoints are only saved for the last checkpointMonths months
+# Positions dirty before their oldest checkpoint are replayed from the beginning
+checkpointMonths = 3
+
+def startPool(processes):
+	"""Start a pool of processes replaying positions if processes is more than 1.
+	Workers are forked, call from the main thread before other threads start and before databases are written.
+	Windows starts workers by running the main script again so only fork is supported."""
+	global pool
+	if not pool and processes > 1 and not sys.platform.startswith("win"):
+		pool = multiprocessing.Pool(processes, initWorker)
+
+def stopPool():
+	global pool
+	if pool:
+		pool.terminate()
+		pool.join()
+		pool = False
+
+def initWorker():
+	"""Initialize a worker process with its own stock database connection"""
+	global workerStockData
+	import stockData
+	workerStockData = stockData.StockData(checkTables = False)
+
+def replayInWorker(job):
+	"""Replay a position in a worker process.  Messages and errors are returned in the result."""
+	# Workers outlive a rebuild, stock data may have been downloaded since the last job
+	workerStockData.invalidateCache()
+	log = ReplayLog()
+	result = PositionReplay(job, workerStockData, log).run()
+	result["log"] = log.messages
+	return result
+
+def dayToStr(day):
+	"""Return the "YYYY-MM-DD 00:00:00" string of a day ordinal"""
+	return datetime.date.fromordinal(day).isoformat() + " 00:00:00"
+
+def getMonthStart(day, monthsBefore = 0):
+	"""Return the ordinal of the first day of the month monthsBefore months before the month of day"""
+	d = datetime.date.fromordinal(day)
+	month = d.year * 12 + d.month - 1 - monthsBefore
+	return datetime.date(month / 12, month % 12 + 1, 1).toordinal()
+
+def getNextMonth(day):
+	"""Return the ordinal of the first day of the month after day"""
+	d = datetime.date.fromordinal(day)
+	if d.month == 12:
+		return datetime.date(d.year + 1, 1, 1).toordinal()
+	return datetime.date(d.year, d.month + 1, 1).toordinal()
+
+def getDependencies(tickers, transactions):
+	"""Return a dictionary of ticker to the tickers it depends on.
+	The new ticker of a spinoff or ticker change depends on the original ticker.
+	Cash depends on positions with buys that have their price filled in when replayed.
+	transactions is a dictionary of ticker to its transactions."""
+	deps = {}
+	for ticker in tickers:
+		deps[ticker] = []
+		for t in transactions.get(ticker, []):
+			if t.type in [Transaction.spinoff, Transaction.tickerChange] and ticker == t.ticker2 and t.ticker != ticker and t.ticker in transactions and not t.ticker in deps[ticker]:
+				deps[ticker].append(t.ticker)
+	
+	if "__CASH__" in deps:
+		for ticker in tickers:
+			if ticker == "__CASH__":
+				continue
+			for t in transactions.get(ticker, []):
+				if t.type in [Transaction.buy, Transaction.transferIn] and t.pricePerShare < 1.0e-6:
+					deps["__CASH__"].append(ticker)
+					break
+	return deps
+
+def getLevels(tickers, deps):
+	"""Return a list of levels, each a list of tickers that only depend on tickers in earlier levels.
+	Tickers in a dependency cycle are put in the last level."""
+	levels = []
+	done = {}
+	remaining = tickers[:]
+	while remaining:
+		level = []
+		for ticker in remaining:
+			ready = True
+			for dep in deps.get(ticker, []):
+				if not dep in done and dep in remaining:
+					ready = False
+					break
+			if ready:
+				level.append(ticker)
+		if not level:
+			# Cycle, replay the rest in order
+			level = remaining
+		for ticker in level:
+			done[ticker] = True
+		remaining = [ticker for ticker in remaining if not ticker in done]
+		levels.append(level)
+	return levels
+
+def getDirtyDates(tickers, deps, dirtyTickers):
+	"""Return a dictionary of ticker to the first date that needs to be replayed.
+	A ticker is dirty from the earliest dirty date of itself and every ticker it depends on.
+	dirtyTickers is a dictionary of ticker to the date its data changed."""
+	dates = {}
+	for ticker in tickers:
+		if ticker in dirtyTickers:
+			dates[ticker] = dirtyTickers[ticker]
+	
+	# Repeat until nothing changes in case of dependency cycles
+	changed = True
+	while changed:
+		changed = False
+		for ticker in tickers:
+			for dep in deps.get(ticker, []):
+				if dep in dates and (not ticker in dates or dates[dep] < dates[ticker]):
+					dates[ticker] = dates[dep]
+					changed = True
+	return dates
+
+def fillMissingPrices(ticker, transactions, stockData):
+	"""Fill in the price of buys without a price from the nearest stock price, as a replay does"""
+	missing = [t for t in transactions if t.type in [Transaction.buy, Transaction.transferIn] and t.pricePerShare < 1.0e-6]
+	if not missing:
+		return
+	nearestPrices = stockData.getNearestPrices([(ticker, t.date) for t in missing])
+	for (t, p) in zip(missing, nearestPrices):
+		if p:
+			t.pricePerShare = p["close"]
+			t.setTotal(t.pricePerShare * abs(t.shares) - t.getFee())
+
+def addUserAndTransactionPrices(prices, optionPrices, transactions, userPrices):
+	"""Add user prices and the prices of buys and sells to prices and optionPrices"""
+	# Use buys/sells to add to user price
+	for t in transactions:
+		if t.type in [Transaction.buy, Transaction.sell, Transaction.transferIn, Transaction.transferOut, Transaction.short, Transaction.cover, Transaction.buyToOpen, Transaction.sellToClose, Transaction.sellToOpen, Transaction.buyToClose]:
+			# Add to user prices
+			# Note there may already be a user price for this date
+
+			price = False
+			if t.pricePerShare:
+				price = t.pricePerShare
+			elif t.shares > 0:
+				price = abs(t.total / t.shares)
+
+			# Add user price if we found pricing information
+			if price:
+				if t.isOption():
+					if not t.formatTicker() in optionPrices:
+						optionPrices[t.formatTicker()] = []
+					optionPrices[t.formatTicker()].append({'volume': 0, 'high': price, 'low': price, 'date': t.date, 'close': price, 'open': price})
+				else:
+					userPrices.append(UserPrice(t.date, t.ticker, price))
+
+	# Add user prices and transaction prices to prices array
+	appended = False
+	for p in userPrices:
+		date = Transaction.parseDate(str(p.date)[0:10] + " 00:00:00")
+
+		# Check if date is already there
+		found = False
+		for p2 in prices:
+			if p2["date"] == date:
+				found = True
+				break
+		if not found:
+			appended = True
+			prices.append({'volume': 0, 'high': p.price, 'low': p.price, 'date': date, 'close': p.price, 'open': p.price})
+
+	# If we added prices, sort by date
+	if appended:
+		prices.sort(key = lambda p: p['date'])
+
+class ReplayLog:
+	"""Collects the messages and errors of a position replayed in another process"""
+	def __init__(self):
+		self.canceled = False
+		self.messages = []
+
+	def addMessage(self, message):
+		self.messages.append((False, message))
+
+	def addError(self, error):
+		self.messages.append((True, error))
+
+	def addException(self):
+		self.messages.append((True, traceback.format_exc()))
+
+	def appYield(self):
+		pass
+
+class PositionReplay:
+	"""Replays the transactions of one position day by day.
+
+	job is a dictionary with:
+	ticker, transactions (ascending), userPrices,
+	firstDate: the portfolio start date, used for cash,
+	now: the last second of today,
+	checkpoint: (date, state) to resume from or False, state is a dictionary saved in checkpoints,
+	basisMethod: lot selection method of Basis,
+	positions: dictionary of (ticker, date string) to the position of tickers this one depends on.
+
+	run() returns a dictionary with:
+	skipped: True if there is no price data,
+	history: positionHistory rows in Portfolio.historyColumns order,
+	values: list of (date, value),
+	checkpoints: list of (date string, state), state holds the running totals and the
+		lots and returns as plain dictionaries and lists,
+	prices: list of (index, pricePerShare, total) of transactions whose price was filled in."""
+
+	def __init__(self, job, stockData, update = False):
+		self.job = job
+		self.ticker = job["ticker"]
+		self.transactions = job["transactions"]
+		self.stockData = stockData
+		self.update = update
+
+		# Basis dictionary key is ticker, content is a LotLedger
+		self.basisMethod = job["basisMethod"]
+		self.basis = {}
+
+		# Options basis key is date, content is list of (shares, price per share, strike, expire)
+		self.longOptionsBasis = {}
+		self.shortOptionsBasis = {}
+
+		self.twrr = Twrr(self.basisMethod) # Time weighted rate of return
+
+	def addToBasis(self, ticker, d, s, pps):
+		if ticker not in self.basis:
+			self.basis[ticker] = LotLedger()
+		self.basis[ticker].add(d, s, pps)
+
+	def getShares(self, ticker):
+		if not ticker in self.basis:
+			return 0
+		return self.basis[ticker].getShares()
+
+	def getBasis(self, ticker):
+		if not ticker in self.basis:
+			return 0
+		return self.basis[ticker].getBasis()
+
+	def getBasisValue(self, ticker):
+		if not ticker in self.basis:
+			return 0
+		return self.basis[ticker].getTotalBasis()
+
+	def removeFromBasis(self, ticker, remove):
+		if ticker in self.basis:
+			remove = self.basis[ticker].remove(remove, self.basisMethod)
+		if abs(remove) > 1.0e-6:
+			if self.update:
+				if ticker in self.basis:
+					self.update.addError("Could not finish basis for %s %s %s" % (ticker, remove, self.basis[ticker].getLots()))
+				else:
+					self.update.addError("Could not finish basis for %s %s (no basis)" % (ticker, remove))
+
+	def adjustBasisStockDividend(self, ticker, adjustShares):
+		"""Add or remove shares from basis"""
+		shares = self.getShares(ticker)
+		if shares == 0:
+			if self.update:
+				self.update.addError("Split but zero shares for " + ticker)
+			return
+		shareFactor = (shares + adjustShares) / shares
+		if shareFactor == 0:
+			if self.update:
+				self.update.addError("Split to zero shares for " + ticker)
+			return
+
+		self.basis[ticker].scale(shareFactor)
+
+	def adjustBasisValue(self, ticker, percent):
+		"""Modify basis value by percent"""
+		self.basis[ticker].adjustPrices(percent)
+
+	# TODO: do not combine individual days
+	def addToOptionsBasis(self, ticker, d, s, pps, strike, expire):
+		# Decide whether short or long
+		if s > 0:
+			b = self.longOptionsBasis
+		else:
+			b = self.shortOptionsBasis
+
+		if d in b:
+			# Update basis for this day
+			b[d].append((ticker, s, pps, strike, expire))
+		else:
+			b[d] = [(ticker, s, pps, strike, expire)]
+
+	def getOptionsShares(self, ticker):
+		s = 0
+		for d in self.longOptionsBasis:
+			for i in range(len(self.longOptionsBasis[d])):
+				s += self.longOptionsBasis[d][i][1]
+		for d in self.shortOptionsBasis:
+			for i in range(len(self.shortOptionsBasis[d])):
+				s += abs(self.shortOptionsBasis[d][i][1])
+		return s
+
+	def getOptionsBasis(self, ticker, update = False):
+		basisVal = 0
+		basisShares = 0
+		# Compute over all shares
+		for thisBasis in [self.longOptionsBasis, self.shortOptionsBasis]:
+			for d in thisBasis:
+				for i in range(len(thisBasis[d])):
+					(ignoreTicker, s, pps, strike, expire) = thisBasis[d][i]
+					basisVal += s * pps
+					basisShares += s
+
+		if basisShares == 0:
+			return 0
+		else:
+			return basisVal / basisShares
+
+	def getOptionsBasisValue(self, ticker, update = False):
+		basisVal = 0
+		# Compute over all shares
+		for thisBasis in [self.longOptionsBasis, self.shortOptionsBasis]:
+			for d in thisBasis:
+				for i in range(len(thisBasis[d])):
+					(ignoreTicker, s, pps, strike, expire) = thisBasis[d][i]
+					basisVal += s * pps
+
+		return basisVal
+
+	def getOptionsValue(self, ticker):
+		value = 0.0
+
+		for d in self.longOptionsBasis:
+			for i in range(len(self.longOptionsBasis[d])):
+				(optionTicker, s, pps, strike, expire) = self.longOptionsBasis[d][i]
+
+				# TODO: Determine price for this option
+				price = pps
+
+				value += s * price
+
+		for d in self.shortOptionsBasis:
+			for i in range(len(self.shortOptionsBasis[d])):
+				(optionTicker, s, pps, strike, expire) = self.shortOptionsBasis[d][i]
+
+				# TODO: Determine price for this option
+				price = pps
+
+				value += (pps - price) * s
+
+		return value
+
+	def getSpecificOptionsBasis(self, optionStrike, optionExpire):
+		basisVal = 0
+		basisShares = 0
+		# Compute over matching shares
+		for thisBasis in [self.longOptionsBasis, self.shortOptionsBasis]:
+			for d in thisBasis:
+				for i in range(len(thisBasis[d])):
+					(ignoreTicker, s, pps, strike, expire) = thisBasis[d][i]
+					if strike == optionStrike and expire == optionExpire:
+						basisVal += s * pps
+						basisShares += s
+
+		if basisShares == 0:
+			return 0
+		else:
+			return basisVal / basisShares
+
+	def expireOptions(self, ticker, optionStrike, optionExpire, date):
+		# TODO: Use option prices when Icarra supports them
+		for thisBasis in [self.longOptionsBasis, self.shortOptionsBasis]:
+			for d in thisBasis:
+				for i in range(len(thisBasis[d])):
+					(thisTicker, s, pps, strike, expire) = thisBasis[d][i]
+					if ticker == thisTicker and strike == optionStrike and expire == optionExpire:
+						if s < 0:
+							# Sell to open / buy to close
+							self.twrr.coverShares(thisTicker, abs(s), 0)
+						else:
+							# Buy to open / sell to close
+							self.twrr.removeShares(thisTicker, abs(s), 0)
+						self.removeFromOptionsBasis(thisTicker, s, strike, expire)
+
+	def checkOptionsExpiration(self, ticker, day):
+		# Return True if expired an option
+		expired = False
+
+		for thisBasis in [self.longOptionsBasis, self.shortOptionsBasis]:
+			for d in thisBasis:
+				for i in range(len(thisBasis[d])):
+					(thisTicker, s, pps, strike, expire) = thisBasis[d][i]
+					# Expire 2 days after the friday
+					if day >= expire.toordinal() + 2:
+						expired = True
+						self.expireOptions(ticker, strike, expire, datetime.datetime.fromordinal(day))
+
+		return expired
+
+	def removeFromOptionsBasis(self, ticker, remove, strike, expire):
+		if remove > 0:
+			thisBasis = self.longOptionsBasis
+		else:
+			thisBasis = self.shortOptionsBasis
+
+		for d in thisBasis:
+			i = 0
+			while d in thisBasis and i < len(thisBasis[d]) and abs(remove) > 1.0e-6:
+				(optionTicker, s, pps, str, e) = thisBasis[d][i]
+				# Check for right ticker, strike price, expiration
+				if ticker != optionTicker or (str - strike) > 1.0e-6 or e != expire:
+					i += 1
+					continue
+
+				if abs(s) > abs(remove):
+					thisBasis[d][i] = (ticker, s - remove, pps, str, e)
+					remove = 0
+					i += 1
+				else:
+					# Remove all of basis
+					del thisBasis[d][i]
+					remove -= s
+		if abs(remove) > 1.0e-6:
+			if self.update:
+				self.update.addError("Could not finish options basis for %s remove %f strike %f expire %s" % (ticker, remove, strike, expire))
+
+	def getPrices(self, transactions):
+		"""Return (prices, optionPrices) for the position or False if there is no price data"""
+		ticker = self.ticker
+		stockData = self.stockData
+		update = self.update
+
+		if ticker == "__CASH__":
+			prices = {}
+			prices[0] = {}
+			prices[0]["close"] = 1.0
+			return (prices, {})
+
+		prices = stockData.getPrices(ticker, startDate = transactions[0].date)
+		optionPrices = {}
+		if not prices:
+			# No prices print error
+			if update:
+				firstStockDate = stockData.getFirstDate(ticker)
+				lastStockDate = stockData.getLastDate(ticker)
+				if firstStockDate and lastStockDate:
+					update.addError("No usable stock data found for %s.  Icarra has data for %s from %s to %s.  The first transaction for %s is on %s." % (ticker, ticker, firstStockDate.strftime("%m/%d/%Y"), lastStockDate.strftime("%m/%d/%Y"), ticker, transactions[0].formatDate()))
+				else:
+					update.addError("No stock data found for %s" % ticker)
+		addUserAndTransactionPrices(prices, optionPrices, transactions, self.job["userPrices"])
+		if not prices and not optionPrices:
+			# Still no data, ignore
+			return False
+		return (prices, optionPrices)
+
+	def run(self):
+		ticker = self.ticker
+		transactions = self.transactions
+		stockData = self.stockData
+		update = self.update
+		now = self.job["now"]
+		checkpoint = self.job["checkpoint"]
+
+		result = {
+			"ticker": ticker,
+			"skipped": False,
+			"history": [],
+			"values": [],
+			"checkpoints": [],
+			"prices": []}
+
+		# Prices filled in while replaying are returned to the caller
+		originalPrices = [(t.pricePerShare, t.total) for t in transactions]
+
+		# Get stock data
+		prices = self.getPrices(transactions)
+		if not prices:
+			result["skipped"] = True
+			return result
+		(prices, optionPrices) = prices
+
+		# Look up prices of buys without a price at once
+		missingPrices = []
+		for t in transactions:
+			if t.type in [Transaction.buy, Transaction.transferIn] and t.pricePerShare < 1.0e-6:
+				missingPrices.append(t.date)
+		nearestPrices = dict(zip(missingPrices, stockData.getNearestPrices([(ticker, d) for d in missingPrices])))
+
+		# Loop through first day until now
+		# Days are ordinals, a transaction or price belongs to a day if it is on or before the end of that day
+		currentTrans = 0
+		currentPrice = 0
+		transactionDays = [t.getDate().toordinal() for t in transactions]
+		if ticker != "__CASH__":
+			priceDays = [p["date"].toordinal() for p in prices]
+		nowDay = now.toordinal()
+		# Begin on first transaction.  Always begin cash on portfolio first date.
+		if transactions and ticker != "__CASH__":
+			day = transactionDays[0]
+		else:
+			day = self.job["firstDate"].toordinal()
+		price = False
+		shares = 0.0
+		value = 0.0
+		adjustedValue = 0.0
+		totalFees = 0
+		totalDividends = 0
+		totalProfit = 0 # Profit after fees
+		yieldCount = 0
+		doneWithTicker = False
+		twrr = self.twrr
+		if ticker == "__CASH__":
+			twrr.addShares("__CASH__", 0, 1)
+
+		# Restore state from checkpoint
+		if checkpoint:
+			(checkpointDate, state) = checkpoint
+			shares = state["shares"]
+			value = state["value"]
+			adjustedValue = state["adjustedValue"]
+			totalFees = state["totalFees"]
+			totalDividends = state["totalDividends"]
+			totalProfit = state["totalProfit"]
+			price = state["price"]
+			if price is None:
+				price = False
+			twrr.setState(state["twrr"])
+			for (d, s, pps) in state["basis"]:
+				self.addToBasis(ticker, d, s, pps)
+			self.longOptionsBasis = state["longOptionsBasis"]
+			self.shortOptionsBasis = state["shortOptionsBasis"]
+
+			# Skip transactions before the checkpoint
+			# Buys without a price had their price filled in when they were replayed
+			day = checkpointDate.toordinal()
+			while currentTrans < len(transactions) and transactionDays[currentTrans] <= day:
+				t = transactions[currentTrans]
+				if t.type in [Transaction.buy, Transaction.transferIn] and t.pricePerShare < 1.0e-6:
+					p = nearestPrices.get(t.date) or stockData.getNearestPrice(ticker, t.date)
+					if p:
+						t.pricePerShare = p["close"]
+						t.setTotal(t.pricePerShare * abs(t.shares) - t.getFee())
+				currentTrans += 1
+			day += 1
+
+		# Checkpoints are saved on the last day of recent months
+		nextMonth = getNextMonth(day)
+		firstCheckpoint = getMonthStart(nowDay, checkpointMonths)
+		while day < nowDay and not doneWithTicker:
+			yieldCount += 1
+			if yieldCount == 100:
+				yieldCount = 0
+				if update:
+					update.appYield()
+					if update.canceled:
+						break
+			totalTrans = 0
+			todayDividends = 0
+			twrr.beginTransactions()
+			while currentTrans < len(transactions) and transactionDays[currentTrans] <= day and not doneWithTicker:
+				t = transactions[currentTrans]
+
+				# Check that first transaction is a buy or transferIn (if not cash), or a spinoff or tickerChange and we are ticker2
+				if currentTrans == 0 and ticker != "__CASH__":
+					if not t.type in [Transaction.buy, Transaction.short, Transaction.buyToOpen, Transaction.sellToOpen, Transaction.transferIn] and ((t.type != Transaction.spinoff and t.type != Transaction.tickerChange) or t.ticker2 != ticker):
+						if update:
+							update.addError("The first transaction for %s does not add to its shares.  Ignoring position." % ticker)
+						doneWithTicker = True
+						break
+				currentTrans += 1
+				totalTrans += 1
+
+				if t.type == Transaction.deposit:
+					shares += t.getTotal()
+					twrr.addShares(ticker, t.getTotal(), 1)
+				elif t.type == Transaction.withdrawal:
+					shares += t.getTotal()
+					twrr.removeShares(ticker, -t.getTotal(), 1)
+				elif t.type == Transaction.buy or t.type == Transaction.transferIn:
+					# Lookup price if unavailable
+					if t.pricePerShare < 1.0e-6:
+						p = nearestPrices.get(t.date) or stockData.getNearestPrice(ticker, t.date)
+						if p:
+							t.pricePerShare = p["close"]
+							t.setTotal(t.pricePerShare * abs(t.shares) - t.getFee())
+						else:
+							if update:
+								update.addError("Buy transaction has no price per share %s" % t)
+							continue
+
+					totalProfit -= abs(t.total)
+					twrr.addShares(t.formatTicker(), t.getShares(), t.pricePerShare)
+
+					# Check for transfer in option
+					if t.isOption():
+						# Add to basis tracker
+						self.addToOptionsBasis(t.formatTicker(), t.date, t.shares, t.pricePerShare, t.optionStrike, t.optionExpire)
+					else:
+						shares += abs(t.shares)
+
+						# Add to basis tracker
+						self.addToBasis(ticker, t.date, t.shares, t.pricePerShare)
+				elif t.type == Transaction.sell:
+					if shares <= 0:
+						if update:
+							update.addError("Sell transaction but no shares %s" % t)
+						continue
+					shares -= abs(t.shares)
+					totalProfit += t.getTotal()
+					twrr.removeShares(ticker, t.getShares(), t.pricePerShare)
+
+					# Remove t.shares from basis tracker
+					self.removeFromBasis(ticker, abs(t.shares))
+				elif t.type == Transaction.buyToOpen:
+					totalProfit -= abs(t.total)
+					# Use formatTicker() because it includes strike, option
+					twrr.addShares(t.formatTicker(), t.getShares(), t.pricePerShare)
+
+					# Add to basis tracker
+					self.addToOptionsBasis(t.formatTicker(), t.date, t.shares, t.pricePerShare, t.optionStrike, t.optionExpire)
+				elif t.type == Transaction.sellToClose:
+					totalProfit += t.getTotal()
+					twrr.removeShares(t.formatTicker(), t.getShares(), t.pricePerShare)
+
+					# Remove t.shares from basis tracker
+					self.removeFromOptionsBasis(t.formatTicker(), abs(t.shares), t.optionStrike, t.optionExpire)
+				elif t.type == Transaction.short:
+					# Lookup price if unavailable
+					if not t.pricePerShare:
+						if update:
+							update.addError("Transaction has no price per share %s" % t)
+						continue
+
+					# Shorts reduce shares and add to basis
+					shares -= abs(t.shares)
+					totalProfit += t.getTotal()
+					twrr.shortShares(ticker, t.getShares(), t.pricePerShare)
+
+					# Add to basis tracker
+					self.addToBasis(ticker, t.date, -abs(t.shares), t.pricePerShare)
+				elif t.type == Transaction.cover:
+					if shares >= 0:
+						if update:
+							update.addError("Cover transaction but no shares %s" % t)
+						continue
+
+					# Cover adds to shares and removes from basis
+					shares += abs(t.shares)
+					twrr.coverShares(ticker, t.getShares(), t.pricePerShare)
+
+					# Remove t.shares from basis tracker
+					totalProfit += t.getTotal()
+					self.removeFromBasis(ticker, -abs(t.shares))
+				elif t.type == Transaction.sellToOpen:
+					# Shorts reduce shares and add to basis
+					totalProfit += t.getTotal()
+
+					# For sellToOpen we track 2 positions: One is exposure to the underlying stock,
+					# the other is the value of the options.  Assume 100 shares per option.
+					twrr.shortShares(t.formatTicker(), t.getShares(), t.pricePerShare)
+
+					# Add to basis tracker
+					self.addToOptionsBasis(t.formatTicker(), t.date, -abs(t.shares), t.pricePerShare, t.optionStrike, t.optionExpire)
+				elif t.type == Transaction.buyToClose:
+					twrr.coverShares(t.formatTicker(), t.getShares(), t.pricePerShare)
+
+					# Remove t.shares from basis tracker
+					totalProfit += t.getTotal()
+					self.removeFromOptionsBasis(t.formatTicker(), -abs(t.shares), t.optionStrike, t.optionExpire)
+				elif t.type in [Transaction.assign, Transaction.exercise, Transaction.expire]:
+					self.expireOptions(t.formatTicker(), t.optionStrike, t.optionExpire, t.date)
+				elif t.type == Transaction.dividend:
+					todayDividends += t.getTotalIgnoreFee()
+					twrr.addDividend(t.getTotalIgnoreFee())
+					if ticker == "__CASH__":
+						twrr.addShares(ticker, t.getTotalIgnoreFee(), 1)
+					# Fee will be subtracted from todayDividends later
+					if t.getFee():
+						todayDividends += t.getFee()
+				elif t.type == Transaction.expense:
+					# Note: Fees for all transactions are handled somewhere else
+					# Here we only keep track of fees from the total
+					if t.total:
+						if t.fee:
+							thisFee = abs(t.total) - abs(t.fee)
+						else:
+							thisFee = abs(t.total)
+						totalFees += thisFee
+						totalProfit -= thisFee
+					else:
+						totalProfit -= t.getFee()
+				elif t.type == Transaction.dividendReinvest:
+					if t.pricePerShare < 1.0e-6:
+						if t.getTotalIgnoreFee() > 0 and t.shares > 0:
+							t.pricePerShare = t.getTotalIgnoreFee() / t.shares
+						else:
+							p = stockData.getNearestPrice(ticker, t.date)
+							if p:
+								t.pricePerShare = p["close"]
+							else:
+								if update:
+									update.addError("Dividend reinvest transaction has no price per share %s" % t)
+								continue
+
+					# Add to today's dividends, but don't count as profit
+					# Because we are increasing share count
+					shares += abs(t.shares)
+					todayDividends += t.getTotalIgnoreFee()
+					totalProfit -= t.getTotalIgnoreFee()
+					twrr.addDividendReinvest(ticker, t.getShares(), t.pricePerShare)
+
+					# Add to basis tracker
+					self.addToBasis(ticker, t.date, t.shares, t.pricePerShare)
+				elif t.type == Transaction.transferOut:
+					if t.pricePerShare < 1.0e-6:
+						if t.getTotalIgnoreFee() > 0:
+							t.pricePerShare = t.getTotalIgnoreFee() / t.shares
+						elif price:
+							# Use last price data
+							t.pricePerShare = price
+						else:
+							p = stockData.getNearestPrice(ticker, t.date)
+							if p:
+								t.pricePerShare = p["close"]
+							else:
+								if update:
+									update.addError("transaction has no price per share %s" % t)
+								continue
+
+					totalProfit += t.getTotal()
+					twrr.removeShares(t.formatTicker(), t.getShares(), t.pricePerShare)
+
+					if t.isOption():
+						# Remove t.shares from basis tracker
+						self.removeFromOptionsBasis(t.formatTicker(), abs(t.shares), t.optionStrike, t.optionExpire)
+					else:
+						shares -= abs(t.shares)
+
+						# Remove t.shares from basis tracker
+						self.removeFromBasis(ticker, abs(t.shares))
+				elif t.type in [Transaction.stockDividend, Transaction.split]:
+					if t.type == Transaction.stockDividend:
+						adjustShares = t.shares
+					elif t.getTotal() > 0:
+						# A 2-1 split has a value of 2.0
+						adjustShares = math.floor(shares * (t.getTotal() - 1.0))
+					else:
+						raise Exception("Invalid split value for %s" % t)
+					shares += adjustShares
+					self.adjustBasisStockDividend(ticker, adjustShares)
+
+					twrr.stockDividendShares(ticker, adjustShares)
+				elif t.type == Transaction.adjustment:
+					adjustedValue += t.getTotal()
+					twrr.addAdjustment(t.getTotal())
+				elif t.type == Transaction.spinoff:
+					# Determine price per share
+					if t.pricePerShare:
+						pps = t.pricePerShare
+					else:
+						if update:
+							update.addError("Transaction has no price per share: %s" % t)
+						continue
+
+					# Dividend if ticker, buy if ticker2
+					if t.ticker == ticker:
+						spinoffValue = t.shares * pps
+						if value > 0:
+							basisValue = self.getBasisValue(ticker)
+							totalProfit += spinoffValue
+							twrr.adjustBasis(ticker, spinoffValue)
+
+							# Adjust basis
+							percent = (basisValue - spinoffValue) / basisValue
+							if percent < 0:
+								percent = 0
+							if percent >= 0:
+								self.adjustBasisValue(ticker, percent)
+							elif update:
+								update.addError("adjust basis for spinoff, percent less than 0: %f - %f" % (basisValue, spinoffValue))
+					else:
+						shares += abs(t.shares)
+						totalProfit -= pps
+						twrr.addShares(ticker, t.getShares(), pps)
+
+						# TODO: Handle for options?
+						self.addToBasis(ticker, t.date, t.shares, pps)
+				elif t.type == Transaction.tickerChange:
+					if ticker == t.ticker:
+						# Old ticker
+						# TODO: Handle for options?
+						self.removeFromBasis(ticker, shares)
+						shares = 0
+
+						# Force exit from loop, this stock no longer exists
+						doneWithTicker = True
+					else:
+						# New ticker, get stock data of original ticker
+						if currentTrans != 1:
+							if update:
+								update.addMessage("The ticker change transaction from %s to %s is not the first transaction for %s." % (t.ticker, t.ticker2, t.ticker2))
+							continue
+						pos = self.job["positions"].get((t.ticker, (t.date - datetime.timedelta(1)).strftime("%Y-%m-%d %H:%M:%S")))
+						if not pos:
+							if update:
+								update.addMessage("The ticker change transaction from %s to %s does not have data" % (t.ticker, t.ticker2))
+							continue
+
+						# Start calculating based off of the position data
+						# First use given transaction shares, if not, use position shares
+						if t.shares > 0:
+							shares = abs(t.shares)
+						elif pos["shares"] > 0:
+							shares = abs(pos["shares"])
+						if shares > 0:
+							pps = pos["value"] / shares
+							# TODO: Handle for options?
+							self.addToBasis(ticker, t.date, shares, pps)
+				elif update:
+					update.addError("Did not use transaction %s for rebuilding" % t)
+
+				# Adjust for fee
+				if t.fee:
+					totalFees += t.fee
+				if t.getFee():
+					twrr.addFee(t.getFee())
+					if ticker == "__CASH__":
+						twrr.removeShares(ticker, t.getFee(), 1)
+						shares -= t.getFee()
+						value -= t.getFee()
+
+			# Do not automatically expire options
+			expired = self.checkOptionsExpiration(ticker, day)
+			if expired:
+				totalTrans += 1
+
+			# Build current value based on shares and price
+			if currentPrice < len(prices):
+				# Advance to next price if not cash
+				if ticker != "__CASH__":
+					while currentPrice < len(prices) - 1 and priceDays[currentPrice + 1] <= day:
+						currentPrice += 1
+
+				price = prices[currentPrice]["close"]
+				if ticker == "__CASH__":
+					value = shares
+				elif self.getShares(ticker) >= 0:
+					value = self.getShares(ticker) * price + adjustedValue
+				else:
+					# Short
+					value = (price - self.getBasis(ticker)) * self.getShares(ticker) + adjustedValue
+
+				twrr.setValue(ticker, price)
+
+				# Use yesterday's value or today's value if position was opened today
+				if todayDividends > 0:
+					totalProfit += todayDividends
+					totalDividends += todayDividends
+
+					if ticker == "__CASH__":
+						shares += todayDividends
+						value += todayDividends
+
+				# Adjust fee factor for fees today's fees
+				# Use today's value or yesterday's value if position was closed today
+			elif price:
+				# Use last price
+				value = self.getShares(ticker) * price + adjustedValue
+			else:
+				# No price
+				value = 0
+
+			try:
+				twrr.endTransactions()
+			except Exception, e:
+				if update:
+					update.addException()
+				else:
+					raise
+
+			# Update value based on options
+			# TODO: Calculate value of options better!!!
+			value += self.getOptionsValue(ticker)
+
+			if ticker == "__CASH__":
+				profitFee = totalProfit
+			else:
+				profitFee = value + totalProfit
+
+			profitDividend = profitFee + totalFees
+			profitSplit = profitDividend - totalDividends
+
+			dateStr = False
+			if (abs(shares) + abs(self.getOptionsShares(ticker)) > 1.0e-6 or totalTrans > 0 or currentTrans < len(transactions) or ticker == "__CASH__") and not doneWithTicker:
+				dateStr = dayToStr(day)
+				result["history"].append((
+					dateStr,
+					ticker,
+					self.getShares(ticker),
+					self.getOptionsShares(ticker),
+					value,
+					twrr.getReturnSplit(),
+					twrr.getReturnDiv(),
+					twrr.getReturnFee(),
+					profitSplit,
+					profitDividend,
+					profitFee))
+
+			result["values"].append((day, value))
+
+			# Checkpoint at the end of recent months and on the last day
+			# Incremental rebuilds resume from the last checkpoint before the dirty date
+			monthEnd = day + 1 == nextMonth
+			if monthEnd:
+				nextMonth = getNextMonth(day + 1)
+			if not doneWithTicker and ((monthEnd and day >= firstCheckpoint) or day + 1 >= nowDay):
+				if not dateStr:
+					dateStr = dayToStr(day)
+				lots = []
+				if ticker in self.basis:
+					lots = self.basis[ticker].getLots()
+				result["checkpoints"].append((dateStr, {
+					"shares": shares,
+					"value": value,
+					"adjustedValue": adjustedValue,
+					"totalFees": totalFees,
+					"totalDividends": totalDividends,
+					"totalProfit": totalProfit,
+					"price": price if price is not False else None,
+					"twrr": twrr.getState(),
+					"basis": lots,
+					"longOptionsBasis": dict([(d, list(b)) for (d, b) in self.longOptionsBasis.items()]),
+					"shortOptionsBasis": dict([(d, list(b)) for (d, b) in self.shortOptionsBasis.items()])}))
+
+			day += 1
+
+		for i in range(len(transactions)):
+			t = transactions[i]
+			if (t.pricePerShare, t.total) != originalPrices[i]:
+				result["prices"].append((i, t.pricePerShare, t.total))
+
+		return result
@@ -47,11 +47,13 @@ class Prefs:
 		return os.path.join(Prefs.prefsRootPath(), "portfolio_" + name + ".db")
 
 	def __init__(self, customDb = False):
+		# Every preference, key is name.  Read again when the database is written.
+		self.values = {}
+		self.changes = False
+		
 		if customDb:
+			# The owner of customDb creates its prefs table
 			self.db = customDb
-			self.db.checkTable("prefs", [
-				{"name": "name", "type": "text"},
-				{"name": "value", "type": "text"}])
 		else:
 			# Check for ~/.icarra2
 			if not os.path.isdir(self.prefsRootPath()):
@@ -59,62 +61,104 @@ class Prefs:
 			
 			self.db = Db(os.path.join(self.prefsRootPath(), "prefs.db"))
 
-			self.db.beginTransaction()
+			# Append schema changes to the list, opening up to date prefs only reads the version
+			self.db.migrate([self.createTables])
 
-			self.db.checkTable("prefs", [
-				{"name": "name", "type": "text"},
-				{"name": "value", "type": "text"}])
-			
-			self.db.checkTable("portfolios", [
-				{"name": "portfolioId", "type": "integer primary key autoincrement"},
-				{"name": "name", "type": "text"},
-				{"name": "brokerage", "type": "text"},
-				{"name": "username", "type": "text"},
-				{"name": "account", "type": "text"}],
-				unique = [{"name": "name", "cols": ["name"]}])
-			
 			# Check basic defaults
-			self.checkDefaults("width", 950)
-			self.checkDefaults("height", 550)
-			self.checkDefaults("statusWidth", 500)
-			self.checkDefaults("statusHeight", 300)
-			self.checkDefaults("lastPortfolio", "S&P 500")
-			self.checkDefaults("lastTab", "Summary")
-			self.checkDefaults("ofxDebug", "False")
-			self.checkDefaults("showCashInTransactions", "False")
-			self.checkDefaults("backgroundRebuild", "True")
-			self.checkDefaults("backgroundImport", "False")
-			self.checkDefaults("lastBackgroundImport", "2000-01-01 00:00:00")
-			self.checkDefaults("ignoreVersion", "0.0.0")
-			self.checkDefaults("lastVersionReminder", "2000-01-01 00:00:00")
-			self.checkDefaults("latestVersion", "0.0.0")
-			self.checkDefaults("timesRun", "0")
-			self.checkDefaults("tutorial", "0")
-			self.checkDefaults("uniqueId", "")
-			
-			self.db.commitTransaction()
+			self.checkAllDefaults([
+				("width", 950),
+				("height", 550),
+				("statusWidth", 500),
+				("statusHeight", 300),
+				("lastPortfolio", "S&P 500"),
+				("lastTab", "Summary"),
+				("ofxDebug", "False"),
+				("showCashInTransactions", "False"),
+				("backgroundRebuild", "True"),
+				("backgroundImport", "False"),
+				("rebuildProcesses", "1"),
+				("lastBackgroundImport", "2000-01-01 00:00:00"),
+				("ignoreVersion", "0.0.0"),
+				("lastVersionReminder", "2000-01-01 00:00:00"),
+				("latestVersion", "0.0.0"),
+				("timesRun", "0"),
+				("tutorial", "0"),
+				("uniqueId", "")])
 			
 			# Save global in Prefs
 			global prefs
 			prefs = self
 	
+	def createTables(self):
+		self.db.checkTable("prefs", [
+			{"name": "name", "type": "text"},
+			{"name": "value", "type": "text"}])
+		
+		self.db.checkTable("portfolios", [
+			{"name": "portfolioId", "type": "integer primary key autoincrement"},
+			{"name": "name", "type": "text"},
+			{"name": "brokerage", "type": "text"},
+			{"name": "username", "type": "text"},
+			{"name": "account", "type": "text"}],
+			unique = [{"name": "name", "cols": ["name"]}])
+		
+		# Tickers held by each portfolio, used to find portfolios affected by new stock data
+		self.db.checkTable("portfolioTickers", [
+			{"name": "portfolio", "type": "text"},
+			{"name": "ticker", "type": "text"}],
+			index = [{"name": "portfolioTickerIndex", "cols": ["portfolio"]}],
+			unique = [{"name": "tickerPortfolioIndex", "cols": ["ticker", "portfolio"]}])
+	
 	def checkDefaults(self, name, value):
-		cursor = self.db.select("prefs", where = {"name": name})
-		if not cursor.fetchone():
-			self.db.beginTransaction()
+		'''Insert value if there is no preference name.  Call in a transaction to insert many at once.'''
+		if not name in self.getValues():
 			self.db.insert("prefs", {"name": name, "value": value})
+			self.cacheValue(name, value)
+	
+	def checkAllDefaults(self, defaults):
+		'''checkDefaults for a list of (name, value).  A transaction is only started if a name is missing.'''
+		values = self.getValues()
+		missing = [(name, value) for (name, value) in defaults if not name in values]
+		if missing:
+			self.db.beginTransaction()
+			for (name, value) in missing:
+				self.checkDefaults(name, value)
 			self.db.commitTransaction()
 	
 	def getAllPrefs(self):
 		res = self.db.select("prefs")
 		return res.fetchall()
 
+	def getValues(self):
+		'''Return every preference, read again if the database was written since it was read'''
+		# Read the change count first so writes during the read are read again
+		changes = self.db.getChanges()
+		if changes != self.changes:
+			values = {}
+			for (name, value) in self.db.selectTuples("prefs", what = "name, value").fetchall():
+				values[name] = value
+			self.values = values
+			self.changes = changes
+		return self.values
+	
 	def getPreference(self, name):
-		cursor = self.db.select("prefs", where = {"name": name})
-		row = cursor.fetchone()
-		if not row:
+		values = self.getValues()
+		if not name in values:
 			raise Exception("No preference " + name)
-		return row["value"]
+		return values[name]
+	
+	def setPreference(self, name, value):
+		self.db.update("prefs", {"value": value}, {"name": name})
+		if name in self.values:
+			self.cacheValue(name, value)
+	
+	def cacheValue(self, name, value):
+		'''Keep value as it is read back from the text column'''
+		if isinstance(value, bool):
+			value = str(value)
+		elif value is not None and not isinstance(value, basestring):
+			value = unicode(value)
+		self.values[name] = value
 		
 	def getWidth(self):
 		return int(self.getPreference("width"))
@@ -146,6 +190,9 @@ class Prefs:
 	def getBackgroundImport(self):
 		return self.getPreference("backgroundImport") == "True"
 
+	def getRebuildProcesses(self):
+		return int(self.getPreference("rebuildProcesses"))
+
 	def getLastBackgroundImport(self):
 		return datetime.datetime.strptime(self.getPreference("lastBackgroundImport"), "%Y-%m-%d %H:%M:%S")
 
@@ -171,105 +218,110 @@ class Prefs:
 
 	def setSize(self, width, height):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": width}, {"name": "width"})
-		self.db.update("prefs", {"value": height}, {"name": "height"})
+		self.setPreference("width", width)
+		self.setPreference("height", height)
 		self.db.commitTransaction()
 	
 	def setStatusSize(self, width, height):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": width}, {"name": "statusWidth"})
-		self.db.update("prefs", {"value": height}, {"name": "statusHeight"})
+		self.setPreference("statusWidth", width)
+		self.setPreference("statusHeight", height)
 		self.db.commitTransaction()
 
 	def setLastPortfolio(self, last):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": last}, {"name": "lastPortfolio"})
+		self.setPreference("lastPortfolio", last)
 		self.db.commitTransaction()
 			
 	def setLastTab(self, last):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": last}, {"name": "lastTab"})
+		self.setPreference("lastTab", last)
 		self.db.commitTransaction()
 
 	def setOfxDebug(self, debug):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": debug}, {"name": "ofxDebug"})
+		self.setPreference("ofxDebug", debug)
 		self.db.commitTransaction()
 	
 	def setShowCashInTransactions(self, show):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": show}, {"name": "showCashInTransactions"})
+		self.setPreference("showCashInTransactions", show)
 		self.db.commitTransaction()
 	
 	def setBackgroundRebuild(self, show):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": show}, {"name": "backgroundRebuild"})
+		self.setPreference("backgroundRebuild", show)
 		self.db.commitTransaction()
 	
 	def setBackgroundImport(self, show):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": show}, {"name": "backgroundImport"})
+		self.setPreference("backgroundImport", show)
+		self.db.commitTransaction()
+	
+	def setRebuildProcesses(self, processes):
+		self.db.beginTransaction()
+		self.setPreference("rebuildProcesses", processes)
 		self.db.commitTransaction()
 	
 	def setLastBackgroundImport(self):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, {"name": "lastBackgroundImport"})
+		self.setPreference("lastBackgroundImport", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 		self.db.commitTransaction()
 
 	def setIgnoreVersion(self, major, minor, release):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": "%d.%d.%d" % (major, minor, release)}, {"name": "ignoreVersion"})
+		self.setPreference("ignoreVersion", "%d.%d.%d" % (major, minor, release))
 		self.db.commitTransaction()
 
 	def updateLatestVersion(self, major, minor, release):
 		(major2, minor2, release2) = self.getLatestVersion()
 		if major > major2 or (major == major2 and minor > minor2) or (major == major2 and minor == minor2 and release > release2):
 			self.db.beginTransaction()
-			self.db.update("prefs", {"value": "%d.%d.%d" % (major, minor, release)}, {"name": "latestVersion"})
+			self.setPreference("latestVersion", "%d.%d.%d" % (major, minor, release))
 			self.db.commitTransaction()
 
 	def setLastVersionReminder(self):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, {"name": "lastVersionReminder"})
+		self.setPreference("lastVersionReminder", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 		self.db.commitTransaction()
 
 	def incTimesRun(self):
 		r = int(self.getPreference("timesRun"))
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": r + 1}, {"name": "timesRun"})
+		self.setPreference("timesRun", r + 1)
 		self.db.commitTransaction()
 	
 	def setTutorialBit(self, bit):
 		t = int(self.getPreference("tutorial"))
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": t | bit}, {"name": "tutorial"})
+		self.setPreference("tutorial", t | bit)
 		self.db.commitTransaction()
 	
 	def setUniqueId(self, unique):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": unique}, {"name": "uniqueId"})
+		self.setPreference("uniqueId", unique)
 		self.db.commitTransaction()
 	
 	def setOfxDebug(self, debug):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": debug}, {"name": "ofxDebug"})
+		self.setPreference("ofxDebug", debug)
 		self.db.commitTransaction()
 	
 	def setIgnoreVersion(self, major, minor, release):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": "%d.%d.%d" % (major, minor, release)}, {"name": "ignoreVersion"})
+		self.setPreference("ignoreVersion", "%d.%d.%d" % (major, minor, release))
 		self.db.commitTransaction()
 
 	def updateLatestVersion(self, major, minor, release):
 		(major2, minor2, release2) = self.getLatestVersion()
 		if major > major2 or (major == major2 and minor > minor2) or (major == major2 and minor == minor2 and release > release2):
 			self.db.beginTransaction()
-			self.db.update("prefs", {"value": "%d.%d.%d" % (major, minor, release)}, {"name": "latestVersion"})
+			self.setPreference("latestVersion", "%d.%d.%d" % (major, minor, release))
 			self.db.commitTransaction()
 
 	def setLastVersionReminder(self):
 		self.db.beginTransaction()
-		self.db.update("prefs", {"value": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, {"name": "lastVersionReminder"})
+		self.setPreference("lastVersionReminder", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 		self.db.commitTransaction()
 
 	def addPortfolio(self, name):
@@ -289,6 +341,7 @@ class Prefs:
 	def deletePortfolio(self, name):
 		self.db.beginTransaction()
 		self.db.delete("portfolios", {"name": name})
+		self.db.delete("portfolioTickers", {"portfolio": name})
 		self.db.commitTransaction()
 	
 	def updatePortfolio(self, name, brokerage, username, account = ""):
@@ -338,6 +391,20 @@ class Prefs:
 		# Not found
 		return False
 	
+	def getPortfolioTickers(self, name):
+		"""Return the tickers saved by setPortfolioTickers or False if they were never saved"""
+		cursor = self.db.select("portfolioTickers", where = {"portfolio": name})
+		tickers = [row["ticker"] for row in cursor.fetchall()]
+		if not tickers:
+			return False
+		return sorted(tickers)
+	
+	def setPortfolioTickers(self, name, tickers):
+		self.db.beginTransaction()
+		self.db.delete("portfolioTickers", {"portfolio": name})
+		self.db.insertMany("portfolioTickers", ["portfolio", "ticker"], [(name, ticker) for ticker in tickers])
+		self.db.commitTransaction()
+	
 	def changePortfolioName(self, old, new):
 		# Unload current portfolio
 		getApp().portfolio.close()
@@ -346,6 +413,8 @@ class Prefs:
 		# Then update the portfolio
 		try:
 			shutil.move(self.getPortfolioPath(old), self.getPortfolioPath(new))
+			for logFile in getLogFiles(self.getPortfolioPath(old)):
+				shutil.move(logFile, self.getPortfolioPath(new) + logFile[len(self.getPortfolioPath(old)):])
 		except Exception, e:
 			# TODO: Print error
 			print "could not move", e
@@ -355,7 +424,8 @@ class Prefs:
 		self.db.update("portfolios",
 			{"name": new}, 
 			{"name": old})
-		self.db.update("prefs", {"value": new}, {"name": "lastPortfolio"})
+		self.setPreference("lastPortfolio", new)
+		self.db.update("portfolioTickers", {"portfolio": new}, {"portfolio": old})
 		self.db.commitTransaction()
 
 		# Now reload portfolio with new name
@@ -364,3 +434,40 @@ class Prefs:
 		return False
 		
 prefs = False
+
+if __name__ == "__main__":
+	import tempfile
+	
+	path = tempfile.mkdtemp()
+	try:
+		Prefs.prefsRootPath = staticmethod(lambda: os.path.join(path, "icarra2"))
+		p = Prefs()
+		
+		print "test 1 - values are read back as stored"
+		assert(p.getWidth() == 950)
+		p.setSize(1000, 600)
+		p.setBackgroundRebuild(False)
+		cached = dict(p.values)
+		p.changes = False
+		assert(p.getValues() == cached)
+		assert(p.getPreference("backgroundRebuild") == "False")
+		
+		print "test 2 - writes from other handles are read"
+		other = Prefs()
+		assert(other.getWidth() == 1000)
+		other.setLastTab("Chart")
+		assert(p.getLastTab() == "Chart")
+		p.db.beginTransaction()
+		p.setLastTab("News")
+		assert(p.getLastTab() == "News")
+		p.db.rollbackTransaction()
+		assert(p.getLastTab() == "Chart")
+		
+		print "test 3 - opening up to date prefs does not write"
+		changes = p.db.getChanges()
+		Prefs().db.close()
+		assert(p.db.getChanges() == changes)
+		other.db.close()
+		p.db.close()
+	finally:
+		shutil.rmtree(path)
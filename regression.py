@@ -58,7 +58,7 @@ def run(argv):
 		if inRegression:
 			portfolio = Portfolio(portfolioName, customDb = regressionPath)
 		else:
-			portfolio = Portfolio(portfolioName)
+			portfolio = getPortfolio(portfolioName)
 		appGlobal.getApp().portfolio = portfolio
 		if not commit:
 			portfolio.db.beginTransaction()
@@ -30,60 +30,138 @@ import datetime
 import prefs
 import zlib
 import binascii
+import bisect
+import threading
+from array import array
 
 import appGlobal
 from transaction import *
 
+def dateOrdinal(dateStr):
+	'''Return the day ordinal of a "YYYY-MM-DD HH:MM:SS" string'''
+	return datetime.date(int(dateStr[0:4]), int(dateStr[5:7]), int(dateStr[8:10])).toordinal()
+
+class TickerCache:
+	'''Prices, dividends and splits of one ticker stored as arrays sorted by date.
+	Dates are day ordinals, stock data is daily.'''
+	def __init__(self, db, ticker):
+		self.lastUsed = 0
+		self.splitFactors = False
+		
+		self.dates = array("l")
+		self.open = array("d")
+		self.high = array("d")
+		self.low = array("d")
+		self.close = array("d")
+		self.volume = array("d")
+		cursor = db.selectTuples("stockData", what = "day, date, open, high, low, close, volume", where = {"ticker": ticker}, orderBy = "date asc")
+		for (day, date, open, high, low, close, volume) in cursor.fetchall():
+			self.dates.append(day or dateOrdinal(date))
+			self.open.append(float(open))
+			self.high.append(float(high))
+			self.low.append(float(low))
+			self.close.append(float(close))
+			self.volume.append(float(volume))
+		
+		(self.dividendDates, self.dividends) = self.readValues(db, "stockDividends", ticker)
+		(self.splitDates, self.splits) = self.readValues(db, "stockSplits", ticker)
+		
+		self.size = 8 * (6 * len(self.dates) + 2 * len(self.dividendDates) + 2 * len(self.splitDates))
+	
+	def readValues(self, db, table, ticker):
+		dates = array("l")
+		values = array("d")
+		cursor = db.selectTuples(table, what = "day, date, value", where = {"ticker": ticker}, orderBy = "date asc")
+		for (day, date, value) in cursor.fetchall():
+			dates.append(day or dateOrdinal(date))
+			values.append(float(value))
+		return (dates, values)
+	
+	def find(self, dates, ordinal):
+		'''Return the index of ordinal in dates or -1'''
+		i = bisect.bisect_left(dates, ordinal)
+		if i < len(dates) and dates[i] == ordinal:
+			return i
+		return -1
+	
+	def findNearest(self, ordinal, maxDays):
+		'''Return the index of the price closest to ordinal within maxDays or -1.
+		Earlier prices win ties.'''
+		i = bisect.bisect_left(self.dates, ordinal)
+		after = -1
+		if i < len(self.dates):
+			if self.dates[i] == ordinal:
+				return i
+			after = self.dates[i] - ordinal
+		before = -1
+		if i > 0:
+			before = ordinal - self.dates[i - 1]
+		
+		if before != -1 and before <= maxDays and (after == -1 or before <= after):
+			return i - 1
+		if after != -1 and after <= maxDays:
+			return i
+		return -1
+	
+	def getSplitFactors(self):
+		'''Cumulative split factor for every price, computed on first use'''
+		if self.splitFactors is False:
+			factors = array("d")
+			splitFactor = 1.0
+			si = 0
+			for d in self.dates:
+				while si < len(self.splitDates) and self.splitDates[si] <= d:
+					splitFactor *= self.splits[si]
+					si += 1
+				factors.append(splitFactor)
+			self.splitFactors = factors
+		return self.splitFactors
+	
+	def getPrice(self, i, splitFactor = 1.0):
+		return {
+			"date": datetime.datetime.fromordinal(self.dates[i]),
+			"open": self.open[i] * splitFactor,
+			"high": self.high[i] * splitFactor,
+			"low": self.low[i] * splitFactor,
+			"close": self.close[i] * splitFactor,
+			"volume": self.volume[i]}
+	
+	def getValues(self, dates, values, first = 0):
+		ret = []
+		for i in range(bisect.bisect_left(dates, first), len(dates)):
+			ret.append({
+				"date": datetime.datetime.fromordinal(dates[i]),
+				"value": values[i]})
+		return ret
+
 class StockData:
-	def __init__(self):
+	# Columns of stockData returned by iterPrices
+	priceColumns = ["date", "open", "high", "low", "close", "volume"]
+	
+	# Rows read at a time by iterPrices
+	chunkSize = 1000
+	
+	def __init__(self, maxCacheSize = 32 * 1024 * 1024, checkTables = True):
 		self.s = ServiceProxy("http://www.icarra2.com/cgi-bin/webApi.py")
 		
 		self.db = Db(os.path.join(prefs.Prefs.prefsRootPath(), "stocks.db"))
-		# TODO: make unique index on ticker
-		self.db.checkTable("stockData", [
-			{"name": "ticker", "type": "text"},
-			{"name": "date", "type": "datetime"},
-			{"name": "open", "type": "float default 0.0"},
-			{"name": "high", "type": "float default 0.0"},
-			{"name": "low", "type": "float default 0.0"},
-			{"name": "close", "type": "float default 0.0"},
-			{"name": "volume", "type": "float default 0"}], index = [
-			{"name": "tickerDate", "cols": ["ticker", "date"]}])
 		
-		self.db.checkTable("stockDividends", [
-			{"name": "ticker", "type": "text"},
-			{"name": "date", "type": "datetime"},
-			{"name": "value", "type": "float"}], index = [
-			{"name": "tickerDate", "cols": ["ticker", "date"]}])
-
-		self.db.checkTable("stockSplits", [
-			{"name": "ticker", "type": "text"},
-			{"name": "date", "type": "datetime"},
-			{"name": "value", "type": "float"}], index = [
-			{"name": "tickerDate", "cols": ["ticker", "date"]}])
+		# Rebuild worker processes only read stock data and do not check tables
+		if checkTables:
+			# Append schema changes to the list, opening up to date stock data only reads the version
+			self.db.migrate([self.createTables])
 
-		self.db.checkTable("stockInfo", [
-			{"name": "ticker", "type": "text"},
-			{"name": "lastDownload", "type": "datetime"},
-			{"name": "icarraTicker", "type": "text"},
-			{"name": "name", "type": "text"}], unique = [
-			{"name": "ticker", "cols": ["ticker"]}])
-
-		self.db.checkTable("stockNews", [
-			{"name": "ticker", "type": "text"},
-			{"name": "date", "type": "datetime"},
-			{"name": "title", "type": "text"},
-			{"name": "summary", "type": "text"},
-			{"name": "rating", "type": "int"},
-			{"name": "url", "type": "text"},
-			{"name": "downloaded", "type": "bool default 0"},
-			{"name": "content", "type": "text"}], index = [
-			{"name": "tickerDate", "cols": ["ticker", "date"]}])
-
-		self.stocks = {}
+		# In memory stock data, key is ticker, value is TickerCache
+		# Least recently used tickers are removed when over maxCacheSize bytes
+		self.cache = {}
+		self.cacheSize = 0
+		self.cacheClock = 0
+		self.maxCacheSize = maxCacheSize
+		self.cacheLock = threading.Lock()
 	
-	def updateStocks(self, tickers, status = False):
-		'''Return True if new data is received'''
+	def updateStocks(self, tickers, status = False, newDates = False):
+		'''Return True if new data is received.
+		If newDates is a dictionary it is filled with the earliest new date for each ticker.'''
 		if status:
 			status.setStatus("Building Stock Data Query", 20)
 
@@ -96,21 +174,11 @@ class StockData:
 		appGlobal.getApp().beginBigTask('downloading stock data', status)
 
 		try:
-			update = {}
-			for t in tickers:
-				if t == "__CASH__":
-					continue
-				self.setLastDownload(t)
-				
-				last = self.getLastDate(t)
-				if last:
-					update[t] = last
-				else:
-					update[t] = datetime.datetime(1900, 1, 1)
+			update = self.getUpdateRequest(tickers)
 	
 			if status:
 				status.setStatus("Querying server", 40)
-			gotData = self.getFromServer(update, status)
+			gotData = self.getFromServer(update, status, newDates)
 			if status:
 				status.setStatus("Finished Downloading Stock Data", 100)
 			
@@ -122,10 +190,11 @@ class StockData:
 
 		return gotData
 	
-	def updatePortfolioStocks(self, portfolio, status = False):
+	def updatePortfolioStocks(self, portfolio, status = False, newDates = False):
 		'''Downloading new data for every ticker in the portfolio.
 		Only applies to stocks that have not been downloaded in 4 hours.
-		Return True if new data is received.'''
+		Return True if new data is received.
+		If newDates is a dictionary it is filled with the earliest new date for each ticker.'''
 		
 		update = {}
 		for ticker in portfolio.getTickers(includeAllocation = True):
@@ -145,7 +214,7 @@ class StockData:
 		if update:
 			if status:
 				status.setStatus("Querying server")
-			return self.getFromServer(update, status)
+			return self.getFromServer(update, status, newDates)
 
 		return False
 
@@ -157,34 +226,59 @@ class StockData:
 			appGlobal.setFailConnected(True)
 			return False
 
-	def getFromServer(self, request, status = False):
-		'''Return True if new stock data is received'''
+	def getUpdateRequest(self, tickers):
+		'''Return a request for getFromServer of new data for tickers.  Each ticker is marked as downloaded.'''
+		update = {}
+		for t in tickers:
+			if t == "__CASH__":
+				continue
+			self.setLastDownload(t)
+			
+			last = self.getLastDate(t)
+			if last:
+				update[t] = last
+			else:
+				update[t] = datetime.datetime(1900, 1, 1)
+		return update
+
+	def getFromServer(self, request, status = False, newDates = False):
+		'''Return True if new stock data is received.
+		If newDates is a dictionary it is filled with the earliest new date for each ticker.'''
 		
 		if appGlobal.getFailConnected():
 			return False
 		
-		# Encode as string
-		icarraTickers = {}
-		for (ticker, date) in request.items():
-			icarraTicker = self.getIcarraTicker(ticker)
-			icarraTickers[icarraTicker] = ticker
-			
-			# Change request to icarraTicker if necessary
-			if icarraTicker != ticker:
-				request[icarraTicker] = date.strftime("%Y-%m-%d %H:%M:%S")
-				del request[ticker]
-			else:
-				request[ticker] = date.strftime("%Y-%m-%d %H:%M:%S")
-		request["__UNIQUEID__"] = str(appGlobal.getApp().getUniqueId())
-
+		(request, icarraTickers) = self.encodeRequest(request)
 		try:
 			if status:
 				status.setStatus("Receiving Stock Data", 70)
-			data = self.s.getStockZip(request)
+			data = self.downloadStockData(request, icarraTickers)
 		except Exception, inst:
 			appGlobal.setFailConnected(True)
 			return False
 		
+		if status:
+			status.setStatus("Updating Stock Database", 80)
+		return self.saveStockData(data, newDates)
+	
+	def encodeRequest(self, request):
+		'''Return (request, icarraTickers) to pass to downloadStockData.
+		request is a dictionary of ticker to the date to download from.'''
+		icarraTickers = {}
+		encoded = {}
+		for (ticker, date) in request.items():
+			icarraTicker = self.getIcarraTicker(ticker)
+			icarraTickers[icarraTicker] = ticker
+			encoded[icarraTicker] = date.strftime("%Y-%m-%d %H:%M:%S")
+		encoded["__UNIQUEID__"] = str(appGlobal.getApp().getUniqueId())
+		return (encoded, icarraTickers)
+	
+	def downloadStockData(self, request, icarraTickers):
+		'''Download and parse stock data from the server.  Raise an exception if the server can not be reached.
+		Does not use the database so it may be called from any thread.
+		Return a dictionary of stocks, dividends and splits for saveStockData.'''
+		data = self.s.getStockZip(request)
+		
 		# Try decompressing
 		# Ignore errors (assume not compressed)
 		try:
@@ -194,79 +288,194 @@ class StockData:
 		except Exception, inst:
 			pass
 		
-		if status:
-			status.setStatus("Updating Stock Database", 80)
-		self.db.beginTransaction()
-		gotData = False
+		# Parse into one batch per table
+		# Key is (ticker, date), value is a tuple of column values
+		parsed = {"stocks": {}, "dividends": {}, "splits": {}, "version": False}
 		for line in data.split("\n"):
 			#print line
 			values = line.split(",")
 			if len(values) < 4:
 				continue
 			
-			if values[0] == "#vers" and len(values) == 4:
-				appGlobal.getApp().prefs.updateLatestVersion(int(values[1]), int(values[2]), int(values[3]))
-			if values[0] == "stock" and len(values) == 8:
-				on = {
-					"ticker": icarraTickers[values[1].upper()],
-					"date": values[2]
-					}
-				if self.db.insertOrUpdate("stockData", {
-					"ticker": icarraTickers[values[1].upper()],
-					"date": values[2],
-					"open": values[3],
-					"high": values[4],
-					"low": values[5],
-					"close": values[6],
-					"volume": values[7]},
-					on):
-					gotData = True
-			elif values[0] == "dividend" and len(values) == 4:
-				if self.db.insertOrUpdate("stockDividends", {
-					"ticker": icarraTickers[values[1].upper()],
-					"date": values[2],
-					"value": values[3]}):
-					gotData = True
-			elif values[0] == "split" and len(values) == 4:
-				if self.db.insertOrUpdate("stockSplits", {
-					"ticker": icarraTickers[values[1].upper()],
-					"date": values[2],
-					"value": values[3]}):
-					gotData = True
+			try:
+				if values[0] == "#vers" and len(values) == 4:
+					parsed["version"] = (int(values[1]), int(values[2]), int(values[3]))
+				if values[0] == "stock" and len(values) == 8:
+					parsed["stocks"][(icarraTickers[values[1].upper()], values[2])] = tuple([float(v) for v in values[3:8]])
+				elif values[0] == "dividend" and len(values) == 4:
+					parsed["dividends"][(icarraTickers[values[1].upper()], values[2])] = (float(values[3]),)
+				elif values[0] == "split" and len(values) == 4:
+					parsed["splits"][(icarraTickers[values[1].upper()], values[2])] = (float(values[3]),)
+			except ValueError:
+				continue
+		return parsed
+	
+	def saveStockData(self, data, newDates = False):
+		'''Save data from downloadStockData.  Return True if any stock data changed.
+		If newDates is a dictionary it is filled with the earliest new date for each ticker.'''
+		if data["version"]:
+			appGlobal.getApp().prefs.updateLatestVersion(*data["version"])
+		
+		changedTickers = {}
+		self.db.beginTransaction()
+		changed = self.saveBatch("stockData", ["open", "high", "low", "close", "volume"], data["stocks"], newDates, changedTickers)
+		changed += self.saveBatch("stockDividends", ["value"], data["dividends"], newDates, changedTickers)
+		changed += self.saveBatch("stockSplits", ["value"], data["splits"], newDates, changedTickers)
 		self.db.commitTransaction()
 		
-		return gotData
+		# Invalidate after committing so the cache is not reloaded with old data
+		for ticker in changedTickers:
+			self.invalidateCache(ticker)
+		
+		return changed > 0
 	
-	def readTickerFromDb(self, ticker):
-		res = self.db.select("stockData", where = {"ticker": ticker}, orderBy = "date")
+	def saveBatch(self, table, cols, rows, newDates = False, changedTickers = False):
+		'''Write rows keyed by (ticker, date) to table.  Only new or changed rows are written.
+		Return the number of rows that changed.'''
+		if not rows:
+			return 0
 		
-		self.stocks[ticker] = []
-		for row in res.fetchall():
-			self.stocks[ticker].append({
-				"date": row["date"],
-				"open": row["open"],
-				"high": row["high"],
-				"low": row["low"],
-				"close": row["close"],
-				"volume": row["volume"]})
-	
-	def readFromDb(self):
-		self.stocks = {}
-		res = self.db.select("stockData", orderBy = "ticker, date asc")
-		
-		lastTicker = ""
-		for row in res.fetchall():
-			ticker = row["ticker"].upper()
-			if ticker != lastTicker:
-				self.stocks[ticker] = []
-			self.stocks[ticker].append({
-				"date": row["date"],
-				"open": row["open"],
-				"high": row["high"],
-				"low": row["low"],
-				"close": row["close"],
-				"volume": row["volume"]})
-			lastTicker = ticker
+		# Read existing rows starting at the first new date of each ticker
+		first = {}
+		for (ticker, date) in rows:
+			if not ticker in first or date < first[ticker]:
+				first[ticker] = date
+		existing = {}
+		for (ticker, date) in first.items():
+			cursor = self.db.select(table, what = "date, " + ", ".join(cols), where = {"ticker": ticker, "date >=": date})
+			for row in cursor.fetchall():
+				existing[(ticker, row["date"])] = tuple([row[c] for c in cols])
+		
+		changed = []
+		for (key, values) in rows.items():
+			if existing.get(key) != values:
+				changed.append(key + (dateOrdinal(key[1]),) + values)
+				self.addNewDate(newDates, key[0], key[1])
+				if changedTickers is not False:
+					changedTickers[key[0]] = True
+		
+		return self.db.insertMany(table, ["ticker", "date", "day"] + cols, changed, replace = True)
+	
+	def createTables(self):
+		# Older databases may have duplicate rows that prevent unique indexes
+		# Days are the ordinals of dates, filled in when the column is added
+		hasDays = {}
+		for table in ["stockData", "stockDividends", "stockSplits"]:
+			self.removeDuplicates(table, table + "Unique")
+			hasDays[table] = self.db.hasColumn(table, "day")
+	
+		self.db.checkTable("stockData", [
+			{"name": "ticker", "type": "text"},
+			{"name": "date", "type": "datetime"},
+			{"name": "open", "type": "float default 0.0"},
+			{"name": "high", "type": "float default 0.0"},
+			{"name": "low", "type": "float default 0.0"},
+			{"name": "close", "type": "float default 0.0"},
+			{"name": "volume", "type": "float default 0"},
+			{"name": "day", "type": "integer"}], index = [
+			{"name": "tickerDate", "cols": ["ticker", "date"]},
+			{"name": "stockDataDay", "cols": ["ticker", "day"]}], unique = [
+			{"name": "stockDataUnique", "cols": ["ticker", "date"]}])
+	
+		self.db.checkTable("stockDividends", [
+			{"name": "ticker", "type": "text"},
+			{"name": "date", "type": "datetime"},
+			{"name": "value", "type": "float"},
+			{"name": "day", "type": "integer"}], index = [
+			{"name": "tickerDate", "cols": ["ticker", "date"]},
+			{"name": "stockDividendsDay", "cols": ["ticker", "day"]}], unique = [
+			{"name": "stockDividendsUnique", "cols": ["ticker", "date"]}])
+
+		self.db.checkTable("stockSplits", [
+			{"name": "ticker", "type": "text"},
+			{"name": "date", "type": "datetime"},
+			{"name": "value", "type": "float"},
+			{"name": "day", "type": "integer"}], index = [
+			{"name": "tickerDate", "cols": ["ticker", "date"]},
+			{"name": "stockSplitsDay", "cols": ["ticker", "day"]}], unique = [
+			{"name": "stockSplitsUnique", "cols": ["ticker", "date"]}])
+		
+		for table in ["stockData", "stockDividends", "stockSplits"]:
+			if not hasDays[table]:
+				self.db.fillDays(table)
+
+		self.db.checkTable("stockInfo", [
+			{"name": "ticker", "type": "text"},
+			{"name": "lastDownload", "type": "datetime"},
+			{"name": "icarraTicker", "type": "text"},
+			{"name": "name", "type": "text"}], unique = [
+			{"name": "ticker", "cols": ["ticker"]}])
+
+		self.db.checkTable("stockNews", [
+			{"name": "ticker", "type": "text"},
+			{"name": "date", "type": "datetime"},
+			{"name": "title", "type": "text"},
+			{"name": "summary", "type": "text"},
+			{"name": "rating", "type": "int"},
+			{"name": "url", "type": "text"},
+			{"name": "downloaded", "type": "bool default 0"},
+			{"name": "content", "type": "text"}], index = [
+			{"name": "tickerDate", "cols": ["ticker", "date"]}])
+	
+	def removeDuplicates(self, table, uniqueIndex):
+		'''Delete duplicate (ticker, date) rows from table if uniqueIndex does not exist yet'''
+		cursor = self.db.query("select name from sqlite_master where name in (?, ?)", (table, uniqueIndex))
+		names = [row["name"] for row in cursor.fetchall()]
+		if table in names and not uniqueIndex in names:
+			self.db.query("delete from " + table + " where rowid not in (select max(rowid) from " + table + " group by ticker, date)")
+	
+	def addNewDate(self, newDates, ticker, date):
+		'''Keep track of the earliest new date for ticker'''
+		if newDates is False:
+			return
+		date = Transaction.parseDate(date[:10] + " 00:00:00")
+		if not ticker in newDates or date < newDates[ticker]:
+			newDates[ticker] = date
+	
+	def getCache(self, ticker):
+		'''Return the TickerCache for ticker, reading it from the database if necessary'''
+		ticker = ticker.upper()
+		self.cacheLock.acquire()
+		try:
+			self.cacheClock += 1
+			if ticker in self.cache:
+				cache = self.cache[ticker]
+			else:
+				cache = TickerCache(self.db, ticker)
+				self.cache[ticker] = cache
+				self.cacheSize += cache.size
+				
+				# Remove least recently used tickers, always keep this one
+				while self.cacheSize > self.maxCacheSize and len(self.cache) > 1:
+					oldest = False
+					for (t, c) in self.cache.items():
+						if t != ticker and (oldest is False or c.lastUsed < self.cache[oldest].lastUsed):
+							oldest = t
+					self.cacheSize -= self.cache[oldest].size
+					del self.cache[oldest]
+			cache.lastUsed = self.cacheClock
+			return cache
+		finally:
+			self.cacheLock.release()
+	
+	def invalidateCache(self, ticker = False):
+		'''Remove ticker from the in memory cache.  Call after changing stock data.
+		If ticker is False the entire cache is cleared.'''
+		self.cacheLock.acquire()
+		if ticker is False:
+			self.cache = {}
+			self.cacheSize = 0
+		else:
+			ticker = ticker.upper()
+			if ticker in self.cache:
+				self.cacheSize -= self.cache[ticker].size
+				del self.cache[ticker]
+		self.cacheLock.release()
+	
+	def setMaxCacheSize(self, maxCacheSize):
+		self.cacheLock.acquire()
+		self.maxCacheSize = maxCacheSize
+		self.cacheLock.release()
 		
 	def getIcarraTicker(self, ticker):
 		res = self.db.select("stockInfo", where = {"ticker": ticker.upper()})
@@ -328,19 +537,12 @@ class StockData:
 		return ret
 
 	def getPrice(self, ticker, date):
-		where = {"ticker": ticker.upper(), "date": date.strftime("%Y-%m-%d 00:00:00")}
-		res = self.db.select("stockData", where = where)
-		row = res.fetchone()
-		if not row:
+		cache = self.getCache(ticker)
+		i = cache.find(cache.dates, date.toordinal())
+		if i == -1:
 			return False
 
-		return {
-			"date": Transaction.parseDate(row["date"]),
-			"open": float(row["open"]),
-			"high": float(row["high"]),
-			"low": float(row["low"]),
-			"close": float(row["close"]),
-			"volume": float(row["volume"])}
+		return cache.getPrice(i)
 	
 	def getOptionPrice(self, ticker, expire, strike, date, type):
 		# This function is currently a placeholder until Icarra supports option prices
@@ -358,46 +560,48 @@ class StockData:
 			price = t.pricePerShare
 		return price
 
-	def getNearestPrice(self, ticker, date):
-		'''Return price closest to date.  Checks within +/- 7 days.'''
-		for d in [0, -1, 1, -2, 2, -3, 3, -4, 4, -5, 5, -6, 6, -7, 7]:
-			where = {"ticker": ticker.upper(), "date": (date + datetime.timedelta(days = d)).strftime("%Y-%m-%d 00:00:00")}
-			res = self.db.select("stockData", where = where)
-			row = res.fetchone()
-			if row:
-				return {
-					"date": Transaction.parseDate(row["date"]),
-					"open": float(row["open"]),
-					"high": float(row["high"]),
-					"low": float(row["low"]),
-					"close": float(row["close"]),
-					"volume": float(row["volume"])}
+	def getNearestPrice(self, ticker, date, maxDays = 7):
+		'''Return price closest to date.  Checks within +/- maxDays days.'''
+		cache = self.getCache(ticker)
+		i = cache.findNearest(date.toordinal(), maxDays)
+		if i == -1:
+			return False
 		
-		return False
+		return cache.getPrice(i)
+	
+	def getNearestPrices(self, requests, maxDays = 7):
+		'''Batch version of getNearestPrice.  requests is a list of (ticker, date).
+		Return a list of prices in the same order, False if no price is found.'''
+		ret = []
+		caches = {}
+		for (ticker, date) in requests:
+			if not ticker in caches:
+				caches[ticker] = self.getCache(ticker)
+			cache = caches[ticker]
+			i = cache.findNearest(date.toordinal(), maxDays)
+			if i == -1:
+				ret.append(False)
+			else:
+				ret.append(cache.getPrice(i))
+		
+		return ret
 
 	def getDividend(self, ticker, date):
-		where = {"ticker": ticker.upper(), "date": date.strftime("%Y-%m-%d 00:00:00")}
-		res = self.db.select("stockDividends", where = where)
-		
-		row = res.fetchone()
-		if not row:
+		cache = self.getCache(ticker)
+		i = cache.find(cache.dividendDates, date.toordinal())
+		if i == -1:
 			return False
 
 		return {
-			"date": Transaction.parseDate(row["date"]),
-			"value": float(row["value"])}
+			"date": datetime.datetime.fromordinal(cache.dividendDates[i]),
+			"value": cache.dividends[i]}
 
 	def getDividends(self, ticker, firstDate = False, desc = False):
-		where = {"ticker": ticker.upper()}
+		cache = self.getCache(ticker)
 		if firstDate:
-			where["date >="] = firstDate.strftime("%Y-%m-%d 00:00:00")
-		cursor = self.db.select("stockDividends", where = where, orderBy = "date asc")
-		
-		res = []
-		for row in cursor.fetchall():
-			res.append({
-				"date": Transaction.parseDate(row["date"]),
-				"value": float(row["value"])})
+			res = cache.getValues(cache.dividendDates, cache.dividends, firstDate.toordinal())
+		else:
+			res = cache.getValues(cache.dividendDates, cache.dividends)
 		
 		if desc:
 			res.reverse()
@@ -405,16 +609,11 @@ class StockData:
 		return res
 
 	def getSplits(self, ticker, firstDate = False, lastDate = False, desc = False):
-		where = {"ticker": ticker.upper()}
+		cache = self.getCache(ticker)
 		if firstDate:
-			where["date >="] = firstDate.strftime("%Y-%m-%d 00:00:00")
-		cursor = self.db.select("stockSplits", where = where, orderBy = "date asc")
-		
-		res = []
-		for row in cursor.fetchall():
-			res.append({
-				"date": Transaction.parseDate(row["date"]),
-				"value": float(row["value"])})
+			res = cache.getValues(cache.splitDates, cache.splits, firstDate.toordinal())
+		else:
+			res = cache.getValues(cache.splitDates, cache.splits)
 		
 		if desc:
 			res.reverse()
@@ -422,48 +621,99 @@ class StockData:
 		return res
 
 	def getPrices(self, ticker, endDate = False, startDate = False, desc = False, limit = False, splitAdjusted = False):
-		where = {"ticker": ticker.upper()}
-		order = "ticker, date asc"
+		cache = self.getCache(ticker)
+		first = 0
+		last = len(cache.dates)
 		if startDate:
-			where["date >="] = datetime.datetime(startDate.year, startDate.month, startDate.day, 0, 0, 0)
+			first = bisect.bisect_left(cache.dates, startDate.toordinal())
 		if endDate:
-			where["date <="] = datetime.datetime(endDate.year, endDate.month, endDate.day, 23, 59, 59)
-		res = self.db.select("stockData", where = where, orderBy = order, limit = limit)
+			last = bisect.bisect_right(cache.dates, endDate.toordinal())
+		if limit:
+			last = min(last, first + limit)
 		
 		ret = []
-		for row in res.fetchall():
-			ticker = row["ticker"].upper()
-			ret.append({
-				"date": Transaction.parseDate(row["date"]),
-				"open": float(row["open"]),
-				"high": float(row["high"]),
-				"low": float(row["low"]),
-				"close": float(row["close"]),
-				"volume": float(row["volume"])})
-		
 		if splitAdjusted:
-			splitFactor = 1
-			splits = self.getSplits(ticker, firstDate = startDate, lastDate = endDate)
-			pi = 0
-			si = 0
-			while pi < len(ret):
-				if si < len(splits):
-					if splits[si]['date'] <= ret[pi]['date']:
-						splitFactor *= splits[si]['value']
-						si += 1
-				
-				if splitFactor != 1:
-					ret[pi]['high'] = ret[pi]['high'] * splitFactor
-					ret[pi]['low'] = ret[pi]['low'] * splitFactor
-					ret[pi]['open'] = ret[pi]['open'] * splitFactor
-					ret[pi]['close'] = ret[pi]['close'] * splitFactor
-				pi += 1
+			# Only include splits on or after startDate
+			factors = cache.getSplitFactors()
+			baseFactor = 1.0
+			if startDate:
+				for si in range(bisect.bisect_left(cache.splitDates, startDate.toordinal())):
+					baseFactor *= cache.splits[si]
+			for i in range(first, last):
+				ret.append(cache.getPrice(i, factors[i] / baseFactor))
+		else:
+			for i in range(first, last):
+				ret.append(cache.getPrice(i))
 
 		if desc:
 			ret.reverse()
 
 		return ret
 
+	def iterPrices(self, ticker, columns = ["date", "close"], startDate = False, endDate = False, desc = False, limit = False, splitAdjusted = False, ordinals = False):
+		'''Yield a tuple of columns for every price of ticker, read from the database in chunks without the cache.
+		columns are from priceColumns.  Dates are datetimes or day ordinals if ordinals is True.
+		limit counts prices in the requested order.  Split adjusted prices include splits on or after startDate.'''
+		ticker = ticker.upper()
+		where = {"ticker": ticker}
+		if startDate:
+			where["day >="] = startDate.toordinal()
+		if endDate:
+			where["day <="] = endDate.toordinal()
+		# factors[k] is the product of the first k splits, the factor of a price after k splits
+		splitDays = []
+		factors = [1.0]
+		adjustIndexes = []
+		if splitAdjusted:
+			adjustIndexes = [i for i in range(len(columns)) if columns[i] in ["open", "high", "low", "close"]]
+		if adjustIndexes:
+			splitWhere = {"ticker": ticker}
+			if startDate:
+				splitWhere["day >="] = startDate.toordinal()
+			for (day, value) in self.db.selectTuples("stockSplits", what = "day, value", where = splitWhere, orderBy = "day asc").fetchall():
+				splitDays.append(day)
+				factors.append(factors[-1] * value)
+		
+		what = [c == "date" and "day" or c for c in columns]
+		dateIndex = -1
+		if "date" in columns:
+			dateIndex = columns.index("date")
+		dayIndex = dateIndex
+		if splitDays and dateIndex == -1:
+			# Adjusting needs the day even if it is not returned
+			dayIndex = len(what)
+			what.append("day")
+		if desc:
+			orderBy = "day desc"
+		else:
+			orderBy = "day asc"
+		cursor = self.db.selectTuples("stockData", what = ", ".join(what), where = where, orderBy = orderBy, limit = limit)
+		
+		while True:
+			rows = cursor.fetchmany(self.chunkSize)
+			if not rows:
+				break
+			for row in rows:
+				if splitDays or (dateIndex != -1 and not ordinals):
+					row = list(row)
+					day = row[dayIndex]
+					if splitDays:
+						factor = factors[bisect.bisect_right(splitDays, day)]
+						for i in adjustIndexes:
+							row[i] *= factor
+					if dateIndex != -1 and not ordinals:
+						row[dateIndex] = datetime.datetime.fromordinal(day)
+					row = tuple(row[:len(columns)])
+				yield row
+	
+	def getPriceArrays(self, ticker, columns = ["date", "close"], startDate = False, endDate = False, desc = False, limit = False, splitAdjusted = False):
+		'''Return a tuple with an array per column of iterPrices.  Dates are day ordinals.'''
+		arrays = tuple([array(c == "date" and "l" or "d") for c in columns])
+		for row in self.iterPrices(ticker, columns, startDate, endDate, desc, limit, splitAdjusted, ordinals = True):
+			for i in range(len(arrays)):
+				arrays[i].append(row[i])
+		return arrays
+
 	def getLastDate(self, ticker):
 		res = self.db.select("stockData", where = {"ticker": ticker.upper()}, orderBy = "date desc", limit = 1)
 		row = res.fetchone()
@@ -518,6 +768,65 @@ class StockData:
 		return ret
 
 if __name__ == "__main__":
-	s = StockData()
-	s.getFromServer("agg")
-	s.readFromDb()
+	import tempfile
+	import shutil
+	
+	def price(p):
+		return (p, p, p, p, 1000.0)
+	
+	def stocks(ticker, first, count, p):
+		ret = {}
+		for i in range(count):
+			date = datetime.date.fromordinal(first + i).strftime("%Y-%m-%d 00:00:00")
+			ret[(ticker, date)] = price(p + i)
+		return ret
+	
+	path = tempfile.mkdtemp()
+	try:
+		prefs.Prefs.prefsRootPath = staticmethod(lambda: path)
+		s = StockData()
+		first = datetime.date(2010, 1, 4).toordinal()
+		data = {"version": False, "stocks": {}, "dividends": {}, "splits": {}}
+		for (ticker, p) in [("A", 10.0), ("B", 20.0), ("C", 30.0)]:
+			data["stocks"].update(stocks(ticker, first, 100, p))
+		data["dividends"][("A", "2010-02-01 00:00:00")] = (0.5,)
+		data["splits"][("A", "2010-03-01 00:00:00")] = (2.0,)
+		assert(s.saveStockData(data))
+		
+		print "test 1 - prices are read from the cache"
+		d = datetime.datetime(2010, 1, 5)
+		assert(s.getPrice("A", d)["close"] == 11.0)
+		assert(s.getPrice("A", d)["date"] == d)
+		assert(s.getPrice("A", datetime.datetime(2009, 1, 5)) is False)
+		assert(s.getNearestPrice("B", datetime.datetime(2009, 12, 30))["close"] == 20.0)
+		assert(s.getNearestPrice("B", datetime.datetime(2009, 12, 1)) is False)
+		assert([p and p["close"] for p in s.getNearestPrices([("A", d), ("C", d), ("A", datetime.datetime(2011, 1, 1))])] == [11.0, 31.0, False])
+		assert(s.getDividend("A", datetime.datetime(2010, 2, 1))["value"] == 0.5)
+		assert([x["value"] for x in s.getSplits("A")] == [2.0])
+		assert(s.getCache("A") is s.getCache("A"))
+		
+		print "test 2 - saving stock data invalidates the cache"
+		s.saveStockData({"version": False, "stocks": {("A", "2010-01-05 00:00:00"): price(99.0)}, "dividends": {}, "splits": {}})
+		assert(s.getPrice("A", d)["close"] == 99.0)
+		# Data written behind the cache is not seen until invalidated
+		s.db.query("update stockData set close=? where ticker=?", (1.0, "B"))
+		assert(s.getPrice("B", d)["close"] == 21.0)
+		s.invalidateCache("B")
+		assert(s.getPrice("B", d)["close"] == 1.0)
+		s.invalidateCache()
+		assert(s.cache == {} and s.cacheSize == 0)
+		
+		print "test 3 - least recently used tickers are removed"
+		size = s.getCache("A").size
+		s.setMaxCacheSize(size * 2 + 1)
+		s.getCache("B")
+		s.getCache("A")
+		s.getCache("C")
+		assert(sorted(s.cache.keys()) == ["A", "C"])
+		assert(s.cacheSize == sum([c.size for c in s.cache.values()]))
+		s.setMaxCacheSize(1)
+		s.getCache("B")
+		assert(s.cache.keys() == ["B"])
+		s.db.close()
+	finally:
+		shutil.rmtree(path)
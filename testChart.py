@@ -14,7 +14,7 @@ prefs = Prefs()
 app = QApplication(sys.argv)
 app.isOSX = True
 appGlobal.setApp(app, os.path.dirname(__file__))
-p = Portfolio("Scottrade")
+p = getPortfolio("Scottrade")
 
 stockData = StockData()
 
@@ -25,5 +25,5 @@ p.chart(w, stockData, "__COMBINED__", doSplit = True)
 
 img = QPixmap(w.size());
 painter = QPainter(img);
-w.paintEvent(None, painter)
+w.paintChart(painter)
 img.save("test.jpg");
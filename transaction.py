@@ -34,6 +34,9 @@ while not imported:
 		pass
 
 import locale
+import bisect
+import hashlib
+from array import array
 
 # If locale currency is supported
 global useLocaleCurrency
@@ -43,7 +46,7 @@ def dateDict(date):
 	'''Helper function to convert a datetime class into a dictionary'''
 	return {"y": date.year, "m": date.month, "d": date.day}
 
-class Transaction:
+class Transaction(object):
 	'''The Transaction class is one of the most important classes in the
 	Icarra system.  All portfolio calculations revolve around transactions.
 	Importing transactions automatically from brokerages is critical for
@@ -170,6 +173,15 @@ class Transaction:
 	# Applies to buy, sell, short, buyToClose
 	optionPut = 1
 	optionCall = 2
+	
+	# Columns written by save, in order
+	saveColumns = ["uniqueId", "ticker", "ticker2", "type", "subType", "date", "shares", "pricePerShare", "fee", "total", "optionStrike", "optionExpire", "edited", "deleted", "auto"]
+	
+	# Columns that identify an imported transaction without a uniqueId, see getHash
+	hashColumns = ["ticker", "ticker2", "type", "subType", "date", "shares", "pricePerShare", "fee", "total", "optionStrike", "optionExpire", "auto"]
+	
+	# Transactions are created for every row of every portfolio, keep them small
+	__slots__ = ("uniqueId", "ticker", "ticker2", "auto", "date", "type", "subType", "total", "shares", "pricePerShare", "fee", "optionStrike", "optionExpire", "edited", "deleted", "computedCashValue")
 
 	def __init__(self, uniqueId, ticker, date, transactionType, amount = False, shares = False, pricePerShare = False, fee = False, edited = False, deleted = False, ticker2 = False, subType = False, optionStrike = False, optionExpire = False, auto = False):
 		'''Create a new Transaction.  Required fields are described in the Transaction class documentation.'''
@@ -286,6 +298,27 @@ class Transaction:
 		# Basic hash function by datetime (integer) and transaction type
 		return hash((self.date, self.type))
 	
+	def __getstate__(self):
+		state = {}
+		for name in Transaction.__slots__:
+			if hasattr(self, name):
+				state[name] = getattr(self, name)
+		return state
+	
+	def __setstate__(self, state):
+		for (name, value) in state.items():
+			setattr(self, name, value)
+	
+	def sortKey(self):
+		'''Key for sorting transactions, sort with reverse = True for the same order as __cmp__'''
+		return (self.date, Transaction.getTransactionOrdering(self.type))
+	
+	def copy(self):
+		'''Return a copy of this transaction.  All fields are immutable so the copy is shallow.'''
+		t = Transaction.__new__(Transaction)
+		t.__setstate__(self.__getstate__())
+		return t
+	
 	def setDate(self, date):
 		self.date = date
 
@@ -902,6 +935,31 @@ class Transaction:
 			"auto": self.auto
 		}
 	
+	@staticmethod
+	def hashValues(values):
+		'''Return the content hash of hashColumns values.
+		Values are converted the way the database stores them so a row read back has the same hash.'''
+		strings = []
+		for value in values:
+			if type(value) == bool:
+				if value:
+					value = u"True"
+				else:
+					value = u"False"
+			elif type(value) in [int, long, float]:
+				value = repr(float(value))
+			elif type(value) == str:
+				value = value.decode("utf-8", "replace")
+			else:
+				value = unicode(value)
+			strings.append(value)
+		return hashlib.md5(u"|".join(strings).encode("utf-8")).hexdigest()
+	
+	def getHash(self):
+		'''Return a hash of every field except uniqueId, edited and deleted'''
+		data = self.getSaveData()
+		return Transaction.hashValues([data[c] for c in Transaction.hashColumns])
+	
 	def save(self, db):
 		'''Save this transaction to the passed database.  This is typically Portfolio.db.'''
 		data = self.getSaveData()
@@ -911,8 +969,9 @@ class Transaction:
 		if self.uniqueId:
 			on = {"uniqueId": self.uniqueId}
 		else:
-			on = data
+			on = dict(data)
 		
+		data["hash"] = self.getHash()
 		return db.insertOrUpdate("transactions", data, on)
 	
 	def checkError(self):
@@ -940,3 +999,64 @@ class Transaction:
 			return error
 		else:
 			return False
+
+class TransactionTable:
+	'''Transactions sorted by date ascending stored as parallel arrays.
+	Calculations that walk every transaction read the arrays instead of Transaction objects.
+	tickerId is an index into tickers, total is the stored total and netTotal is getTotal().
+	days are date ordinals, dates are the full datetimes used for date ranges.'''
+	def __init__(self, transactions = []):
+		self.dates = []
+		self.days = array("l")
+		self.type = array("i")
+		self.tickerId = array("i")
+		self.shares = array("d")
+		self.pricePerShare = array("d")
+		self.fee = array("d")
+		self.total = array("d")
+		self.netTotal = array("d")
+		self.tickers = []
+		self.tickerIds = {}
+		for t in transactions:
+			self.append(t)
+	
+	def __len__(self):
+		return len(self.days)
+	
+	def getTickerId(self, ticker):
+		'''Return the id of ticker, adding it if it is new'''
+		id = self.tickerIds.get(ticker)
+		if id is None:
+			id = len(self.tickers)
+			self.tickers.append(ticker)
+			self.tickerIds[ticker] = id
+		return id
+	
+	def append(self, t):
+		'''Append a transaction, it must not be before the last transaction'''
+		self.dates.append(t.date)
+		self.days.append(t.date.toordinal())
+		self.type.append(t.type)
+		self.tickerId.append(self.getTickerId(t.ticker))
+		self.shares.append(t.shares or 0.0)
+		self.pricePerShare.append(t.pricePerShare or 0.0)
+		self.fee.append(t.fee or 0.0)
+		self.total.append(t.total or 0.0)
+		self.netTotal.append(t.getTotal())
+	
+	def getIndexes(self, first = False, last = False, types = False):
+		'''Return the indexes of transactions from first to last inclusive whose type is in types (all types if False).
+		first and last are compared to the full transaction datetimes.'''
+		if first:
+			begin = bisect.bisect_left(self.dates, first)
+		else:
+			begin = 0
+		if last:
+			end = bisect.bisect_right(self.dates, last)
+		else:
+			end = len(self.dates)
+		
+		if not types:
+			return range(begin, end)
+		transTypes = self.type
+		return [i for i in xrange(begin, end) if transTypes[i] in types]
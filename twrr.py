@@ -3,7 +3,7 @@ from basis import *
 class Twrr:
 	"""Implements time weighted returns.  Relies on a basis tracker for shorts/covers."""
 
-	def __init__(self):
+	def __init__(self, basisMethod = Basis.fifo):
 		self.day = 0
 		self.ticker = False
 		# Shares is a count of shares owned per ticker
@@ -11,7 +11,7 @@ class Twrr:
 		self.sharesShort = {}
 		self.prices = {}
 		self.yesterdayPrices = {}
-		self.basis = Basis()
+		self.basis = Basis(basisMethod)
 		self.adjustBasises = {}
 		self.adjustment = 0
 		self.totalAdjustment = 0
@@ -421,6 +421,31 @@ class Twrr:
 	def getReturnFee(self):
 		return self.getReturnSplit() * self.dividendMod * self.feeMod
 
+	def getState(self):
+		"""Return the state kept between days as plain dictionaries and numbers"""
+		return {
+			"day": self.day,
+			"ticker": self.ticker,
+			"shares": dict(self.shares),
+			"sharesShort": dict(self.sharesShort),
+			"prices": dict(self.prices),
+			"yesterdayPrices": dict(self.yesterdayPrices),
+			"basis": self.basis.getState(),
+			"adjustBasises": dict(self.adjustBasises),
+			"totalAdjustment": self.totalAdjustment,
+			"lastValue": self.lastValue,
+			"lastReturn": self.lastReturn,
+			"yesterdayValue": self.yesterdayValue,
+			"stockDividend": dict(self.stockDividend),
+			"dividendMod": self.dividendMod,
+			"feeMod": self.feeMod}
+
+	def setState(self, state):
+		"""Restore a state returned by getState"""
+		state = state.copy()
+		self.basis.setState(state.pop("basis"))
+		self.__dict__.update(state)
+
 def checkSplit(r, check):
 	if abs(r.getReturnSplit() - check) >= 1.0e-6:
 		print "FAIL split:", r.getTotalValue(), r.getReturnSplit(), "split should be", check